@@ -0,0 +1,89 @@
+""" Benchmark the database performance profiles.
+
+Builds a synthetic database of 500 podcasts with 200 episodes each (100k
+episodes) once for each profile and times the operations pyres does on it.
+Run from the top of the source tree with:
+
+    python bench/bench_database.py [podcasts] [episodes per podcast]
+"""
+from __future__ import print_function
+import os
+import sys
+import time
+import tempfile
+import shutil
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from pyres.database import PodcastDatabase, PROFILES  # noqa: E402
+from pyres.episode import Episode  # noqa: E402
+
+
+def make_episodes(name, count):
+    """ Build count episodes for a podcast, one a day """
+    return [Episode(date=time.gmtime(1400000000 + index * 86400),
+                    title='%s episode %d' % (name, index),
+                    url='http://example.com/%s/%d.mp3' % (name, index),
+                    podcast=name, file_name='Files/%s/%d.mp3' % (name, index))
+            for index in range(count)]
+
+
+def timed(results, label, function):
+    """ Run function and record how long it took """
+    start = time.time()
+    function()
+    results.append((label, time.time() - start))
+
+
+def run_profile(profile, directory, podcasts, per_podcast):
+    """ Time each step against a new database using the given profile """
+    file_name = os.path.join(directory, profile + '.db')
+    results = list()
+    names = ['podcast %04d' % index for index in range(podcasts)]
+    with PodcastDatabase(file_name, profile) as _database:
+        def build():
+            """ one commit per feed, like a refresh of every subscription """
+            for name in names:
+                _database.add_podcast(name, 'http://example.com/' + name, 10)
+                _database.add_new_episodes(name,
+                                           make_episodes(name, per_podcast))
+                _database.connection.commit()
+
+        def mark():
+            """ mark the newest episode of every podcast downloaded, one
+            commit each like a download finishing """
+            for episode in list(_database.iter_episodes(0))[-podcasts:]:
+                _database.mark_episode_downloaded(episode)
+                _database.connection.commit()
+
+        def query():
+            """ the read queries run by update, process and download """
+            for _ in range(5):
+                _database.get_podcast_urls()
+                _database.count_episodes(0)
+                for _ in _database.iter_episodes(1):
+                    pass
+
+        timed(results, 'build', build)
+        timed(results, 'mark', mark)
+        timed(results, 'query', query)
+    return results
+
+
+def main():
+    """ Run the benchmark for every profile and print a table """
+    podcasts = int(sys.argv[1]) if len(sys.argv) > 1 else 500
+    per_podcast = int(sys.argv[2]) if len(sys.argv) > 2 else 200
+    print("%d podcasts, %d episodes" % (podcasts, podcasts * per_podcast))
+    directory = tempfile.mkdtemp()
+    try:
+        for profile in sorted(PROFILES):
+            results = run_profile(profile, directory, podcasts, per_podcast)
+            print("%-10s" % profile +
+                  "".join("%8s: %7.2fs" % result for result in results))
+    finally:
+        shutil.rmtree(directory)
+
+
+if __name__ == '__main__':
+    main()
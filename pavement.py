@@ -124,6 +124,14 @@ def test_all():
     raise SystemExit(retcode)
 
 
+@task
+@consume_args
+def bench(args):
+    """Benchmark the database performance profiles."""
+    raise SystemExit(subprocess.call(
+        [sys.executable, 'bench/bench_database.py'] + list(args)))
+
+
 @task
 def cov():
     """ Get test coverage """
@@ -0,0 +1,385 @@
+"""
+Download episodes using a single asyncio event loop.
+
+This engine needs python 3.6 or later and is only imported when it is chosen
+on the command line.  It speaks just enough HTTP/1.1 to fetch podcast files:
+GET requests over http or https, redirects, and bodies sent with either a
+Content-Length or chunked encoding.  Each file gets a connection of its own,
+which is closed when it is done, and proxies set in HTTP_PROXY or
+HTTPS_PROXY are not used; the threads engine does both.
+
+The event loop only waits on the network.  Writing, hashing and syncing the
+part files is handed to the loop's thread pool, so a slow disk does not hold
+up the other transfers.  The download results are still written to the
+database on the loop, as the connection belongs to this thread; they are
+committed in groups, so that wait is rare.
+"""
+import asyncio
+import concurrent.futures
+import ssl
+from six.moves.urllib.parse import urlsplit, urljoin, quote
+import pyres.retry as retry
+from pyres.download import PodcastDownloader, PartialDownload, \
+    ProgressLimiter, bytes_to_come, DEFAULT_READ_SIZE, DEFAULT_FSYNC, \
+    EVENT_TIMEOUT, PROGRESS, COMPLETED, FAILED, DEFAULT_CONCURRENCY
+
+# seconds to wait for a connection or for more data before giving up
+TIMEOUT = 60
+MAX_REDIRECTS = 10
+REDIRECTS = (301, 302, 303, 307, 308)
+# characters left alone when escaping the path and query of a url.  % is
+# kept so anything already escaped is not escaped twice
+_PATH_SAFE = "/%:@!$&'()*+,;=-._~"
+_QUERY_SAFE = _PATH_SAFE + "?"
+
+
+class HttpError(Exception):
+    """ The server sent something we cannot use """
+    pass
+
+
+class Response(object):
+    """ The final url, status, headers and open connection for a request """
+    def __init__(self, url, status, headers, reader, writer):
+        self.url = url
+        self.status = status
+        self.headers = headers
+        self.reader = reader
+        self.writer = writer
+
+    def close(self):
+        """ Close the connection to the server """
+        self.writer.close()
+
+    def iter_content(self, block_size=DEFAULT_READ_SIZE):
+        """ Return an async iterator over the body of the response in blocks
+        of at most block_size bytes """
+        if self.headers.get('transfer-encoding', '').lower() == 'chunked':
+            return self._iter_chunked(block_size)
+        if 'content-length' in self.headers:
+            return self._iter_sized(int(self.headers['content-length']),
+                                    block_size)
+        return self._iter_until_closed(block_size)
+
+    async def _iter_chunked(self, block_size):
+        """ Yield a body sent with chunked encoding """
+        while True:
+            line = await _read(self.reader.readline())
+            try:
+                remaining = int(line.split(b';')[0], 16)
+            except ValueError:
+                raise HttpError("Bad chunk size %r" % line)
+            if not remaining:
+                break
+            async for block in self._iter_sized(remaining, block_size):
+                yield block
+            await _read(self.reader.readline())
+
+    async def _iter_sized(self, remaining, block_size):
+        """ Yield the next remaining bytes of the body """
+        while remaining:
+            block = await _read(self.reader.read(min(remaining, block_size)))
+            if not block:
+                raise HttpError("Connection closed with %d bytes to go" %
+                                remaining)
+            remaining -= len(block)
+            yield block
+
+    async def _iter_until_closed(self, block_size):
+        """ Yield a body of no given length, which ends when the server
+        closes the connection """
+        while True:
+            block = await _read(self.reader.read(block_size))
+            if not block:
+                break
+            yield block
+
+
+async def _on_disk(func, *args):
+    """ Run func in the thread pool so the loop is free while it waits for
+    the disk """
+    return await asyncio.get_event_loop().run_in_executor(None, func, *args)
+
+
+async def _read(awaitable):
+    """ Wait for a read from the server, giving up after TIMEOUT """
+    return await asyncio.wait_for(awaitable, TIMEOUT)
+
+
+def _request_target(parts):
+    """ Return the path and host to send for the split url.  The request
+    has to be plain ascii, whatever the feed gave us. """
+    path = quote((parts.path or '/').encode('utf-8'), safe=_PATH_SAFE)
+    if parts.query:
+        path += '?' + quote(parts.query.encode('utf-8'), safe=_QUERY_SAFE)
+    host = parts.netloc
+    try:
+        host.encode('ascii')
+    except UnicodeError:
+        host = host.encode('idna').decode('ascii')
+    return path, host
+
+
+async def _read_head(reader):
+    """ Read the status line and headers of a response, returning the status
+    and the headers by lower case name """
+    status_line = await _read(reader.readline())
+    try:
+        status = int(status_line.split()[1])
+    except (IndexError, ValueError):
+        raise HttpError("Bad status line %r" % status_line)
+    headers = dict()
+    while True:
+        line = await _read(reader.readline())
+        if line in (b'\r\n', b'\n', b''):
+            break
+        name, _, value = line.decode('latin-1').partition(':')
+        headers[name.strip().lower()] = value.strip()
+    return status, headers
+
+
+async def open_url(url, headers=None, redirects=MAX_REDIRECTS):
+    """ Send a GET request for url with any extra headers, following
+    redirects, and return a Response with the headers read and the body ready
+    to iterate """
+    parts = urlsplit(url)
+    if parts.scheme not in ('http', 'https') or not parts.hostname:
+        raise HttpError("Unsupported url %s" % url)
+    secure = parts.scheme == 'https'
+    port = parts.port or (443 if secure else 80)
+    reader, writer = await _read(asyncio.open_connection(
+        parts.hostname, port,
+        ssl=ssl.create_default_context() if secure else None))
+
+    request = ("GET %s HTTP/1.1\r\n"
+               "Host: %s\r\n"
+               "User-Agent: pyres\r\n"
+               "Accept-Encoding: identity\r\n"
+               "Connection: close\r\n" % _request_target(parts))
+    for name, value in (headers or dict()).items():
+        request += "%s: %s\r\n" % (name, value)
+    request += "\r\n"
+    writer.write(request.encode('latin-1'))
+
+    try:
+        status, response_headers = await _read_head(reader)
+    except Exception:
+        writer.close()
+        raise
+
+    response = Response(url, status, response_headers, reader, writer)
+    if status in REDIRECTS and 'location' in response_headers:
+        response.close()
+        if not redirects:
+            raise HttpError("Too many redirects for %s" % url)
+        return await open_url(urljoin(url, response_headers['location']),
+                              headers, redirects - 1)
+    return response
+
+
+def _cancel_tasks(loop):
+    """ Cancel the tasks an interrupted run leaves behind and let them
+    finish, so their connections and part files are closed """
+    all_tasks = getattr(asyncio, 'all_tasks', None) or asyncio.Task.all_tasks
+    tasks = [task for task in all_tasks(loop) if not task.done()]
+    for task in tasks:
+        task.cancel()
+    if tasks:
+        loop.run_until_complete(asyncio.gather(*tasks,
+                                               return_exceptions=True))
+
+
+# ----------------------------------------------------------------------
+class AsyncPodcastDownloader(PodcastDownloader):
+    """ download the podcasts to disk with up to concurrency transfers at a
+    time, all driven from one event loop """
+    # pylint: disable=too-many-arguments
+    def __init__(self, episodes, concurrency=DEFAULT_CONCURRENCY,
+                 read_size=DEFAULT_READ_SIZE, bandwidth=None, disk=None,
+                 fsync=DEFAULT_FSYNC, recorder=None):
+        PodcastDownloader.__init__(self, episodes, concurrency, read_size,
+                                   bandwidth, disk=disk, fsync=fsync,
+                                   recorder=recorder)
+
+    def download_url_list(self):
+        """
+        Downloads each of the episodes passed in, num_threads at a time.
+        """
+        loop = asyncio.new_event_loop()
+        executor = concurrent.futures.ThreadPoolExecutor()
+        loop.set_default_executor(executor)
+        try:
+            loop.run_until_complete(self._download_all())
+        finally:
+            _cancel_tasks(loop)
+            executor.shutdown(wait=True)
+            loop.close()
+        self.status.finish(self.failed_files)
+        self.show_deferred()
+        self.show_throughput()
+
+    async def _download_all(self):
+        """ Start a task for each download slot and wait for them all """
+        episodes = asyncio.Queue()
+        self.remaining = len(self.episodes)
+        for episode in self.admit(self.episodes):
+            episodes.put_nowait(episode)
+        self._stop_if_done(episodes)
+        workers = [asyncio.ensure_future(self._worker(task_id, episodes))
+                   for task_id in range(self.num_threads)]
+        running = workers
+        try:
+            while running:
+                _, running = await asyncio.wait(running,
+                                                timeout=EVENT_TIMEOUT)
+                if self.recorder:
+                    # results are committed on time even when nothing
+                    # arrives
+                    self.recorder.tick()
+        finally:
+            # if we were interrupted, stop the workers and collect what
+            # they raised
+            for worker in running:
+                worker.cancel()
+            await asyncio.gather(*workers, return_exceptions=True)
+        for worker in workers:
+            worker.result()
+
+    async def _worker(self, task_id, episodes):
+        """ Download episodes from the queue until told to stop.  Transient
+        failures are queued again after a short wait, leaving the slot free
+        meanwhile.  Episodes which do not fit on the disk are deferred, and
+        those deferred earlier are queued again whenever a download
+        finishes. """
+        while True:
+            episode = await episodes.get()
+            if episode is None:
+                break  # every episode is done with
+            try:
+                await self.download_file(task_id, episode)
+            except asyncio.CancelledError:
+                raise  # an Exception itself before python 3.8
+            except Exception as err:  # pylint: disable=broad-except
+                # one bad episode must not stop the others
+                self.send_error(episode, episode.url, err,
+                                retry.classify_exception(err))
+            self._settle(task_id, episode, episodes)
+            self._stop_if_done(episodes)
+
+    def _settle(self, task_id, episode, episodes):
+        """ Deal with an episode whose download has ended: defer it, queue
+        it again after a wait, or count it as done """
+        self.disk.release(episode)
+        if episode.error_class == retry.DISK:
+            self.deferred_files.append(episode)
+            return
+        if episode.error_msg:
+            delay = self.retry_delay(episode)
+            if delay is not None:
+                asyncio.get_event_loop().call_later(
+                    delay, episodes.put_nowait, episode)
+            else:
+                self.handle_event(task_id, FAILED, 0, episode)
+                self.remaining -= 1
+        else:
+            self.remaining -= 1
+        # there may be room on the disk now
+        for admitted in self.readmit():
+            episodes.put_nowait(admitted)
+
+    def _stop_if_done(self, episodes):
+        """ Once nothing is left to download or retry, give each worker a
+        stop marker """
+        if self.pending() == 0:
+            for _ in range(self.num_threads):
+                episodes.put_nowait(None)
+
+    @staticmethod
+    def send_error(episode, name, message, error_class):
+        """ Record why a download failed """
+        episode.error_msg = "%s:%s" % (name, message)
+        episode.error_class = error_class
+
+    async def download_file(self, task_id, episode):
+        """ Download and write the file to disc, picking up where an earlier
+        attempt left off if we can.  On failure error_msg is set and the
+        caller decides whether to try again. """
+        episode.error_msg = None
+        episode.error_class = None
+        partial = PartialDownload(episode, self.fsync)
+        try:
+            response = await open_url(episode.url, partial.request_headers())
+            if response.status == 416 and partial.offset:
+                # the server will not resume this one, start again
+                response.close()
+                partial.discard()
+                response = await open_url(episode.url)
+        except (OSError, HttpError, asyncio.TimeoutError) as err:
+            self.send_error(episode, episode.url, err,
+                            retry.classify_exception(err))
+            return
+
+        try:
+            if not self._check_response(episode, partial, response):
+                return
+            total = await self._write_body(task_id, episode, partial,
+                                           response)
+            if episode.size and total != episode.size:
+                self.send_error(episode, episode.url,
+                                "incomplete: %d of %d bytes" %
+                                (total, episode.size), retry.NETWORK)
+                return
+            # without a Content-Length the size is whatever we got
+            episode.size = total
+            await _on_disk(partial.finish)
+            self.handle_event(task_id, COMPLETED, total, episode)
+        except (HttpError, asyncio.TimeoutError, ValueError) as err:
+            # the part file is kept so we can resume next time
+            self.send_error(episode, episode.url, err,
+                            retry.NETWORK if isinstance(err, HttpError)
+                            else retry.classify_exception(err))
+        except (IOError, OSError) as err:
+            self.send_error(episode, episode.file_name, err,
+                            retry.classify_io_error(err))
+        finally:
+            response.close()
+
+    def _check_response(self, episode, partial, response):
+        """ Return True if the response holds the file and it fits on the
+        disk, otherwise record why not """
+        # check http status for success (2xx)
+        if (200 > response.status) or (299 < response.status):
+            self.send_error(episode, episode.url,
+                            "HTTP STATUS: %s" % response.status,
+                            retry.classify_status(response.status))
+            return False
+
+        # now we know how big the file is, make sure it fits
+        needed = bytes_to_come(episode, partial, response.headers)
+        if not self.disk.claim(episode, needed):
+            self.send_error(episode, episode.file_name,
+                            "no room for %d bytes" % needed, retry.DISK)
+            return False
+        return True
+
+    async def _write_body(self, task_id, episode, partial, response):
+        """ Write the body of the response to the part file, returning the
+        size of the file so far """
+        podcast_file = await _on_disk(partial.open, response.status,
+                                      response.headers)
+        try:
+            total = partial.offset
+            progress = ProgressLimiter()
+            host = urlsplit(response.url).hostname
+            async for block in response.iter_content(self.read_size):
+                total = total + len(block)
+                await _on_disk(podcast_file.write, block)
+                if progress.ready(total):
+                    self.handle_event(task_id, PROGRESS, total, episode)
+                wait = self.bandwidth.reserve(host, len(block))
+                if wait:
+                    await asyncio.sleep(wait)
+            podcast_file.digest.record(episode)
+        finally:
+            await _on_disk(podcast_file.close)
+        return total
@@ -0,0 +1,95 @@
+"""
+Limit and measure the bandwidth used by downloads.
+
+Limits are token buckets: each byte read takes a token and tokens come back
+at the limiting rate.  A read larger than the tokens available runs the
+bucket into debt and the reader waits until the debt is paid off, so the
+caller decides how to wait (a thread sleeps, a coroutine awaits).
+"""
+import threading
+import time
+
+
+########################################################################
+class TokenBucket(object):
+    """ Allow rate bytes a second with bursts of up to burst bytes """
+
+    # ----------------------------------------------------------------------
+    def __init__(self, rate, burst=None, clock=time.time):
+        self.rate = float(rate)
+        self.capacity = float(burst or rate)
+        self.tokens = self.capacity
+        self.clock = clock
+        self.last = clock()
+        self.lock = threading.Lock()
+
+    def reserve(self, amount):
+        """ Take amount tokens and return the number of seconds to wait
+        before using them """
+        with self.lock:
+            now = self.clock()
+            self.tokens = min(self.capacity,
+                              self.tokens + (now - self.last) * self.rate)
+            self.last = now
+            self.tokens -= amount
+            if self.tokens >= 0:
+                return 0
+            return -self.tokens / self.rate
+
+
+########################################################################
+class Bandwidth(object):
+    """ The bandwidth shared by all downloads.  rate caps the total and
+    host_rate caps each host, both in bytes a second with None for no limit.
+    The bytes read are counted to report the throughput seen. """
+
+    # ----------------------------------------------------------------------
+    def __init__(self, rate=None, host_rate=None, clock=time.time):
+        self.clock = clock
+        self.host_rate = host_rate
+        self.bucket = TokenBucket(rate, clock=clock) if rate else None
+        self.host_buckets = dict()
+        # host: [bytes, first read time, last read time]
+        self.counts = dict()
+        self.lock = threading.Lock()
+
+    def _host_bucket(self, host):
+        """ Return the bucket for host, creating it the first time """
+        with self.lock:
+            if host not in self.host_buckets:
+                self.host_buckets[host] = TokenBucket(self.host_rate,
+                                                      clock=self.clock)
+            return self.host_buckets[host]
+
+    def reserve(self, host, amount):
+        """ Record amount bytes read from host and return the number of
+        seconds to wait before reading more """
+        now = self.clock()
+        with self.lock:
+            count = self.counts.setdefault(host, [0, now, now])
+            count[0] += amount
+            count[2] = now
+        waits = [0]
+        if self.bucket:
+            waits.append(self.bucket.reserve(amount))
+        if self.host_rate:
+            waits.append(self._host_bucket(host).reserve(amount))
+        return max(waits)
+
+    def throughput(self, host=None):
+        """ Return the bytes a second read from host, or from all hosts,
+        between the first and the last read """
+        with self.lock:
+            counts = [self.counts[host]] if host in self.counts else \
+                list(self.counts.values()) if host is None else []
+        if not counts:
+            return 0.0
+        elapsed = max(count[2] for count in counts) - \
+            min(count[1] for count in counts)
+        total = sum(count[0] for count in counts)
+        return total / elapsed if elapsed > 0 else 0.0
+
+    def hosts(self):
+        """ Return the hosts we have read from """
+        with self.lock:
+            return sorted(self.counts)
@@ -6,13 +6,38 @@ import sqlite3
 import sys
 import logging
 import time
+import pyres.dates as dates
 import pyres.episode as mod_episode
 import pyres.utils as utils
 
+CURRENT_VERSION = 9
+
+# episodes we have given up trying to download
+FAILED_STATE = 3
+
+# the columns of the episodes table filled in when an episode is added
+_EPISODE_COLUMNS = "(podcast_id, date, title, file, url, size, state)"
+
+# pragmas applied when the database is opened.  'default' leaves sqlite alone.
+# 'fast' uses a write ahead log, which lets readers and the writer work at the
+# same time and makes each commit far cheaper, and gives sqlite a bigger page
+# cache and a memory mapped view of the file.
+PROFILES = {
+    'default': [],
+    'fast': [
+        ('journal_mode', 'WAL'),
+        ('synchronous', 'NORMAL'),
+        ('cache_size', -65536),  # negative numbers are KiB, so 64 MiB
+        ('mmap_size', 268435456),
+        ('busy_timeout', 5000),
+    ],
+}
+DEFAULT_PROFILE = 'default'
+
 
 class PodcastDatabase(object):
     """ Class to encapsulate access to database """
-    def __init__(self, file_name):
+    def __init__(self, file_name, profile=DEFAULT_PROFILE):
         if not file_name:
             raise AttributeError()
 
@@ -20,19 +45,27 @@ class PodcastDatabase(object):
         self.connection.text_factory = str
         self.row_factory = sqlite3.Row
         self.cursor = self.connection.cursor()
+        for pragma, value in PROFILES[profile]:
+            self.cursor.execute("PRAGMA %s = %s" % (pragma, value))
         # test to ensure that the main podcasts table exists
         # Create it if not
         try:
-            self.cursor.execute("CREATE TABLE podcasts (name text, "
-                                "url text unique, needsfix bool, "
-                                "throttle int)")
+            self._create_podcasts_table('podcasts')
+            self._create_episodes_table()
+            self._create_state_index()
+            self._add_retry_columns()
+            self._add_hash_column()
+            self._add_duration_column()
+            self._add_local_dates_column()
+            # a brand new database is already in the current format
+            self.cursor.execute("PRAGMA user_version = %s" % CURRENT_VERSION)
         except sqlite3.OperationalError:
             pass
         # check to see if we're on the proper database version, if not, update
         try:
             cursor = self.cursor.execute("PRAGMA user_version")
             version = cursor.fetchone()[0]
-            current_version = 1
+            current_version = CURRENT_VERSION
             if version != current_version:
                 print("=================================")
                 print("CONVERTING DATABASE TO NEW FORMAT")
@@ -48,6 +81,10 @@ class PodcastDatabase(object):
     def __enter__(self):
         return self
 
+    def commit(self):
+        """ Make the changes so far permanent """
+        self.connection.commit()
+
     def __exit__(self, exception_type, exception_value, traceback):
         if not exception_type:
             self.connection.commit()
@@ -56,9 +93,69 @@ class PodcastDatabase(object):
         self.cursor.close()
         self.connection.close()
 
+    def _create_podcasts_table(self, table):
+        """ Create the table holding one row for each podcast """
+        self.cursor.execute("CREATE TABLE '%s' (id integer primary key, "
+                            "name text unique, url text unique, "
+                            "needsfix bool, throttle int, etag text, "
+                            "modified text, content_hash text)" % table)
+
+    def _create_episodes_table(self):
+        """ Create the table holding the episodes of every podcast """
+        self.cursor.execute("CREATE TABLE episodes (podcast_id integer, "
+                            "date text, title text, file text, url text, "
+                            "size integer, state integer, "
+                            "UNIQUE (podcast_id, title))")
+        self.cursor.execute("CREATE INDEX episodes_state ON episodes "
+                            "(podcast_id, state)")
+        self.cursor.execute("CREATE INDEX episodes_date ON episodes "
+                            "(podcast_id, date)")
+
+    def _create_state_index(self):
+        """ Create the index used to find episodes in a given state across
+        all podcasts """
+        self.cursor.execute("CREATE INDEX episodes_by_state ON episodes "
+                            "(state, date)")
+
+    def _add_retry_columns(self):
+        """ Add the columns recording failed downloads to the episodes
+        table.  next_attempt is in seconds since the epoch. """
+        for column, column_type in (('attempts', 'integer default 0'),
+                                    ('last_error', 'text'),
+                                    ('next_attempt', 'real')):
+            self.cursor.execute("ALTER TABLE episodes ADD COLUMN %s %s" %
+                                (column, column_type))
+
+    def _add_hash_column(self):
+        """ Add the column holding the hash of each downloaded file, with
+        an index to find files we already have """
+        self.cursor.execute("ALTER TABLE episodes ADD COLUMN hash text")
+        self.cursor.execute("CREATE INDEX episodes_hash ON episodes (hash)")
+
+    def _add_duration_column(self):
+        """ Add the column holding how many seconds each downloaded episode
+        plays for """
+        self.cursor.execute("ALTER TABLE episodes ADD COLUMN duration real")
+
+    def _add_local_dates_column(self):
+        """ Add the column marking podcasts whose episode dates are still
+        the feed's local time, as they were stored before dates were kept
+        in UTC """
+        self.cursor.execute("ALTER TABLE podcasts ADD COLUMN local_dates "
+                            "integer")
+
+    def _podcast_id(self, name):
+        """ Return the id of the named podcast.  Raises OperationalError if
+        there is no such podcast, just as sqlite does for a missing table.
+        """
+        row = self.cursor.execute("SELECT id FROM podcasts WHERE name = ?",
+                                  (name, )).fetchone()
+        if not row:
+            raise sqlite3.OperationalError("no such podcast: %s" % name)
+        return row[0]
+
     def add_podcast(self, name, url, throttle):
-        """Add a new podcast url to the database and set up a table to track
-           episodes.
+        """Add a new podcast url to the database.
         """
         if not name or not url:
             raise AttributeError()
@@ -69,11 +166,9 @@ class PodcastDatabase(object):
             return  # already exists
 
         try:
-            self.cursor.execute("INSERT INTO podcasts VALUES (?, ?, 0, ?)",
+            self.cursor.execute("INSERT INTO podcasts (name, url, needsfix, "
+                                "throttle) VALUES (?, ?, 0, ?)",
                                 (name, url, throttle))
-            self.cursor.execute("CREATE TABLE '%s' (date text, title text unique, "
-                                "file text, url text, size integer, state integer)"
-                                % name)
         except sqlite3.IntegrityError as e:
             print("failed to insert %s:%s" % (name, e))
 
@@ -88,9 +183,11 @@ class PodcastDatabase(object):
                   episode.url)
             return False
 
+        podcast_id = self._podcast_id(table)
         try:
-            self.cursor.execute("INSERT INTO '%s' VALUES (?, ?, ?, ?, ?, ?)"
-                                % table, episode.as_list())
+            self.cursor.execute("INSERT INTO episodes %s VALUES (?, ?, ?, ?, "
+                                "?, ?, ?)" % _EPISODE_COLUMNS,
+                                (podcast_id, ) + episode.as_list())
             logging.debug("Added %s", episode.title)
             return True
         except sqlite3.IntegrityError:
@@ -99,6 +196,33 @@ class PodcastDatabase(object):
             # Would be good to figure out what's going on there
             return True
 
+    def add_new_episodes(self, table, episodes):
+        """Add a batch of episodes to the named podcast in one statement.
+        Episodes which are already present are skipped.  Returns the number
+        of episodes which were actually added.
+        """
+        podcast_id = self._podcast_id(table)
+        rows = list()
+        for episode in episodes:
+            if not episode.date or not episode.title or not episode.url:
+                # not using %s formats for last three in case they are None
+                print("Got a bad episode from %s server, will not add: (date, "
+                      "title, url):" % table, episode.date, episode.title,
+                      episode.url)
+                continue
+            rows.append((podcast_id, ) + episode.as_list())
+        if not rows:
+            return 0
+
+        before = self.connection.total_changes
+        self.cursor.executemany("INSERT OR IGNORE INTO episodes %s VALUES "
+                                "(?, ?, ?, ?, ?, ?, ?)" % _EPISODE_COLUMNS,
+                                rows)
+        added = self.connection.total_changes - before
+        logging.debug("Added %d of %d episodes to %s", added, len(rows),
+                      table)
+        return added
+
     def find_episodes_to_download(self, table):
         """ returns a list of episodes read to download """
         return self.find_episodes(table, 0)
@@ -112,32 +236,121 @@ class PodcastDatabase(object):
         downloaded.
         """
         episodes = list()
-        for row in self.cursor.execute("SELECT * from '%s' where "
-                                       "state = %s" % (table, state)):
+        for row in self.cursor.execute("SELECT date, title, file, url, size, "
+                                       "state FROM episodes WHERE "
+                                       "podcast_id = ? AND state = ?",
+                                       (self._podcast_id(table), state)):
             row_list = list(row)
+            date = dates.parse_database_date(row_list[0])
             episodes.append(
-                mod_episode.Episode(date=utils.string_to_date(row_list[0]),
+                mod_episode.Episode(date=date,
                                     title=row_list[1], podcast=table,
                                     file_name=row_list[2], url=row_list[3],
                                     size=row_list[4], state=row_list[5]))
         return episodes
 
-    def _update_size(self, table, title, size):
-        """ change state of podcast """
-        logging.debug("In update size with %s %s %d", table, title, size)
-        self.cursor.execute("UPDATE '%s' SET size=? where title = ?" % table,
-                            (size, title))
+    def iter_episodes(self, state, order_by='date', ready_at=None,
+                      podcast=None):
+        """Yield each episode in the given state across all podcasts from a
+        single query.  The episodes are built as they are read, so memory use
+        does not grow with the number of episodes.  order_by is 'date' for
+        oldest first or 'podcast' to group the episodes by podcast name.  If
+        ready_at is given, episodes which failed to download and should not
+        be tried again until after that time are left out.  If podcast is
+        given only the episodes of the podcast with that name are returned.
+        """
+        order = {
+            'date': 'episodes.date',
+            'podcast': 'podcasts.name, episodes.date',
+        }[order_by]
+        where = "episodes.state = ?"
+        params = (state, )
+        if ready_at is not None:
+            where += " AND (next_attempt IS NULL OR next_attempt <= ?)"
+            params += (ready_at, )
+        if podcast is not None:
+            where += " AND podcasts.name = ?"
+            params += (podcast, )
+        # use a cursor of our own so the caller can keep using the database
+        # while we walk the results
+        cursor = self.connection.cursor()
+        try:
+            for row in cursor.execute("SELECT episodes.date, episodes.title, "
+                                      "podcasts.name, episodes.file, "
+                                      "episodes.url, episodes.size, "
+                                      "episodes.state, episodes.attempts, "
+                                      "episodes.hash, episodes.duration "
+                                      "FROM episodes JOIN podcasts ON "
+                                      "podcasts.id = episodes.podcast_id "
+                                      "WHERE %s ORDER BY %s" %
+                                      (where, order), params):
+                yield mod_episode.Episode(
+                    date=dates.parse_database_date(row[0]), title=row[1],
+                    podcast=row[2], file_name=row[3], url=row[4],
+                    size=row[5], state=row[6], attempts=row[7] or 0,
+                    hash=row[8], duration=row[9])
+        finally:
+            cursor.close()
+
+    def count_episodes(self, state):
+        """Return a list of (podcast name, count) tuples giving the number of
+        episodes in the given state for each podcast that has any.
+        """
+        return list(self.cursor.execute("SELECT podcasts.name, COUNT(*) FROM "
+                                        "episodes JOIN podcasts ON "
+                                        "podcasts.id = episodes.podcast_id "
+                                        "WHERE episodes.state = ? GROUP BY "
+                                        "podcasts.name ORDER BY "
+                                        "podcasts.name", (state, )))
 
     def _update_state(self, table, title, state):
         """ change state of podcast """
-        self.cursor.execute("UPDATE '%s' SET state=? where title = ?" % table,
-                            (state, title))
+        self.cursor.execute("UPDATE episodes SET state=? WHERE podcast_id = ? "
+                            "AND title = ?",
+                            (state, self._podcast_id(table), title))
 
     def mark_episode_downloaded(self, episode):
         """ update state to downloaded and update size """
         logging.debug("in mark with %s %s", episode.podcast, episode.title)
-        self._update_state(episode.podcast, episode.title, 1)
-        self._update_size(episode.podcast, episode.title, episode.size)
+        # one statement, as this runs for every finished download
+        self.cursor.execute("UPDATE episodes SET state = 1, size = ?, "
+                            "attempts = 0, last_error = NULL, next_attempt = "
+                            "NULL, hash = ?, duration = ? WHERE podcast_id = "
+                            "? AND title = ?",
+                            (episode.size, episode.hash, episode.duration,
+                             self._podcast_id(episode.podcast),
+                             episode.title))
+
+    def set_episode_duration(self, episode, duration):
+        """ Record how many seconds the episode plays for """
+        self.cursor.execute("UPDATE episodes SET duration = ? WHERE "
+                            "podcast_id = ? AND title = ?",
+                            (duration, self._podcast_id(episode.podcast),
+                             episode.title))
+
+    def find_files_with_hash(self, episode):
+        """ Return the files of the other downloaded episodes whose contents
+        have the same hash as episode """
+        if not episode.hash:
+            return []
+        return [row[0] for row in self.cursor.execute(
+            "SELECT file FROM episodes WHERE hash = ? AND state IN (1, 2) "
+            "AND NOT (podcast_id = ? AND title = ?)",
+            (episode.hash, self._podcast_id(episode.podcast),
+             episode.title))]
+
+    def mark_episode_failed(self, episode, next_attempt):
+        """ Record a failed download of the episode.  It will not be tried
+        again until after next_attempt, or ever if next_attempt is None. """
+        logging.debug("in failed with %s %s", episode.podcast, episode.title)
+        self.cursor.execute("UPDATE episodes SET attempts = ?, last_error = "
+                            "?, next_attempt = ? WHERE podcast_id = ? AND "
+                            "title = ?",
+                            (episode.attempts, episode.error_class,
+                             next_attempt, self._podcast_id(episode.podcast),
+                             episode.title))
+        if next_attempt is None:
+            self._update_state(episode.podcast, episode.title, FAILED_STATE)
 
     def mark_episode_on_mp3_player(self, episode):
         """ update state to downloaded and update size """
@@ -145,37 +358,89 @@ class PodcastDatabase(object):
         self._update_state(episode.podcast, episode.title, 2)
 
     def delete_podcast(self, name):
-        """Delete a podcast from the main table.  Also drops the episode table
-           for this podcast.
+        """Delete a podcast from the main table.  Also deletes the episodes
+           of this podcast.
         """
-        self.cursor.execute("DELETE FROM podcasts WHERE name='%s'" % name)
-        self.cursor.execute("DROP TABLE '%s'" % name)
+        podcast_id = self._podcast_id(name)
+        self.cursor.execute("DELETE FROM episodes WHERE podcast_id = ?",
+                            (podcast_id, ))
+        self.cursor.execute("DELETE FROM podcasts WHERE id = ?",
+                            (podcast_id, ))
 
     def get_podcast_urls(self):
-        """Return a list of urls.  Goes through the table list and produces a
-        list of [name, url] tuples.  Walks this list and produces a list of
-        [url, latest_date] tuples from the podcast tables specified by names.
-        I suspect someone better at SQL than I could get this in a single
-        query, but this will work quickly enough for the small data sets I'm
-        expecting.
+        """Return a list of [url, throttle, latest_date, latest_title]
+        lists, one for each podcast.  latest_date and latest_title are the
+        date and title of the newest episode we have for that podcast, the
+        title is None if there are no episodes.  The newest episode for each
+        podcast comes straight off the (podcast_id, date) index, so this is a
+        single query no matter how many podcasts or episodes there are.
+        If the dates of a podcast are still in the feed's local time the
+        latest date is moved back by the largest zone offset, and no title
+        is given, so no new episode is missed until they are put right.
         """
-        urls = list()
         tuples = list()
-        urls = list(self.cursor.execute('SELECT url,name,throttle FROM '
-                                        'podcasts ORDER BY name'))
-        for _tuple in urls:
-            url = _tuple[0]
-            name = _tuple[1]
-            throttle = _tuple[2]
-            dates = list(self.cursor.execute("Select date from '%s' ORDER BY "
-                                             "date DESC" % name))
-            if len(dates):
-                latest_date = utils.string_to_date(dates[0][0])
-            else:
+        for row in self.cursor.execute("SELECT podcasts.url, "
+                                       "podcasts.throttle, episodes.date, "
+                                       "episodes.title, podcasts.local_dates "
+                                       "FROM podcasts LEFT JOIN episodes ON "
+                                       "episodes.rowid = (SELECT rowid FROM "
+                                       "episodes WHERE podcast_id = "
+                                       "podcasts.id ORDER BY date DESC "
+                                       "LIMIT 1) ORDER BY name"):
+            (url, throttle, latest_date, latest_title, local_dates) = row
+            if not latest_date:
                 latest_date = time.gmtime()
-            tuples.append([url, throttle, latest_date])
+            elif local_dates:
+                latest_date = dates.earlier(
+                    dates.parse_database_date(latest_date),
+                    dates.MAX_ZONE_OFFSET)
+                latest_title = None
+            else:
+                latest_date = dates.parse_database_date(latest_date)
+            tuples.append([url, throttle, latest_date, latest_title])
         return tuples
 
+    def rebase_local_dates(self, name, episodes):
+        """ If the named podcast's episode dates are still the feed's local
+        time, give each stored episode found in episodes, which have just
+        been read from the feed, its UTC date.  Returns the episodes which
+        are not already stored. """
+        podcast_id = self._podcast_id(name)
+        (local_dates, ) = self.cursor.execute("SELECT local_dates FROM "
+                                              "podcasts WHERE id = ?",
+                                              (podcast_id, )).fetchone()
+        if not local_dates:
+            return episodes
+        new_episodes = list()
+        for episode in episodes:
+            self.cursor.execute("UPDATE episodes SET date = ? WHERE "
+                                "podcast_id = ? AND title = ?",
+                                (utils.date_as_string(episode.date),
+                                 podcast_id, episode.title))
+            if not self.cursor.rowcount:
+                new_episodes.append(episode)
+        self.cursor.execute("UPDATE podcasts SET local_dates = NULL WHERE "
+                            "id = ?", (podcast_id, ))
+        return new_episodes
+
+    def get_feed_validators(self):
+        """Return a dict mapping the url of each podcast to the (etag,
+        modified, content_hash) tuple saved from its last refresh.  Podcasts
+        without saved validators are left out.
+        """
+        validators = dict()
+        for row in self.cursor.execute('SELECT url, etag, modified, '
+                                       'content_hash FROM podcasts'):
+            if row[1] or row[2] or row[3]:
+                validators[row[0]] = (row[1], row[2], row[3])
+        return validators
+
+    def update_feed_validators(self, url, validators):
+        """ Save the (etag, modified, content_hash) tuple for a podcast. """
+        self.cursor.execute("UPDATE podcasts SET etag=?, modified=?, "
+                            "content_hash=? where url = ?",
+                            tuple(validators) + (url, ))
+
     def get_podcast_names(self):
         """Return a list of podcasts
         """
@@ -186,16 +451,30 @@ class PodcastDatabase(object):
         return names
 
     def convert_to_new_version(self, old_version, current_version):
-        """ Do an automatic database conversion. """
-        if old_version != 0:
+        """ Do an automatic database conversion.  Each version is converted
+        to the next until we reach the current one. """
+        if old_version not in (0, 1, 2, 3, 4, 5, 6, 7, 8):
             print("Unrecognized old version in database conversion",
                   old_version)
             sys.exit()
-        if current_version != 1:
+        elif current_version != CURRENT_VERSION:
             print("Unrecognized current version in database conversion",
                   current_version)
             sys.exit()
+        else:
+            # the conversion to each version in turn
+            conversions = [
+                self._convert_to_version_1, self._convert_to_version_2,
+                self._convert_to_version_3, self._convert_to_version_4,
+                self._convert_to_version_5, self._convert_to_version_6,
+                self._convert_to_version_7,
+                lambda: self._convert_to_version_8(old_version < 3),
+                self._convert_to_version_9]
+            for conversion in conversions[old_version:]:
+                conversion()
 
+    def _convert_to_version_1(self):
+        """ Version 1 added the throttle column to the podcasts table. """
         # now set it to maxsize for each podcast
         urls = list(self.cursor.execute('SELECT * FROM podcasts ORDER BY '
                                         'name'))
@@ -206,6 +485,69 @@ class PodcastDatabase(object):
             self.cursor.execute("INSERT INTO podcasts VALUES (?, ?, 0, ?)",
                                 (_tuple[0], _tuple[1], sys.maxsize))
 
+    def _convert_to_version_2(self):
+        """ Version 2 added the feed cache validators to the podcasts table.
+        """
+        for column in ('etag', 'modified', 'content_hash'):
+            self.cursor.execute("ALTER TABLE podcasts ADD COLUMN %s text" %
+                                column)
+
+    def _convert_to_version_3(self):
+        """ Version 3 moved the episodes of every podcast from a table per
+        podcast into the single episodes table and gave each podcast an id.
+        """
+        self._create_podcasts_table('podcasts_new')
+        self.cursor.execute("INSERT INTO podcasts_new (name, url, needsfix, "
+                            "throttle, etag, modified, content_hash) SELECT "
+                            "name, url, needsfix, throttle, etag, modified, "
+                            "content_hash FROM podcasts ORDER BY name")
+        self.cursor.execute("DROP TABLE podcasts")
+        self.cursor.execute("ALTER TABLE podcasts_new RENAME TO podcasts")
+        self._create_episodes_table()
+
+        podcasts = list(self.cursor.execute("SELECT id, name FROM podcasts"))
+        for (podcast_id, name) in podcasts:
+            try:
+                self.cursor.execute("INSERT OR IGNORE INTO episodes %s SELECT "
+                                    "?, date, title, file, url, size, state "
+                                    "FROM '%s'" % (_EPISODE_COLUMNS, name),
+                                    (podcast_id, ))
+                self.cursor.execute("DROP TABLE '%s'" % name)
+            except sqlite3.OperationalError as e:
+                print("failed to convert episodes of %s:%s" % (name, e))
+
+    def _convert_to_version_4(self):
+        """ Version 4 added an index on state for queries across all
+        podcasts. """
+        self._create_state_index()
+
+    def _convert_to_version_5(self):
+        """ Version 5 added the columns recording failed downloads. """
+        self._add_retry_columns()
+
+    def _convert_to_version_6(self):
+        """ Version 6 added the hash of each downloaded file. """
+        self._add_hash_column()
+
+    def _convert_to_version_7(self):
+        """ Version 7 added the duration of each downloaded episode. """
+        self._add_duration_column()
+
+    def _convert_to_version_8(self, local_dates):
+        """ Version 8 marked the podcasts whose episode dates are the
+        feed's local time.  Dates have been kept in UTC since version 3, so
+        only podcasts from older databases are marked. """
+        self._add_local_dates_column()
+        if local_dates:
+            self.cursor.execute("UPDATE podcasts SET local_dates = 1 WHERE "
+                                "id IN (SELECT podcast_id FROM episodes)")
+
+    def _convert_to_version_9(self):
+        """ Version 9 threw away the durations found before the MP3 parser
+        checked for a second frame, as files which are not MP3 were given
+        one.  The durations command finds them again. """
+        self.cursor.execute("UPDATE episodes SET duration = NULL")
+
     def show_all_episodes(self):
         """Display information from database.
         """
@@ -213,7 +555,10 @@ class PodcastDatabase(object):
 
         for name in names:
             print(name)
-            for row in self.cursor.execute("SELECT * FROM '%s'" % name):
+            for row in self.cursor.execute("SELECT date, title, file, url, "
+                                           "size, state FROM episodes WHERE "
+                                           "podcast_id = ?",
+                                           (self._podcast_id(name), )):
                 row_list = list(row)
                 print(row_list[0], row_list[1], row_list[5],)
                 if row_list[3]:
@@ -222,7 +567,9 @@ class PodcastDatabase(object):
 
     def show_podcasts(self):
         """ show entries in the podcasts table """
-        urls = list(self.cursor.execute('SELECT * FROM podcasts ORDER BY '
+        urls = list(self.cursor.execute('SELECT name, url, needsfix, '
+                                        'throttle, etag, modified, '
+                                        'content_hash FROM podcasts ORDER BY '
                                         'name'))
 
         for _tuple in urls:
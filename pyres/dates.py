@@ -0,0 +1,128 @@
+"""
+Date parsing for feed and database dates.
+
+Feeds give us RFC 822 dates ('Wed, 20 May 2015 04:47:53 +0000') or ISO 8601
+dates ('2015-08-23T17:38:36-04:00').  Both are converted to a UTC
+time.struct_time.  The database stores dates as '2015/05/20:04:47:53'.
+
+The same date strings show up over and over (every row of the database and
+every item of every feed on each update) so the results are remembered in a
+small cache.
+"""
+import calendar
+import re
+import time
+
+# maximum number of dates each parser remembers
+CACHE_SIZE = 4096
+# the furthest any zone is from UTC, in seconds
+MAX_ZONE_OFFSET = 14 * 60 * 60
+
+_MONTHS = {
+    'jan': 1, 'feb': 2, 'mar': 3, 'apr': 4, 'may': 5, 'jun': 6,
+    'jul': 7, 'aug': 8, 'sep': 9, 'oct': 10, 'nov': 11, 'dec': 12,
+}
+
+# offsets from UTC in minutes for the named zones allowed by RFC 822
+_ZONES = {
+    'UT': 0, 'UTC': 0, 'GMT': 0, 'Z': 0,
+    'EST': -300, 'EDT': -240, 'CST': -360, 'CDT': -300,
+    'MST': -420, 'MDT': -360, 'PST': -480, 'PDT': -420,
+}
+
+_RFC822 = re.compile(r'^\s*(?:[A-Za-z]+,?\s*)?(\d{1,2})\s+([A-Za-z]{3})'
+                     r'[A-Za-z]*\.?\s+(\d{2,4})\s+(\d{1,2}):(\d{2})'
+                     r'(?::(\d{2}))?\s*([A-Za-z]+|[+-]\d{2}:?\d{2})?\s*$')
+_ISO8601 = re.compile(r'^\s*(\d{4})-(\d{2})-(\d{2})'
+                      r'(?:[T ](\d{2}):(\d{2})(?::(\d{2})(?:\.\d+)?)?)?'
+                      r'\s*(Z|[+-]\d{2}:?\d{2})?\s*$')
+_DATABASE = re.compile(r'^(\d{4})/(\d{1,2})/(\d{1,2}):(\d{1,2}):(\d{1,2}):'
+                       r'(\d{1,2})$')
+
+
+def _memoize(function):
+    """ Remember the results of a single argument parse function.  The cache
+    is emptied when it fills up, which keeps it bounded without the
+    bookkeeping of a real LRU. """
+    cache = dict()
+
+    def wrapper(value):
+        """ Look the value up before parsing it """
+        try:
+            return cache[value]
+        except KeyError:
+            pass
+        result = function(value)
+        if len(cache) >= CACHE_SIZE:
+            cache.clear()
+        cache[value] = result
+        return result
+    wrapper.__doc__ = function.__doc__
+    wrapper.cache = cache
+    return wrapper
+
+
+def _zone_offset(zone):
+    """ Return the offset in minutes from UTC for a zone string.  Unknown
+    zone names are treated as UTC. """
+    if not zone:
+        return 0
+    if zone[0] in '+-':
+        digits = zone[1:].replace(':', '')
+        minutes = int(digits[:2]) * 60 + int(digits[2:])
+        return -minutes if zone[0] == '-' else minutes
+    return _ZONES.get(zone.upper(), 0)
+
+
+def _make_date(fields, offset=0):
+    """ Build a struct_time from (year, month, day, hour, minute, second) in
+    a zone offset minutes from UTC.  isdst is left as -1 to match what
+    time.strptime gives us. """
+    (_, month, day, hour, minute, second) = fields
+    if not (1 <= month <= 12 and 1 <= day <= 31 and hour < 24 and
+            minute < 60 and second < 62):
+        raise ValueError("Date out of range %r" % (tuple(fields), ))
+    seconds = calendar.timegm(tuple(fields) + (0, 0, 0)) - offset * 60
+    return time.struct_time(time.gmtime(seconds)[:8] + (-1, ))
+
+
+def earlier(date, seconds):
+    """ Return the struct_time seconds before the UTC struct_time date """
+    return time.struct_time(time.gmtime(calendar.timegm(date) - seconds)[:8] +
+                            (-1, ))
+
+
+@_memoize
+def parse_feed_date(date_string):
+    """ Convert an RFC 822 or ISO 8601 date from a feed to a UTC
+    struct_time.  Raises ValueError for anything else. """
+    match = _RFC822.match(date_string)
+    if match:
+        (day, month, year, hour, minute, second, zone) = match.groups()
+        try:
+            month = _MONTHS[month.lower()]
+        except KeyError:
+            raise ValueError("Unrecognized month in date %r" % date_string)
+        year = int(year)
+        if year < 100:
+            year += 2000 if year < 50 else 1900
+        return _make_date((year, month, int(day), int(hour), int(minute),
+                           int(second or 0)), _zone_offset(zone))
+
+    match = _ISO8601.match(date_string)
+    if match:
+        (year, month, day, hour, minute, second, zone) = match.groups()
+        return _make_date((int(year), int(month), int(day), int(hour or 0),
+                           int(minute or 0), int(second or 0)),
+                          _zone_offset(zone))
+
+    raise ValueError("Unrecognized date %r" % date_string)
+
+
+@_memoize
+def parse_database_date(date_string):
+    """ Convert a date as stored in the database to a struct_time. """
+    match = _DATABASE.match(date_string)
+    if not match:
+        raise ValueError("Unrecognized database date %r" % date_string)
+    return _make_date([int(field) for field in match.groups()])
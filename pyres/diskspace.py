@@ -0,0 +1,69 @@
+"""
+Keep downloads from filling the disk.
+
+Before a download starts we check that the filesystem it writes to has room
+for the rest of the file and still leaves a reserve free.  Space promised to
+downloads which are still running is counted as used until they finish, so
+several large episodes cannot all be started into the same free space.
+Episodes which do not fit are deferred to a later run rather than failed.
+"""
+import os
+import shutil
+import threading
+
+# bytes to leave free on the disk
+DEFAULT_RESERVE = 256 * 1024 * 1024
+
+
+def existing_directory(path):
+    """ Return the nearest directory holding path which exists """
+    directory = os.path.dirname(os.path.abspath(path))
+    while not os.path.isdir(directory):
+        parent = os.path.dirname(directory)
+        if parent == directory:
+            break
+        directory = parent
+    return directory
+
+
+def free_space(directory):
+    """ Return the bytes free to us on the filesystem holding directory """
+    if hasattr(shutil, 'disk_usage'):
+        return shutil.disk_usage(directory).free
+    # python 2 has no disk_usage
+    stats = os.statvfs(directory)  # pylint: disable=no-member
+    return stats.f_bavail * stats.f_frsize
+
+
+########################################################################
+class DiskSpace(object):
+    """ The free space shared by all downloads.  reserve bytes are always
+    left free on each filesystem. """
+
+    # ----------------------------------------------------------------------
+    def __init__(self, reserve=DEFAULT_RESERVE, free=free_space):
+        self.reserve = reserve
+        self.free = free
+        # id(episode): (device, bytes) for each running download
+        self.claims = dict()
+        self.lock = threading.Lock()
+
+    def claim(self, episode, needed):
+        """ Promise needed bytes to episode if they fit on its disk.  Any
+        earlier claim for episode is replaced.  Returns False if there is
+        not room for them. """
+        directory = existing_directory(episode.file_name)
+        device = os.stat(directory).st_dev
+        with self.lock:
+            self.claims.pop(id(episode), None)
+            promised = sum(size for (claim_device, size)
+                           in self.claims.values() if claim_device == device)
+            if self.free(directory) - promised - needed < self.reserve:
+                return False
+            self.claims[id(episode)] = (device, needed)
+            return True
+
+    def release(self, episode):
+        """ Give back the space promised to episode """
+        with self.lock:
+            self.claims.pop(id(episode), None)
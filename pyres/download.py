@@ -2,13 +2,388 @@
 Manage downloading episodes to filesystem.
 """
 from __future__ import print_function
-from six.moves.urllib_request import urlopen
-from six.moves.urllib_error import URLError
 from six.moves import queue
+from six.moves.urllib.parse import urlsplit
+import hashlib
+import heapq
+import itertools
+import json
+import logging
 import time
 import os
+import re
 import requests
 import threading
+import pyres.httpclient as httpclient
+import pyres.mp3 as mp3
+import pyres.retry as retry
+import pyres.utils as utils
+from pyres.bandwidth import Bandwidth
+from pyres.diskspace import DiskSpace
+
+# number of episodes downloaded at once by default
+DEFAULT_THREADS = 3
+# number of episodes the asyncio engine downloads at once by default.  It is
+# kept here as that engine can only be imported on python 3
+DEFAULT_CONCURRENCY = 10
+# bytes asked for in each read from the network by default
+DEFAULT_READ_SIZE = 64 * 1024
+# progress is reported at most this often, in seconds...
+PROGRESS_INTERVAL = 0.5
+# ...unless this many bytes have arrived since the last report
+PROGRESS_BYTES = 4 * 1024 * 1024
+
+# files at least this big may be fetched in segments, when segments are on
+DEFAULT_SEGMENT_SIZE = 100 * 1024 * 1024
+# seconds the supervisor waits for an event before checking on the workers
+EVENT_TIMEOUT = 5
+# episodes which may be waiting or running before adding another one waits
+DEFAULT_PENDING = 20
+
+# events sent from the downloads to the supervisor
+PROGRESS = 'progress'
+COMPLETED = 'completed'
+FAILED = 'failed'
+# episodes are written here until they are complete
+PART_SUFFIX = ".part"
+# the validators needed to resume a .part file are kept here
+STATE_SUFFIX = ".json"
+
+# when downloads are forced to disk: never, once the file is complete, or
+# also every FSYNC_BYTES while it is written
+FSYNC_NEVER = 'never'
+FSYNC_FINISH = 'finish'
+FSYNC_PERIODIC = 'periodic'
+FSYNC_POLICIES = (FSYNC_NEVER, FSYNC_FINISH, FSYNC_PERIODIC)
+DEFAULT_FSYNC = FSYNC_FINISH
+FSYNC_BYTES = 16 * 1024 * 1024
+
+_CONTENT_RANGE = re.compile(r'^bytes\s+(\d+)-\d+/(\d+|\*)$')
+
+
+########################################################################
+class ProgressLimiter(object):
+    """ Decides when a download has made enough progress to be worth
+    reporting, so a large file does not send an event for every read """
+
+    # ----------------------------------------------------------------------
+    def __init__(self, interval=PROGRESS_INTERVAL, step=PROGRESS_BYTES):
+        self.interval = interval
+        self.step = step
+        self.last_time = time.time()
+        self.last_size = 0
+
+    def ready(self, size):
+        """ Return True if the download has reached size and a progress
+        event is due """
+        now = time.time()
+        if size - self.last_size >= self.step or \
+                now - self.last_time >= self.interval:
+            self.last_time = now
+            self.last_size = size
+            return True
+        return False
+
+
+########################################################################
+class PartialDownload(object):
+    """ The .part file an episode is downloaded into.  If an earlier download
+    was interrupted the part file is resumed with a Range request, provided
+    the server gave us an ETag or Last-Modified to check that the file has
+    not changed since.  The finished file is renamed over the episode file,
+    so the episode file is either missing or complete. """
+
+    # ----------------------------------------------------------------------
+    def __init__(self, episode, fsync=DEFAULT_FSYNC):
+        self.episode = episode
+        self.fsync = fsync
+        self.part_name = episode.file_name + PART_SUFFIX
+        self.state_name = self.part_name + STATE_SUFFIX
+        self.offset = 0
+        self.validator = None
+        self.state = dict()
+        state = self._load_state()
+        if state.get('url') == episode.url and \
+                os.path.isfile(self.part_name):
+            self.validator = state.get('etag') or state.get('last_modified')
+            if self.validator:
+                self.offset = os.path.getsize(self.part_name)
+                # a preallocated file is only good up to what we know was
+                # written to it
+                if state.get('written') is not None:
+                    self.offset = min(self.offset, state['written'])
+
+    def _load_state(self):
+        """ Read the saved validators, if any """
+        try:
+            with open(self.state_name) as state_file:
+                return json.load(state_file)
+        except (IOError, OSError, ValueError):
+            return dict()
+
+    def request_headers(self):
+        """ The headers asking the server for the rest of the file """
+        if not self.offset:
+            return dict()
+        # If-Range gets us the whole file if it has changed on the server
+        return {'Range': 'bytes=%d-' % self.offset,
+                'If-Range': self.validator}
+
+    def discard(self):
+        """ Throw away the partial download and start from scratch """
+        for file_name in (self.part_name, self.state_name):
+            if os.path.exists(file_name):
+                os.remove(file_name)
+        self.offset = 0
+        self.validator = None
+
+    def save_state(self, written=None):
+        """ Record what we need to resume the part file.  written is the
+        number of bytes known to be in a preallocated part file. """
+        self.state['written'] = written
+        with open(self.state_name, "w") as state_file:
+            json.dump(self.state, state_file)
+
+    def open(self, status, headers):
+        """ Check the response to our request and open the part file to write
+        the body to.  Sets the episode size to the size of the whole file.
+        headers must accept lower case names. """
+        match = _CONTENT_RANGE.match(headers.get('content-range') or '')
+        if status == 206 and self.offset and match and \
+                int(match.group(1)) == self.offset:
+            # not append mode, which would write after the preallocation
+            mode = "r+b"
+            size = match.group(2)
+        else:
+            # the server sent the whole file
+            self.offset = 0
+            mode = "wb"
+            size = headers.get('content-length')
+        # a size of 0 shows as unknown until the download finishes
+        self.episode.size = int(size) if size and size != '*' else 0
+        self.state = {'url': self.episode.url,
+                      'etag': headers.get('etag'),
+                      'last_modified': headers.get('last-modified')}
+
+        part_file = open(self.part_name, mode)
+        try:
+            part_file.truncate(self.offset)
+            self.save_state()
+            the_file = PartFile(self, part_file)
+            part_file.seek(self.offset)
+            return the_file
+        except (IOError, OSError):
+            part_file.close()
+            raise
+
+    def finish(self):
+        """ Move the completed part file into place """
+        if self.fsync != FSYNC_NEVER:
+            utils.sync_file(self.part_name)
+        utils.replace_file(self.part_name, self.episode.file_name)
+        if self.fsync != FSYNC_NEVER:
+            # make the rename itself survive a crash
+            utils.sync_directory(os.path.dirname(
+                os.path.abspath(self.episode.file_name)))
+        if os.path.exists(self.state_name):
+            os.remove(self.state_name)
+
+
+########################################################################
+class ContentDigest(object):
+    """ What we learn from the content of a file as it goes by: its hash,
+    and how long it plays if it is an MP3 file """
+
+    # ----------------------------------------------------------------------
+    def __init__(self):
+        self.hash = hashlib.sha256()
+        self.parser = mp3.DurationParser()
+
+    def update(self, block):
+        """ Take the next block of the file """
+        self.hash.update(block)
+        self.parser.update(block)
+
+    def record(self, episode):
+        """ Store the hash and duration of the file on the episode """
+        episode.hash = self.hash.hexdigest()
+        episode.duration = self.parser.duration()
+
+
+########################################################################
+class PartFile(object):
+    """ A part file open for writing.  The rest of the file is preallocated
+    where the system allows, so it is laid out in one piece on the disk and
+    its size is not changed by every write.  What has been written is
+    counted so a preallocated file can be resumed; on close the file is cut
+    back to what was written.  The content is digested as it is written. """
+
+    # ----------------------------------------------------------------------
+    def __init__(self, partial, part_file):
+        self.partial = partial
+        self.part_file = part_file
+        self.written = partial.offset
+        self.synced = partial.offset
+        self.preallocated = False
+        self.digest = ContentDigest()
+        if partial.offset:
+            # the digest has to start with what an earlier attempt wrote
+            part_file.seek(0)
+            utils.hash_file_object(part_file, self.digest, partial.offset)
+        if partial.episode.size > partial.offset and \
+                utils.preallocate(part_file, partial.episode.size):
+            self.preallocated = True
+            # until the file is closed only what was synced can be trusted
+            partial.save_state(self.synced)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def write(self, block):
+        """ Write the next block of the file """
+        self.part_file.write(block)
+        self.digest.update(block)
+        self.written += len(block)
+        if self.partial.fsync == FSYNC_PERIODIC and \
+                self.written - self.synced >= FSYNC_BYTES:
+            self.sync()
+
+    def sync(self):
+        """ Force what has been written out to the disk """
+        self.part_file.flush()
+        os.fsync(self.part_file.fileno())
+        self.synced = self.written
+        if self.preallocated:
+            self.partial.save_state(self.synced)
+
+    def close(self):
+        """ Close the file, dropping any space preallocated but not used """
+        try:
+            if self.preallocated:
+                self.part_file.truncate(self.written)
+        finally:
+            self.part_file.close()
+        if self.preallocated:
+            self.partial.save_state()
+
+
+def bytes_to_come(episode, partial, headers=None):
+    """ Return the bytes still to be written for episode, from the response
+    headers if they say, otherwise from the size we already know """
+    length = (headers or dict()).get('content-length') or ''
+    if length.isdigit():
+        return int(length)
+    return max(0, (episode.size or 0) - partial.offset)
+
+
+def split_ranges(size, count):
+    """ Split size bytes into count (first, last) byte ranges """
+    step = max(1, -(-size // count))
+    return [(start, min(start + step, size) - 1)
+            for start in range(0, size, step)]
+
+
+########################################################################
+class SegmentedDownload(object):
+    """ Download one large file as several Range requests at once.  Each
+    segment is written at its own offset of a part file the full size of the
+    episode.  The first segment is read from the response which told us the
+    file was big enough to split. """
+
+    # ----------------------------------------------------------------------
+    def __init__(self, downloader, episode, part_name, validator, segments):
+        self.downloader = downloader
+        self.episode = episode
+        self.part_name = part_name
+        self.validator = validator
+        self.ranges = split_ranges(episode.size, segments)
+        self.lock = threading.Lock()
+        self.total = 0
+        self.progress = ProgressLimiter()
+        # (message, error class) for each segment which failed
+        self.errors = list()
+
+    def run(self, response):
+        """ Download every segment.  Returns (message, error class) for the
+        first segment to fail, or None if the whole file arrived. """
+        try:
+            with open(self.part_name, "wb") as part_file:
+                utils.preallocate(part_file, self.episode.size)
+                part_file.truncate(self.episode.size)
+        except (IOError, OSError) as err:
+            response.close()
+            return err, retry.classify_io_error(err)
+
+        helpers = [threading.Thread(target=self._fetch, args=byte_range)
+                   for byte_range in self.ranges[1:]]
+        for helper in helpers:
+            helper.start()
+        try:
+            self._fetch(self.ranges[0][0], self.ranges[0][1], response)
+        finally:
+            for helper in helpers:
+                helper.join()
+        return self.errors[0] if self.errors else None
+
+    def _fetch(self, first, last, response=None):
+        """ Download bytes first to last, asking for them with a Range
+        request unless we are given the response to read """
+        try:
+            if response is None:
+                response = httpclient.get(
+                    self.episode.url, stream=True,
+                    headers={'Range': 'bytes=%d-%d' % (first, last),
+                             'If-Range': self.validator})
+                match = _CONTENT_RANGE.match(
+                    response.headers.get('content-range') or '')
+                if response.status_code != 206 or not match or \
+                        int(match.group(1)) != first:
+                    # an error, or the file changed since the first request
+                    status = response.status_code
+                    self.errors.append(("HTTP STATUS: %s" % status,
+                                        retry.classify_status(status)
+                                        if status >= 400 else retry.NETWORK))
+                    return
+            self._write(response, first, last)
+        except requests.exceptions.RequestException as err:
+            self.errors.append((err, retry.classify_exception(err)))
+        except (IOError, OSError) as err:
+            self.errors.append((err, retry.classify_io_error(err)))
+        finally:
+            if response is not None:
+                response.close()
+
+    def _write(self, response, first, last):
+        """ Write the body of response into the part file from first up to
+        and including last """
+        stop_event = self.downloader.stop_event
+        host = urlsplit(response.url).hostname
+        position = first
+        with open(self.part_name, "r+b") as part_file:
+            part_file.seek(first)
+            for block in response.iter_content(self.downloader.read_size):
+                if not block or self.errors or stop_event.is_set():
+                    break
+                block = block[:last + 1 - position]
+                part_file.write(block)
+                position += len(block)
+                with self.lock:
+                    self.total += len(block)
+                    total = self.total
+                    due = self.progress.ready(total)
+                if due:
+                    self.downloader.send_event(PROGRESS, total, self.episode)
+                wait = self.downloader.bandwidth.reserve(host, len(block))
+                if wait:
+                    stop_event.wait(wait)
+                if position > last:
+                    break
+        if position <= last and not self.errors and not stop_event.is_set():
+            self.errors.append(("incomplete: bytes %d-%d" % (position, last),
+                                retry.NETWORK))
 
 
 ########################################################################
@@ -16,63 +391,195 @@ class Downloader(threading.Thread):
     """Threaded File Downloader"""
 
     # ----------------------------------------------------------------------
-    def __init__(self, task_id, in_queue, out_queue):
+    # pylint: disable=too-many-arguments
+    def __init__(self, task_id, in_queue, out_queue,
+                 read_size=DEFAULT_READ_SIZE, stop_event=None,
+                 bandwidth=None, segments=1,
+                 segment_size=DEFAULT_SEGMENT_SIZE, disk=None,
+                 fsync=DEFAULT_FSYNC):
         threading.Thread.__init__(self)
         self.queue = in_queue
         self.out_queue = out_queue
         self.task_id = task_id
+        self.read_size = read_size
+        self.stop_event = stop_event or threading.Event()
+        self.bandwidth = bandwidth or Bandwidth()
+        self.segments = segments
+        self.segment_size = segment_size
+        self.disk = disk or DiskSpace()
+        self.fsync = fsync
         self.name = "task %d" % task_id
 
     # ----------------------------------------------------------------------
     def run(self):
         while True:
             episode = self.queue.get()
-            self.download_file(episode)
-            self.queue.task_done()
+            if episode is None:
+                break  # no more episodes for this thread
+            if self.stop_event.is_set():
+                continue  # the supervisor gave up, drain the queue
+            try:
+                self.download_file(episode)
+            except Exception as err:  # pylint: disable=broad-except
+                # every episode must end with an event or the supervisor
+                # would wait for it forever
+                self.send_error(episode, episode.url, err,
+                                retry.classify_exception(err))
 
     # ----------------------------------------------------------------------
-    def send_error(self, episode, name, message):
+    def send_error(self, episode, name, message, error_class=retry.OTHER):
         """ Utility to put an error message in the out_queue """
         episode.error_msg = "%s:%s" % (name, message)
-        self.send_status(0, episode)
+        episode.error_class = error_class
+        self.send_event(FAILED, 0, episode)
 
-    def send_status(self, downloaded_current, episode):
-        """ Utility to put an error message in the out_queue """
-        self.out_queue.put((self.task_id, downloaded_current, episode))
+    def send_event(self, event, downloaded_current, episode):
+        """ Utility to put a progress, completed or failed event in the
+        out_queue """
+        self.out_queue.put((self.task_id, event, downloaded_current, episode))
 
     # ----------------------------------------------------------------------
     def download_file(self, episode):
-        """ Download and write the file to disc """
+        """ Download and write the file to disc, picking up where an earlier
+        attempt left off if we can """
+        episode.error_msg = None
+        episode.error_class = None
+        partial = PartialDownload(episode, self.fsync)
         # open the url
         try:
-            r = requests.get(episode.url, stream=True)
-        except URLError as err:
-            self.send_error(episode, episode.url, err)
+            r = httpclient.get(episode.url, stream=True,
+                               headers=partial.request_headers())
+            if r.status_code == 416 and partial.offset:
+                # the server will not resume this one, start again
+                r.close()
+                partial.discard()
+                r = httpclient.get(episode.url, stream=True)
+        except requests.exceptions.RequestException as err:
+            self.send_error(episode, episode.url, err,
+                            retry.classify_exception(err))
             return
 
+        # the connection goes back to the pool however we leave, or later
+        # requests to the host would wait for it
+        try:
+            if not self.check_response(episode, partial, r):
+                return
+
+            validator = self.segment_validator(partial, r)
+            if validator:
+                self.download_segments(episode, partial, r, validator)
+                return
+
+            try:
+                total = self.write_body(episode, partial, r)
+                self.finish_file(episode, partial, total)
+            except requests.exceptions.RequestException as err:
+                # the part file is kept so we can resume next time
+                self.send_error(episode, episode.url, err,
+                                retry.classify_exception(err))
+            except (IOError, OSError) as err:
+                self.send_error(episode, episode.file_name, err,
+                                retry.classify_io_error(err))
+        finally:
+            r.close()
+
+    def check_response(self, episode, partial, response):
+        """ Return True if the response holds the file and it fits on the
+        disk, otherwise record why not """
         # check http status for success (2xx)
-        http_status = r.status_code
+        http_status = response.status_code
         if (200 > http_status) or (299 < http_status):
             self.send_error(episode, episode.url,
-                            "HTTP STATUS: %s" % http_status)
+                            "HTTP STATUS: %s" % http_status,
+                            retry.classify_status(http_status))
+            return False
+
+        # now we know how big the file is, make sure it fits
+        needed = bytes_to_come(episode, partial, response.headers)
+        if not self.disk.claim(episode, needed):
+            self.send_error(episode, episode.file_name,
+                            "no room for %d bytes" % needed, retry.DISK)
+            return False
+        return True
+
+    def write_body(self, episode, partial, response):
+        """ Write the body of the response to the part file, returning the
+        size of the file so far """
+        with partial.open(response.status_code,
+                          response.headers) as podcast_file:
+            total = partial.offset
+            progress = ProgressLimiter()
+            # limits apply to the host we were redirected to
+            host = urlsplit(response.url).hostname
+            for block in response.iter_content(self.read_size):
+                if not block or self.stop_event.is_set():
+                    break
+                total = total + len(block)
+                podcast_file.write(block)
+                if progress.ready(total):
+                    self.send_event(PROGRESS, total, episode)
+                wait = self.bandwidth.reserve(host, len(block))
+                if wait:
+                    self.stop_event.wait(wait)
+            podcast_file.digest.record(episode)
+        return total
+
+    def finish_file(self, episode, partial, total):
+        """ Move the part file into place if all of it came, otherwise
+        record why not """
+        if self.stop_event.is_set():
+            self.send_error(episode, episode.url, "cancelled",
+                            retry.CANCELLED)
             return
+        if episode.size and total != episode.size:
+            self.send_error(episode, episode.url,
+                            "incomplete: %d of %d bytes" %
+                            (total, episode.size), retry.NETWORK)
+            return
+        # without a Content-Length the size is whatever we got
+        episode.size = total
+        partial.finish()
+        self.send_event(COMPLETED, total, episode)
 
-        episode.size = int(r.headers["Content-Length"])
-        total = 0
+    def segment_validator(self, partial, response):
+        """ Return the validator to check each segment against if the file
+        in response is to be fetched in segments, otherwise None.  The file
+        must be big enough, be a fresh download and come from a server which
+        takes Range requests and lets us check the file has not changed. """
+        headers = response.headers
+        if self.segments < 2 or partial.offset or \
+                response.status_code != 200 or \
+                headers.get('accept-ranges') != 'bytes' or \
+                int(headers.get('content-length') or 0) < self.segment_size:
+            return None
+        return headers.get('etag') or headers.get('last-modified')
+
+    def download_segments(self, episode, partial, response, validator):
+        """ Download the file in response in parallel segments """
+        # anything left from an earlier attempt is no use to us
+        partial.discard()
+        episode.size = int(response.headers['content-length'])
+        download = SegmentedDownload(self, episode, partial.part_name,
+                                     validator, self.segments)
+        failure = download.run(response)
+        if self.stop_event.is_set():
+            failure = ("cancelled", retry.CANCELLED)
+        if failure:
+            # a part file with holes in it cannot be resumed
+            partial.discard()
+            self.send_error(episode, episode.url, failure[0], failure[1])
+            return
+        # the segments arrive out of order so the file is digested at the end
         try:
-            with open(episode.file_name, "wb") as podcast_file:
-                for block in r.iter_content(1024):
-                    if not block:
-                        break
-                    total = total + len(block)
-                    podcast_file.write(block)
-                    self.send_status(total, episode)
-        except requests.exceptions.RequestException as e:  # This will catch ONLY Requests exceptions
-            print('REQUESTS ERROR:')
-            print(e)  # This should tell you more details about the error
-            self.send_error(episode, episode.file_name, e)
-        except IOError as err:
-            self.send_error(episode, episode.file_name, err)
+            with open(partial.part_name, "rb") as part_file:
+                utils.hash_file_object(part_file,
+                                       ContentDigest()).record(episode)
+            partial.finish()
+        except (IOError, OSError) as err:
+            self.send_error(episode, episode.file_name, err,
+                            retry.classify_io_error(err))
+            return
+        self.send_event(COMPLETED, episode.size, episode)
 
 
 ########################################################################
@@ -88,6 +595,12 @@ class DisplayStatus(object):
         self.successful_file_count = 0
         self.progress_string = "  0:%3s " % self.total_files
 
+    def add_file(self):
+        """ Count one more file to download """
+        self.total_files += 1
+        self.progress_string = r"%3s:%3s " % (self.successful_file_count,
+                                              self.total_files)
+
     def increment_success(self):
         """ Update the count and header string of successful files. """
         self.successful_file_count += 1
@@ -133,57 +646,280 @@ class DisplayStatus(object):
         print(display_str, end='')
 
 
+########################################################################
+class ScheduleQueue(object):
+    """ The episodes waiting for a download thread.  They are handed out
+    smallest sort key first, or in the order they were put if there is no
+    key.  The stop markers, None, come after every episode. """
+
+    # ----------------------------------------------------------------------
+    def __init__(self, key=None):
+        self.key = key
+        self.queue = queue.PriorityQueue()
+        # keeps episodes with the same key in order, and stops them being
+        # compared
+        self.sequence = itertools.count()
+
+    def put(self, episode):
+        """ Queue an episode, or a stop marker """
+        if episode is None:
+            rank = (1, )
+        else:
+            rank = (0, self.key(episode) if self.key else 0)
+        self.queue.put((rank, next(self.sequence), episode))
+
+    def get(self):
+        """ Wait for the next episode or stop marker """
+        return self.queue.get()[2]
+
+
 # ----------------------------------------------------------------------
 class PodcastDownloader(object):
     """ download the podcasts to disk. """
-    def __init__(self, episodes):
-        self.episodes = episodes
-        self.num_threads = min(3, len(episodes))
-        self.queue = queue.Queue()
+    # pylint: disable=too-many-arguments
+    def __init__(self, episodes, num_threads=DEFAULT_THREADS,
+                 read_size=DEFAULT_READ_SIZE, bandwidth=None, segments=1,
+                 segment_size=DEFAULT_SEGMENT_SIZE, disk=None,
+                 fsync=DEFAULT_FSYNC, max_pending=DEFAULT_PENDING,
+                 recorder=None, schedule_key=None):
+        self.episodes = list(episodes)
+        # a pool started empty is given its episodes with add
+        self.num_threads = min(num_threads, len(episodes)) or num_threads
+        self.read_size = read_size
+        self.bandwidth = bandwidth or Bandwidth()
+        # large files are fetched in this many parallel segments
+        self.segments = segments
+        self.segment_size = segment_size
+        self.disk = disk or DiskSpace()
+        self.fsync = fsync
+        # the episodes given with add are reordered by schedule_key while
+        # they wait
+        self.queue = ScheduleQueue(schedule_key)
         self.out_queue = queue.Queue()
         self.status = DisplayStatus(self.num_threads, len(episodes))
         self.failed_files = []
         self.successful_files = []
+        # episodes left for a later run as they do not fit on the disk
+        self.deferred_files = []
+        # retries so far in this run of each episode, by id
+        self.retries = dict()
+        # writes the result of each download as soon as it finishes
+        self.recorder = recorder
+        # episodes added beyond this many unfinished ones make add wait
+        self.max_pending = max_pending
+        # episodes submitted but not yet finished or deferred
+        self.remaining = 0
+        # (time due, sequence, episode) for each retry waiting to be queued
+        self.waiting = list()
+        self.sequence = itertools.count()
+        self.stop_event = threading.Event()
+        self.threads = list()
 
     def download_url_list(self):
         """
         Downloads each of the episodes passed in using a thread pool to
-        download in parallel.
+        download in parallel.  Events from the threads are handled as soon
+        as they arrive and the threads are stopped and joined before
+        returning, even if we are interrupted.  Transient failures are put
+        back on the queue after a short wait.  Episodes which do not fit on
+        the disk wait until others finish and are deferred if they still do
+        not fit once nothing else is running.
         """
-        # create a thread pool and give them a queue
+        self.start()
+        try:
+            self.submit(self.episodes)
+            self.join()
+        finally:
+            self.stop()
+        self.report()
+
+    def start(self):
+        """ Start the thread pool.  Episodes can then be given to it with add
+        while other work, such as refreshing feeds, goes on. """
         for thread_number in range(self.num_threads):
-            the_thread = Downloader(thread_number, self.queue, self.out_queue)
-            the_thread.setDaemon(True)
+            the_thread = Downloader(thread_number, self.queue, self.out_queue,
+                                    self.read_size, self.stop_event,
+                                    self.bandwidth, self.segments,
+                                    self.segment_size, self.disk,
+                                    self.fsync)
             the_thread.start()
+            self.threads.append(the_thread)
 
-        # give the queue some data
-        for episode in self.episodes:
+    def submit(self, episodes):
+        """ Queue the episodes there is room for on the disk """
+        self.remaining += len(episodes)
+        for episode in self.admit(episodes):
             self.queue.put(episode)
 
-        while self.queue.unfinished_tasks or self.out_queue.unfinished_tasks:
-            if self.out_queue.empty():
-                time.sleep(1)
-            else:
-                (task_id, current_size, episode) = self.out_queue.get(True, 1)
-
-                # if total length is 0, there was an error
-                if episode.error_msg:
-                    self.failed_files.append(episode)
-                    # update our UI
-                    self.status.update(task_id, current_size, None)
-                else:
-                    if current_size == episode.size:
-                        # if length read is total length - save name
-                        self.successful_files.append(episode)
-                        self.status.increment_success()
-                    # update our UI
-                    self.status.update(task_id, current_size, episode)
-
-                self.out_queue.task_done()
-
-        # wait for the queue to finish
-        self.queue.join()
+    def add(self, episode):
+        """ Download one more episode.  If max_pending episodes are already
+        waiting or running, handle events until one of them finishes so the
+        caller cannot get too far ahead of the downloads. """
+        self.episodes.append(episode)
+        self.status.add_file()
+        self.submit([episode])
+        # catch up with whatever the threads have done meanwhile
+        while self.poll(0):
+            pass
+        while self.pending() > self.max_pending and self.poll():
+            pass
+
+    def pending(self):
+        """ Return the number of episodes queued, running or waiting to be
+        retried """
+        return self.remaining - len(self.deferred_files)
+
+    def join(self):
+        """ Handle events until every episode has finished or been
+        deferred """
+        while self.pending() > 0 and self.poll():
+            pass
+
+    def poll(self, timeout=EVENT_TIMEOUT):
+        """ Queue the retries which are due and handle the next event from
+        the threads, waiting up to timeout seconds for one.  Returns False if
+        there was nothing to handle. """
+        if self.recorder:
+            # results are committed on time even when nothing is happening
+            self.recorder.tick()
+        event_tuple = self._next_event(timeout)
+        if event_tuple is None:
+            if not timeout:
+                return False
+            # keep waiting while somebody is left to send us anything
+            return any(thread.is_alive() for thread in self.threads)
+        (task_id, event, current_size, episode) = event_tuple
+        if event == FAILED and self._retry_or_defer(episode):
+            return True
+        self.handle_event(task_id, event, current_size, episode)
+        if event != PROGRESS:
+            self.remaining -= 1
+            # its space is on the disk now, or free again
+            self.disk.release(episode)
+            for admitted in self.readmit():
+                self.queue.put(admitted)
+        return True
+
+    def _queue_due_retries(self):
+        """ Queue the retries which are due, returning the seconds until the
+        next one is, or None if none are waiting """
+        while self.waiting and self.waiting[0][0] <= time.time():
+            self.queue.put(heapq.heappop(self.waiting)[2])
+        if self.waiting:
+            return self.waiting[0][0] - time.time()
+        return None
+
+    def _next_event(self, timeout):
+        """ Return the next event from the threads, or None if none came
+        before timeout or the next retry was due """
+        wait = timeout
+        due = self._queue_due_retries()
+        if due is not None:
+            wait = min(wait, due)
+        try:
+            if wait > 0:
+                return self.out_queue.get(True, wait)
+            return self.out_queue.get(False)
+        except queue.Empty:
+            if self.recorder:
+                self.recorder.tick()
+            return None
+
+    def _retry_or_defer(self, episode):
+        """ Put a failed episode aside to try again later if it can be,
+        returning True if it was """
+        self.disk.release(episode)
+        if episode.error_class == retry.DISK:
+            self.deferred_files.append(episode)
+            return True
+        delay = self.retry_delay(episode)
+        if delay is None:
+            return False
+        heapq.heappush(self.waiting, (time.time() + delay,
+                                      next(self.sequence), episode))
+        return True
+
+    def stop(self):
+        """ Stop and join the threads.  A partly finished download is kept
+        to be resumed next time. """
+        self.stop_event.set()
+        # one stop marker for each thread
+        for _ in self.threads:
+            self.queue.put(None)
+        for the_thread in self.threads:
+            the_thread.join()
+        self.threads = list()
+
+    def report(self):
+        """ Print how the downloads went """
         self.status.finish(self.failed_files)
+        self.show_deferred()
+        self.show_throughput()
+
+    def admit(self, episodes):
+        """ Return the episodes which fit on the disk, as far as we know
+        their size, and defer the rest """
+        admitted = list()
+        for episode in episodes:
+            if self.disk.claim(episode, bytes_to_come(
+                    episode, PartialDownload(episode))):
+                admitted.append(episode)
+            else:
+                self.deferred_files.append(episode)
+        return admitted
+
+    def readmit(self):
+        """ Return the deferred episodes which fit now """
+        deferred, self.deferred_files = self.deferred_files, list()
+        return self.admit(deferred)
+
+    def show_deferred(self):
+        """ Print the episodes left for next time for lack of space """
+        if self.deferred_files:
+            print("Not enough disk space, left for next time:")
+            for episode in self.deferred_files:
+                print("\t%s" % episode.file_name)
+
+    def show_throughput(self):
+        """ Print the download speed we saw, per host if debugging """
+        if not self.bandwidth.hosts():
+            return
+        print("Average download speed %.1f KB/s" %
+              (self.bandwidth.throughput() / 1024))
+        for host in self.bandwidth.hosts():
+            logging.debug("%s: %.1f KB/s", host,
+                          self.bandwidth.throughput(host) / 1024)
+
+    def retry_delay(self, episode):
+        """ Return the seconds to wait before trying a failed episode again
+        in this run, or None if it has failed for good this time """
+        retries = self.retries.get(id(episode), 0)
+        delay = retry.retry_delay(episode.error_class, retries)
+        if delay is not None:
+            self.retries[id(episode)] = retries + 1
+            logging.debug("Retrying %s in %.1f seconds after %s",
+                          episode.url, delay, episode.error_msg)
+        return delay
+
+    def handle_event(self, task_id, event, current_size, episode):
+        """ Record an event from one of the download tasks """
+        if event == FAILED:
+            self.failed_files.append(episode)
+            if self.recorder:
+                self.recorder.failed(episode)
+            # update our UI
+            self.status.update(task_id, current_size, None)
+        else:
+            if event == COMPLETED:
+                self.successful_files.append(episode)
+                if self.recorder:
+                    self.recorder.downloaded(episode)
+                self.status.increment_success()
+            elif self.recorder:
+                # progress arrives often enough to commit on time
+                self.recorder.tick()
+            # update our UI
+            self.status.update(task_id, current_size, episode)
 
     def return_failed_files(self):
         """ get the list of files that failed to download """
@@ -192,3 +928,7 @@ class PodcastDownloader(object):
     def return_successful_files(self):
         """ get the list of files that downloaded successfully """
         return self.successful_files
+
+    def return_deferred_files(self):
+        """ get the list of files that did not fit on the disk """
+        return self.deferred_files
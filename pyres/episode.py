@@ -28,6 +28,12 @@ class Episode(object):
             self.state = kwargs['state']
         else:
             self.state = 0
+        # failed download attempts so far and the class of the last failure
+        self.attempts = kwargs.get('attempts', 0)
+        self.error_class = None
+        # SHA-256 of the downloaded file, and how many seconds it plays
+        self.hash = kwargs.get('hash')
+        self.duration = kwargs.get('duration')
 
         if 'base_path' in kwargs:
             # create file name
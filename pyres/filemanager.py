@@ -80,8 +80,10 @@ class FileManager(object):
                 print("copying to %s" % (newfile))
                 shutil.copyfile(file_name, newfile)
 
-    def copy_episodes_to_player(self, episodes):
-        """ Copies the episodes to the mp3 player """
+    def copy_episodes_to_player(self, episodes, total=None, copied=None):
+        """ Copies the episodes to the mp3 player in the order given.
+        episodes may be any iterable if total gives how many there are.  If
+        copied is given it is called with each episode once it is done. """
         # make sure the podcast directory exists
         curname = os.getcwd()
         pod_name = curname.split("/")[-1]
@@ -89,21 +91,37 @@ class FileManager(object):
                                    utils.current_date_time_as_string())
         utils.mkdir_p(podcast_dir)
 
-        total = len(episodes)
+        if total is None:
+            total = len(episodes)
         counter = 0
-        for episode in sorted(episodes, key=lambda x: x.date):
+        # the player copy of each file by hash, so a file posted under more
+        # than one title is only copied once
+        on_player = dict()
+        for episode in episodes:
             episode.file_name = episode.file_name.replace('\\', '/')
             (_, tail) = os.path.split(episode.file_name)
             newfile = os.path.join(podcast_dir, tail)
             oldfile = os.path.join(curname, episode.file_name)
 
+            counter += 1
+            if episode.hash and episode.hash in on_player:
+                print("%2d/%d: %s is already on the player as %s" %
+                      (counter, total, episode.file_name,
+                       on_player[episode.hash]))
+                if copied:
+                    copied(episode)
+                continue
+
             logging.debug("copying %s to %s", episode.file_name, newfile)
             try:
                 shutil.copyfile(oldfile, newfile)
+                if episode.hash:
+                    on_player[episode.hash] = newfile
             except IOError as ex:
                 logging.error("Failed to find %s: %s", episode.file_name, ex)
 
-            counter += 1
             logging.debug("copied %s to %s", episode.file_name, newfile)
             print("%2d/%d: copied %s to %s" % (counter, total,
                                                episode.file_name, newfile))
+            if copied:
+                copied(episode)
@@ -0,0 +1,59 @@
+"""
+The HTTP client shared by feed refreshes and downloads.
+
+All requests go through one requests.Session so connections (and their TLS
+handshakes) are kept alive and reused.  Most episodes come from a handful of
+hosts, so this saves a connection setup for nearly every request.  The
+session is safe to share between the fetcher and downloader threads.
+"""
+import threading
+import requests
+import requests.adapters
+
+USER_AGENT = "pyres"
+# seconds to wait to connect and then between reads of the response
+TIMEOUT = (10, 60)
+# number of hosts to keep connections open to
+POOL_HOSTS = 20
+# connections kept open to each host.  Once they are all in use a request to
+# that host opens a connection of its own, which is closed when it is done
+POOL_SIZE = 6
+
+_SESSION = None
+_LOCK = threading.Lock()
+
+
+def make_session(pool_hosts=POOL_HOSTS, pool_size=POOL_SIZE):
+    """ Build a session with a connection pool per host """
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_connections=pool_hosts,
+                                            pool_maxsize=pool_size)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    session.headers['User-Agent'] = USER_AGENT
+    return session
+
+
+def get_session():
+    """ Return the shared session, creating it the first time """
+    global _SESSION  # pylint: disable=global-statement
+    with _LOCK:
+        if _SESSION is None:
+            _SESSION = make_session()
+        return _SESSION
+
+
+def get(url, **kwargs):
+    """ Send a GET request for url on the shared session.  Takes the same
+    arguments as requests.get and uses the default timeout if none is
+    given. """
+    kwargs.setdefault('timeout', TIMEOUT)
+    return get_session().get(url, **kwargs)
+
+
+def head(url, **kwargs):
+    """ Send a HEAD request for url on the shared session, following
+    redirects and using the default timeout unless told otherwise """
+    kwargs.setdefault('timeout', TIMEOUT)
+    kwargs.setdefault('allow_redirects', True)
+    return get_session().head(url, **kwargs)
@@ -1,15 +1,31 @@
 """ Manage podcasts. """
 import argparse
+import itertools
 import time
 import shutil
 import os
 import sys
+import sqlite3
 import logging
+import multiprocessing
 import pyres.utils as utils
+import pyres.mp3 as mp3
+import pyres.schedule as schedule
 import pyres.rss
-from pyres.database import PodcastDatabase
+from pyres.database import PodcastDatabase, PROFILES, DEFAULT_PROFILE
 from pyres.filemanager import FileManager
-from pyres.download import PodcastDownloader
+from pyres.download import PodcastDownloader, DEFAULT_THREADS, \
+    DEFAULT_CONCURRENCY, DEFAULT_READ_SIZE, DEFAULT_SEGMENT_SIZE, \
+    DEFAULT_FSYNC, FSYNC_POLICIES
+from pyres.bandwidth import Bandwidth
+from pyres.diskspace import DiskSpace, DEFAULT_RESERVE
+from pyres.recorder import DownloadRecorder
+from pyres.refresh import FeedRefresher, DEFAULT_FEED_WORKERS
+
+BACKUP_DIR = "BACKUP"
+# episodes handed to the process pool at a time when finding durations
+DURATION_BATCH = 100
+ENGINES = ['threads', 'async']
 
 
 def cmd_string_to_date(date_string):
@@ -17,27 +33,108 @@ def cmd_string_to_date(date_string):
     return time.strptime(date_string, "%x")
 
 
+def open_database(args):
+    """ Open the database named on the command line using the performance
+    profile chosen there """
+    return PodcastDatabase(args.database,
+                           getattr(args, 'db_profile', DEFAULT_PROFILE))
+
+
+def _list_backups(database):
+    """ Return the backups of the database, oldest first """
+    if not os.path.isdir(BACKUP_DIR):
+        return []
+    prefix = os.path.basename(database) + "_"
+    # the timestamp suffix sorts in date order
+    return [os.path.join(BACKUP_DIR, name)
+            for name in sorted(os.listdir(BACKUP_DIR))
+            if name.startswith(prefix)]
+
+
+def _copy_database(source, destination):
+    """ Copy the database using the sqlite online backup API, which gives a
+    consistent copy even if another process is writing to it. """
+    source_connection = sqlite3.connect(source)
+    try:
+        if hasattr(source_connection, 'backup'):
+            destination_connection = sqlite3.connect(destination)
+            try:
+                source_connection.backup(destination_connection)
+            finally:
+                destination_connection.close()
+        else:
+            # python versions before 3.7 have no backup API
+            shutil.copyfile(source, destination)
+    finally:
+        source_connection.close()
+
+
+def _checkpoint(database):
+    """ Move any changes still in the write-ahead log into the database
+    file, so its modification time shows them.  Returns False if the log
+    could not be emptied as another process is using it. """
+    wal_name = database + "-wal"
+    if not os.path.isfile(wal_name) or not os.path.getsize(wal_name):
+        return True
+    connection = sqlite3.connect(database)
+    try:
+        busy, _, _ = connection.execute(
+            "PRAGMA wal_checkpoint(TRUNCATE)").fetchone()
+    finally:
+        connection.close()
+    return not busy
+
+
+def _prune_backups(database, keep, max_days):
+    """ Delete all but the newest keep backups and any backup older than
+    max_days.  The newest backup is never deleted.  A keep or max_days of 0
+    means no limit. """
+    backups = _list_backups(database)[:-1]
+    oldest = time.time() - max_days * 24 * 60 * 60
+    for index, filename in enumerate(backups):
+        too_many = keep and index < len(backups) - (keep - 1)
+        too_old = max_days and os.path.getmtime(filename) < oldest
+        if too_many or too_old:
+            logging.debug("Removing old backup %s", filename)
+            os.remove(filename)
+
+
 def backup_database(args):
-    """ Save a copy of the database before modifying """
+    """ Save a copy of the database before modifying.  The copy is skipped if
+    the database has not changed since the newest backup, including changes
+    a WAL profile has only written to the log. """
     if os.path.isfile(args.database):
-        utils.mkdir_p("BACKUP")
-        suffix = utils.current_date_time_as_string()
-        filename = os.path.join("BACKUP", args.database + "_" + suffix)
-        shutil.copyfile(args.database, filename)
+        utils.mkdir_p(BACKUP_DIR)
+        backups = _list_backups(args.database)
+        settled = _checkpoint(args.database)
+        if settled and backups and os.path.getmtime(backups[-1]) == \
+                os.path.getmtime(args.database):
+            logging.debug("Database unchanged since %s", backups[-1])
+        else:
+            suffix = utils.current_date_time_as_string()
+            filename = os.path.join(BACKUP_DIR,
+                                    os.path.basename(args.database) + "_" +
+                                    suffix)
+            _copy_database(args.database, filename)
+            # stamp the backup with the time of the database it came from so
+            # we can tell next time if anything has changed
+            db_time = os.path.getmtime(args.database)
+            os.utime(filename, (db_time, db_time))
+        _prune_backups(args.database, args.backup_keep, args.backup_days)
     else:
         logging.debug("No database file to back up")
 
 
 def delete_podcast(args):
     """ Delete a podcast from the database """
-    with PodcastDatabase(args.database) as _database:
+    with open_database(args) as _database:
         _database.delete_podcast(args.name)
 
 
 def add_url(args):
     """ add a new podcast to the system """
     logging.debug("in add url with %s %s", args.url, args.start_date)
-    with PodcastDatabase(args.database) as _database:
+    with open_database(args) as _database:
         name, added = pyres.rss.add_episodes_from_feed(_database, args.url,
                                                        args.base_dir,
                                                        int(args.max_update),
@@ -51,75 +148,182 @@ def add_url(args):
             print("%-50s: %3d episodes returned" % (name, added))
 
 
+def refresh_feeds(database, args):
+    """ Queries each podcast website for new episodes and adds them to the
+    database.  Yields the name of each podcast with new episodes as soon as
+    they are stored.
+    """
+    total_added = 0
+    refresher = FeedRefresher(database, args.base_dir,
+                              getattr(args, 'feed_workers',
+                                      DEFAULT_FEED_WORKERS))
+    for _tuple, name, added in refresher.refresh(database.get_podcast_urls()):
+        if added:
+            total_added += added
+            print("%-50s: %3d episodes since %s" %
+                  (name, added, utils.date_as_string(_tuple[2])))
+            yield name
+    print()
+    print("There are a total of %d episodes to be updated." % (total_added))
+
+
 def update_download_list(args):
     """ Queries each podcast website for new episodes to down load.  Adds
-    these to the database.
+    these to the database and downloads them.  With the threads engine the
+    downloads start as soon as the first feed has been read rather than
+    after all of them, and the schedule orders the episodes waiting for a
+    download thread.  The asyncio engine cannot take episodes while it
+    runs, so with it every feed is read before the downloads start.
     """
-    with PodcastDatabase(args.database) as _database:
-        podcasts = _database.get_podcast_urls()
-        total_added = 0
-        for _tuple in podcasts:
-            name, added = pyres.rss.add_episodes_from_feed(_database,
-                                                           _tuple[0],
-                                                           args.base_dir,
-                                                           int(_tuple[1]),
-                                                           _tuple[2])
-            if added:
-                total_added += added
-                print("%-50s: %3d episodes since %s" %
-                      (name, added, utils.date_as_string(_tuple[2])))
-        print()
-        print("There are a total of %d episodes to be updated." %
-              (total_added))
-
-    # go ahead and get those podcasts while we're here.
-    process_rss_feeds(args)
+    if getattr(args, 'engine', 'threads') != 'threads':
+        print("The %s engine downloads once every feed has been read" %
+              args.engine)
+        with open_database(args) as _database:
+            for _ in refresh_feeds(_database, args):
+                pass
+        # go ahead and get those podcasts while we're here.
+        process_rss_feeds(args)
+        return
+
+    with open_database(args) as _database:
+        order = getattr(args, 'schedule', schedule.DEFAULT_SCHEDULE)
+        recorder = DownloadRecorder(_database)
+        downloader = make_downloader(args, [], recorder,
+                                     schedule.queue_key(order))
+        # (podcast, title) of each episode given to the downloader
+        queued = set()
+
+        def queue_episodes(podcast=None):
+            """ Give the downloader the episodes ready to download, of just
+            one podcast if given, which it does not already have """
+            episodes = [episode for episode in _database.iter_episodes(
+                0, order_by='podcast', ready_at=time.time(), podcast=podcast)
+                        if (episode.podcast, episode.title) not in queued]
+            for episode in episodes:
+                queued.add((episode.podcast, episode.title))
+                downloader.add(episode)
+
+        downloader.start()
+        try:
+            # episodes left from earlier runs need not wait for the feeds
+            queue_episodes()
+            for name in refresh_feeds(_database, args):
+                queue_episodes(name)
+            downloader.join()
+        finally:
+            downloader.stop()
+            # keep whatever finished, even if we were interrupted
+            recorder.commit()
+        downloader.report()
+        report_downloads(_database, recorder)
+
+
+def make_downloader(args, episodes, recorder=None, schedule_key=None):
+    """ Create the downloader for the engine chosen on the command line.  If
+    a recorder is given it writes the result of each download to the
+    database as soon as it finishes.  schedule_key orders the episodes
+    waiting for a thread, for those given to the threads engine with
+    add. """
+    concurrency = getattr(args, 'concurrency', None)
+    read_size = getattr(args, 'read_size', DEFAULT_READ_SIZE)
+    # limits are given in KB/s
+    rate = getattr(args, 'max_rate', None)
+    host_rate = getattr(args, 'max_host_rate', None)
+    bandwidth = Bandwidth(rate and rate * 1024, host_rate and host_rate * 1024)
+    # the reserve is given in MB
+    reserve = getattr(args, 'disk_reserve', None)
+    disk = DiskSpace(DEFAULT_RESERVE if reserve is None
+                     else reserve * 1024 * 1024)
+    fsync = getattr(args, 'fsync', DEFAULT_FSYNC)
+    if getattr(args, 'engine', 'threads') == 'async':
+        # the asyncio engine is python 3 only so only import it when asked
+        from pyres.asyncdownload import AsyncPodcastDownloader
+        return AsyncPodcastDownloader(episodes,
+                                      concurrency or DEFAULT_CONCURRENCY,
+                                      read_size, bandwidth, disk, fsync,
+                                      recorder)
+    # segmented downloads are only done by the threads engine
+    segments = getattr(args, 'segments', 1)
+    segment_size = getattr(args, 'segment_size', None)
+    return PodcastDownloader(episodes, concurrency or DEFAULT_THREADS,
+                             read_size, bandwidth, segments,
+                             segment_size * 1024 * 1024 if segment_size
+                             else DEFAULT_SEGMENT_SIZE, disk, fsync,
+                             recorder=recorder, schedule_key=schedule_key)
+
+
+def link_duplicate(database, episode):
+    """ If we already have a file with the same contents as the episode just
+    downloaded, replace the new file with a hard link to it so the contents
+    are only stored once """
+    for file_name in database.find_files_with_hash(episode):
+        if os.path.abspath(file_name) == os.path.abspath(episode.file_name) \
+                or not os.path.isfile(file_name):
+            continue
+        if utils.link_file(file_name, episode.file_name):
+            print("%s is the same as %s, linked" % (episode.file_name,
+                                                    file_name))
+            return True
+    return False
 
 
 def process_rss_feeds(args):
     """ download podcasts from web to computer - poorly named """
-    with PodcastDatabase(args.database) as _database:
-
-        podcasts = _database.get_podcast_names()
-
-        episodes = list()
-
-        for podcast in podcasts:
-            tmp_list = _database.find_episodes_to_download(podcast)
-            episodes += tmp_list
-            if len(tmp_list) != 0:
-                print("%-50s: %3d episodes to download" % (podcast,
-                                                           len(tmp_list)))
+    with open_database(args) as _database:
+        for podcast, count in _database.count_episodes(0):
+            print("%-50s: %3d episodes to download" % (podcast, count))
+
+        # episodes which failed recently wait for their next attempt.  The
+        # schedule builds the one list of them the downloader works from
+        episodes = schedule.order_episodes(
+            _database.iter_episodes(0, order_by='podcast',
+                                    ready_at=time.time()),
+            getattr(args, 'schedule', schedule.DEFAULT_SCHEDULE))
         if episodes:
-            downloader = PodcastDownloader(episodes)
-            downloader.download_url_list()
-            for episode in downloader.return_successful_files():
-                _database.mark_episode_downloaded(episode)
-                print(episode.file_name)
+            recorder = DownloadRecorder(_database)
+            downloader = make_downloader(args, episodes, recorder)
+            try:
+                downloader.download_url_list()
+            finally:
+                # keep whatever finished, even if we were interrupted
+                recorder.commit()
+            report_downloads(_database, recorder)
+
+
+def report_downloads(database, recorder):
+    """ Print the downloads the recorder has written to the database and
+    store files we already have only once """
+    successful = recorder.downloaded_files
+    for episode in successful:
+        print(episode.file_name)
+        link_duplicate(database, episode)
+    listening = sum(episode.duration or 0 for episode in successful)
+    if listening:
+        print("Downloaded %s of episodes" %
+              utils.duration_as_string(listening))
+    for episode in recorder.given_up_files:
+        print("Giving up on %s after %d attempts (%s)" %
+              (episode.file_name, episode.attempts, episode.error_class))
 
 
 def download_to_player(args):
     """ copy episodes to mp3 player """
-    with PodcastDatabase(args.database) as _database:
-        podcasts = _database.get_podcast_names()
+    with open_database(args) as _database:
+        total = 0
+        for podcast, count in _database.count_episodes(1):
+            print("%-50s: %3d" % (podcast, count))
+            total += count
 
-        episodes = list()
-        for podcast in podcasts:
-            new_episodes = _database.find_episodes_to_copy(podcast)
-            if len(new_episodes) != 0:
-                print("%-50s: %3d" % (podcast, len(new_episodes)))
-                episodes.extend(new_episodes)
-
-        if episodes:
+        if total:
             print()
-            print("Copying %d episodes to player" % len(episodes))
+            print("Copying %d episodes to player" % total)
 
-            # copy all the files in one list so they come out in date
-            # order
+            # the episodes come oldest first across all the podcasts, and
+            # are copied as they are read
             filemgr = FileManager(args.mp3_player)
-            filemgr.copy_episodes_to_player(episodes)
-            for episode in episodes:
-                _database.mark_episode_on_mp3_player(episode)
+            filemgr.copy_episodes_to_player(
+                _database.iter_episodes(1), total,
+                _database.mark_episode_on_mp3_player)
         else:
             print()
             print("No episodes to copy")
@@ -131,9 +335,46 @@ def manage_audiobook(args):
     filemgr.copy_audiobook(args.dir)
 
 
+def find_durations(args):
+    """ Find how long each downloaded episode we still have plays for, if
+    that was not found when it was downloaded.  The files are read in a pool
+    of processes, DURATION_BATCH episodes at a time. """
+    with open_database(args) as _database:
+        episodes = (episode for state in (1, 2)
+                    for episode in _database.iter_episodes(state)
+                    if episode.duration is None and
+                    os.path.isfile(episode.file_name))
+        pool = None
+        found = total = 0
+        try:
+            while True:
+                batch = list(itertools.islice(episodes, DURATION_BATCH))
+                if not batch:
+                    break
+                if pool is None:
+                    pool = multiprocessing.Pool(getattr(args, 'workers',
+                                                        None))
+                total += len(batch)
+                durations = pool.imap(mp3.file_duration,
+                                      [episode.file_name for episode in batch],
+                                      chunksize=4)
+                for episode, duration in zip(batch, durations):
+                    if duration is not None:
+                        _database.set_episode_duration(episode, duration)
+                        found += 1
+        finally:
+            if pool is not None:
+                pool.close()
+                pool.join()
+        if not total:
+            print("No episodes need a duration")
+            return
+        print("Found the duration of %d of %d episodes" % (found, total))
+
+
 def debug_database(args):
     """ debug routine to examine the database """
-    with PodcastDatabase(args.database) as _database:
+    with open_database(args) as _database:
         # show info from the database
         if args.all:
             _database.show_all_episodes()
@@ -143,37 +384,121 @@ def debug_database(args):
 
 def podcast_names(args):
     """ display the names of subscribed podcasts """
-    with PodcastDatabase(args.database) as _database:
+    with open_database(args) as _database:
         _database.show_names()
 
 
-def parse_command_line():
-    """ Manage command line options """
-    # base args are shared with all subcommands
+def _base_options(defaults=True):
+    """ Return a parser holding the options every command takes.  Without
+    defaults an option which is left out sets nothing, so a subcommand keeps
+    what was given before it on the command line. """
+    def default(value):
+        """ the default to give an option """
+        return value if defaults else argparse.SUPPRESS
+
     base = argparse.ArgumentParser(add_help=False)
     base.add_argument('-v', '--verbose', action='store_true',
+                      default=default(False),
                       help="print debug output while processing")
     base.add_argument('-b', '--no-backup', action='store_true',
+                      default=default(False),
                       help="do not create an auto-backup of the database")
-    base.add_argument('-d', '--database', action='store', default='rss.db',
+    base.add_argument('-d', '--database', action='store',
+                      default=default('rss.db'),
                       help="name of database file")
+    base.add_argument('--backup-keep', action='store', type=int,
+                      default=default(10),
+                      help="number of database backups to keep, 0 for all")
+    base.add_argument('--backup-days', action='store', type=int,
+                      default=default(0),
+                      help="delete database backups older than this many "
+                      "days, 0 to keep them regardless of age")
+    base.add_argument('--db-profile', action='store',
+                      default=default(DEFAULT_PROFILE),
+                      choices=sorted(PROFILES), help="sqlite tuning to use "
+                      "when opening the database")
+    return base
+
 
+def parse_command_line():
+    """ Manage command line options """
+    # base args are shared with all subcommands.  The subcommands' copies
+    # have no defaults so they do not undo options given before the
+    # subcommand
+    base = _base_options()
+    sub_base = _base_options(defaults=False)
+
+    # download options are shared by the commands which download episodes
+    download_opts = argparse.ArgumentParser(add_help=False)
+    download_opts.add_argument('--engine', action='store', default='threads',
+                               choices=ENGINES, help="download with a pool of "
+                               "threads or with a single asyncio event loop "
+                               "(python 3 only).  The asyncio engine opens a "
+                               "new connection for each file and does not "
+                               "use HTTP_PROXY or HTTPS_PROXY.  Only the "
+                               "threads engine starts downloading during "
+                               "update before every feed has been read")
+    download_opts.add_argument('--concurrency', action='store', type=int,
+                               default=None, help="the number of episodes to "
+                               "download at once (default %d for threads, %d "
+                               "for async)" % (DEFAULT_THREADS,
+                                               DEFAULT_CONCURRENCY))
+    download_opts.add_argument('--read-size', action='store', type=int,
+                               default=DEFAULT_READ_SIZE, help="the number "
+                               "of bytes to read from the network at a time")
+    download_opts.add_argument('--max-rate', action='store', type=int,
+                               default=None, help="limit all downloads "
+                               "together to this many KB/s")
+    download_opts.add_argument('--max-host-rate', action='store', type=int,
+                               default=None, help="limit the downloads from "
+                               "each host to this many KB/s")
+    download_opts.add_argument('--disk-reserve', action='store', type=int,
+                               default=DEFAULT_RESERVE // (1024 * 1024),
+                               help="MB to leave free on the disk.  "
+                               "Episodes which do not fit are left for the "
+                               "next run")
+    download_opts.add_argument('--fsync', action='store',
+                               default=DEFAULT_FSYNC, choices=FSYNC_POLICIES,
+                               help="when to force downloads out to the "
+                               "disk: never, when each file is finished, or "
+                               "also periodically while it is written")
+    download_opts.add_argument('--schedule', action='store',
+                               default=schedule.DEFAULT_SCHEDULE,
+                               choices=list(schedule.SCHEDULES),
+                               help="the order to download episodes in: "
+                               "grouped by podcast, smallest first, newest "
+                               "first or each podcast in turn (fair).  "
+                               "During update it orders the episodes "
+                               "waiting to download as feeds are read, "
+                               "without looking up unknown sizes")
+    download_opts.add_argument('--segments', action='store', type=int,
+                               default=1, help="download large episodes "
+                               "in this many parallel pieces, from servers "
+                               "which allow it (threads engine only)")
+    download_opts.add_argument('--segment-size', action='store', type=int,
+                               default=DEFAULT_SEGMENT_SIZE // (1024 * 1024),
+                               help="the size in MB from which episodes are "
+                               "downloaded in pieces")
+
+    # options can also be read from a file, one per line, before or after
+    # the subcommand:  pyres @pyres.conf update
     parser = argparse.ArgumentParser(description='Pyres podcast manager.',
-                                     parents=[base])
+                                     parents=[base],
+                                     fromfile_prefix_chars='@')
 
     # add subcommands
     subparsers = parser.add_subparsers(help='commands', dest='command')
 
     # delete podcast command
     delete_parser = subparsers.add_parser('delete', help='remove podcast from '
-                                          'database', parents=[base])
+                                          'database', parents=[sub_base])
     delete_parser.add_argument('name', action='store', help="the name of the "
                                "podcast to delete")
-    delete_parser.set_defaults(func=delete_podcast)
+    delete_parser.set_defaults(func=delete_podcast, modifies=True)
 
     # Add new URL command
     add_parser = subparsers.add_parser('add', help='Add a new podcast',
-                                       parents=[base])
+                                       parents=[sub_base])
     add_parser.add_argument('url', action='store', help='The URL of the'
                             'podcast to add')
     add_parser.add_argument('--start-date', action='store',
@@ -185,38 +510,42 @@ def parse_command_line():
     add_parser.add_argument('--max-update', action='store',
                             default=sys.maxsize, help='The maximum number of '
                             'episodes to download at one time.')
-    add_parser.set_defaults(func=add_url)
+    add_parser.set_defaults(func=add_url, modifies=True)
 
     # Update existing podcasts - download to from web to computer
     update_parser = subparsers.add_parser('update', help="update the list of "
                                           "podcasts to download",
-                                          parents=[base])
+                                          parents=[sub_base, download_opts])
     update_parser.add_argument('--base-dir', action='store', default='Files',
                                help='The local direction in which to store '
                                'podcasts')
-    update_parser.set_defaults(func=update_download_list)
+    update_parser.add_argument('--feed-workers', action='store', type=int,
+                               default=DEFAULT_FEED_WORKERS,
+                               help='The number of feeds to fetch in '
+                               'parallel')
+    update_parser.set_defaults(func=update_download_list, modifies=True)
 
     # process existing podcasts - download to from web to computer
     process_parser = subparsers.add_parser('process', help="download podcasts "
                                            "from web to computer",
-                                           parents=[base])
-    process_parser.set_defaults(func=process_rss_feeds)
+                                           parents=[sub_base, download_opts])
+    process_parser.set_defaults(func=process_rss_feeds, modifies=True)
 
     # download podcasts - download from computer to mp3 player
     download_parser = subparsers.add_parser('download', help="Download "
                                             "episodes to mp3 player",
-                                            parents=[base])
+                                            parents=[sub_base])
     download_parser.add_argument('--mp3-player', action='store',
                                  default=None, help='The path to the mp3 '
                                  'player including drive')
-    download_parser.set_defaults(func=download_to_player)
+    download_parser.set_defaults(func=download_to_player, modifies=True)
 
     # transfer an audiobook to mp3 play in correct order
     # Player is very fussy about the directory order (it does not sort by name)
     # Copying them in in the correct order gets it to play in the right order!
     audiobook_parser = subparsers.add_parser('audiobook', help="update the "
                                              "list of podcasts to download",
-                                             parents=[base])
+                                             parents=[sub_base])
     audiobook_parser.add_argument('--dir', action='store', required=True,
                                   help='The directory from which the '
                                   'audiobook will be copied.')
@@ -225,17 +554,26 @@ def parse_command_line():
                                   'player including drive')
     audiobook_parser.set_defaults(func=manage_audiobook)
 
+    # fill in the duration of episodes downloaded before it was recorded
+    durations_parser = subparsers.add_parser('durations', help="find the "
+                                             "duration of downloaded "
+                                             "episodes", parents=[sub_base])
+    durations_parser.add_argument('--workers', action='store', type=int,
+                                  default=None, help="the number of files "
+                                  "to read at once (default one per CPU)")
+    durations_parser.set_defaults(func=find_durations, modifies=True)
+
     # debug conversion of database on general command
     database_parser = subparsers.add_parser('database', help="debug utility "
                                             "to examine database.",
-                                            parents=[base])
+                                            parents=[sub_base])
     database_parser.add_argument('-a', '--all', action='store_true',
                                  help="show all episode data")
     database_parser.set_defaults(func=debug_database)
 
     # return a list of podcast names.  Helpful for command-line tab completion
     names_parser = subparsers.add_parser('names', help="display podcast names",
-                                         parents=[base])
+                                         parents=[sub_base])
     names_parser.set_defaults(func=podcast_names)
 
     args = parser.parse_args(sys.argv[1:])
@@ -246,8 +584,9 @@ def main():
     """ Main entry point for pyres application """
     args = parse_command_line()
 
-    # database backup is done before any operation by default
-    if not args.no_backup:
+    # database backup is done before any operation that changes the database
+    # by default
+    if not args.no_backup and getattr(args, 'modifies', False):
         backup_database(args)
 
     # if verbose flag is set - turn logging level up
@@ -0,0 +1,257 @@
+"""
+Find how long an MP3 file plays from its headers.
+
+The parser is fed the file a block at a time as it is downloaded, so the
+duration is known without reading the file again.  It skips any ID3v2 tags
+at the start, reads the header of the first MPEG audio frame and looks in
+that frame for a Xing/Info or VBRI header giving the number of frames in a
+variable bit rate file.  Without one the file is taken to be constant bit
+rate and the duration comes from the size of the audio and the bit rate.
+
+A frame only counts if the next frame of the same stream starts where it
+ends, so other files which happen to hold the bytes of a frame header, such
+as AAC, have no duration.
+"""
+import struct
+
+# bit rates in kbit/s by (MPEG 1 or not, layer) and the bit rate index
+_BITRATES = {
+    (True, 1): (0, 32, 64, 96, 128, 160, 192, 224, 256, 288, 320, 352, 384,
+                416, 448),
+    (True, 2): (0, 32, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256,
+                320, 384),
+    (True, 3): (0, 32, 40, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256,
+                320),
+    (False, 1): (0, 32, 48, 56, 64, 80, 96, 112, 128, 144, 160, 176, 192,
+                 224, 256),
+    (False, 2): (0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144,
+                 160),
+}
+_BITRATES[(False, 3)] = _BITRATES[(False, 2)]
+# the header bits which stay the same from frame to frame: sync, version,
+# layer and sample rate
+_STREAM_BITS = 0xFFFE0C00
+# sample rates by the version bits then the sample rate index
+_SAMPLE_RATES = {3: (44100, 48000, 32000),     # MPEG 1
+                 2: (22050, 24000, 16000),     # MPEG 2
+                 0: (11025, 12000, 8000)}      # MPEG 2.5
+# ID3v2 tags start with a 10 byte header
+_ID3_HEADER = 10
+# ID3v1 tags are the last 128 bytes of the file
+_ID3V1_SIZE = 128
+# bytes from the start of the first frame we need to see to find a Xing or
+# VBRI header
+_FRAME_HEAD = 64
+# give up looking for the first frame after this many bytes of audio
+MAX_SCAN = 64 * 1024
+# block size for reading files
+_READ_SIZE = 1 << 20
+
+
+def parse_frame_header(header):
+    """ Return (bitrate in bit/s, sample rate, samples per frame, Xing
+    header offset) for the 4 byte frame header, or None if it is not a
+    valid MPEG audio frame header """
+    (value, ) = struct.unpack('>I', header)
+    if value & 0xFFE00000 != 0xFFE00000:
+        return None
+    version = (value >> 19) & 3
+    layer = 4 - ((value >> 17) & 3)
+    bitrate_index = (value >> 12) & 15
+    rate_index = (value >> 10) & 3
+    if version == 1 or layer == 4 or bitrate_index in (0, 15) or \
+            rate_index == 3:
+        return None
+    mpeg1 = version == 3
+    mono = (value >> 6) & 3 == 3
+    bitrate = _BITRATES[(mpeg1, layer)][bitrate_index] * 1000
+    sample_rate = _SAMPLE_RATES[version][rate_index]
+    if layer == 1:
+        samples = 384
+    elif layer == 3 and not mpeg1:
+        samples = 576
+    else:
+        samples = 1152
+    # the Xing header follows the side information of a layer III frame
+    if mpeg1:
+        xing_offset = 4 + (17 if mono else 32)
+    else:
+        xing_offset = 4 + (9 if mono else 17)
+    return bitrate, sample_rate, samples, xing_offset
+
+
+def frame_length(header):
+    """ Return the number of bytes in the frame which starts with the 4 byte
+    frame header, or None if it is not a valid frame header """
+    fields = parse_frame_header(header)
+    if fields is None:
+        return None
+    bitrate, sample_rate, samples, _ = fields
+    padding = (struct.unpack('>I', header)[0] >> 9) & 1
+    if samples == 384:
+        # layer I frames are counted in 4 byte slots
+        return (12 * bitrate // sample_rate + padding) * 4
+    return samples // 8 * bitrate // sample_rate + padding
+
+
+def _same_stream(header, following):
+    """ Return True if following is a frame header of the same stream as
+    header """
+    if parse_frame_header(following) is None:
+        return False
+    return struct.unpack('>I', header)[0] & _STREAM_BITS == \
+        struct.unpack('>I', following)[0] & _STREAM_BITS
+
+
+def _vbr_frames(frame, xing_offset):
+    """ Return the number of frames given by a Xing/Info or VBRI header in
+    the first frame, or None if it has neither """
+    tag = frame[xing_offset:xing_offset + 4]
+    if tag in (b'Xing', b'Info') and len(frame) >= xing_offset + 12:
+        (flags, ) = struct.unpack('>I', frame[xing_offset + 4:xing_offset + 8])
+        if flags & 1:
+            return struct.unpack('>I',
+                                 frame[xing_offset + 8:xing_offset + 12])[0]
+    # the VBRI header is always 32 bytes after the frame header
+    if frame[36:40] == b'VBRI' and len(frame) >= 54:
+        return struct.unpack('>I', frame[50:54])[0]
+    return None
+
+
+########################################################################
+class DurationParser(object):
+    """ Work out the duration of an MP3 file fed to it a block at a time.
+    Only the start of the file is kept, the rest is just counted. """
+
+    # ----------------------------------------------------------------------
+    def __init__(self):
+        self.size = 0
+        # the start of the file not yet parsed, and where it is in the file
+        self.head = b''
+        self.position = 0
+        # bytes of ID3v2 tag still to skip
+        self.skip = 0
+        self.done = False
+        self.audio_start = None
+        self.bitrate = None
+        self.sample_rate = None
+        self.samples = None
+        self.frames = None
+        # the last bytes of the file, which may be an ID3v1 tag
+        self.tail = b''
+
+    def update(self, block):
+        """ Take the next block of the file """
+        self.size += len(block)
+        self.tail = (self.tail + block[-_ID3V1_SIZE:])[-_ID3V1_SIZE:]
+        if self.done:
+            return
+        if self.skip:
+            skipped = min(self.skip, len(block))
+            self.skip -= skipped
+            self.position += skipped
+            block = block[skipped:]
+        self.head += block
+        self._parse()
+
+    def _parse(self):
+        """ Skip tags and look for the first frame in what we have """
+        while not self.done and not self.skip:
+            if len(self.head) < _ID3_HEADER:
+                return
+            if self.head[:3] == b'ID3':
+                # the tag size is a 28 bit "syncsafe" integer
+                size = 0
+                for byte in bytearray(self.head[6:10]):
+                    size = (size << 7) | (byte & 0x7F)
+                size += _ID3_HEADER
+                if bytearray(self.head[5:6])[0] & 0x10:
+                    size += _ID3_HEADER  # a footer follows the tag
+                skipped = min(size, len(self.head))
+                self.skip = size - skipped
+                self.position += skipped
+                self.head = self.head[skipped:]
+                continue
+            self._find_frame()
+            return
+
+    def _find_frame(self, final=False):
+        """ Look for the first frame header and any VBR header after it.
+        Unless this is the final look, wait until enough of the frame has
+        arrived to check for a VBR header. """
+        start = 0
+        while True:
+            start = self.head.find(b'\xff', start)
+            if start < 0 or \
+                    len(self.head) < start + (4 if final else _FRAME_HEAD):
+                break
+            header = self._check_frame(start, final)
+            if header is None:
+                break  # wait for the next frame to arrive
+            if header:
+                frame = self.head[start:start + _FRAME_HEAD]
+                (self.bitrate, self.sample_rate, self.samples,
+                 xing_offset) = header
+                self.frames = _vbr_frames(frame, xing_offset)
+                self.audio_start = self.position + start
+                self.done = True
+                self.head = b''
+                return
+            start += 1
+        if len(self.head) > MAX_SCAN:
+            # not an MP3 file, or not one we understand
+            self.done = True
+            self.head = b''
+
+    def _check_frame(self, start, final):
+        """ Return the fields of the frame header at start if the next frame
+        of the stream starts where this one ends, False if there is no frame
+        here, or None if we cannot tell until more of the file arrives """
+        header = self.head[start:start + 4]
+        length = frame_length(header)
+        if length is None:
+            return False
+        following = start + length
+        if len(self.head) >= following + 4:
+            if not _same_stream(header, self.head[following:following + 4]):
+                return False
+        elif not final:
+            return None
+        # otherwise the file ends inside its only frame
+        return parse_frame_header(header)
+
+    def duration(self):
+        """ Return how many seconds the file fed so far plays for, or None if
+        we could not tell """
+        if not self.done and not self.skip:
+            # a file which ends soon after its first frame
+            self._find_frame(final=True)
+        if self.audio_start is None:
+            return None
+        if self.frames:
+            return float(self.frames) * self.samples / self.sample_rate
+        audio = self.size - self.audio_start
+        if self.tail[:3] == b'TAG':
+            audio -= _ID3V1_SIZE
+        return max(0, audio) * 8.0 / self.bitrate
+
+
+def file_duration(file_name):
+    """ Return how many seconds the MP3 file plays for, or None if we cannot
+    tell.  Used to fill in the duration of files we already have. """
+    parser = DurationParser()
+    try:
+        with open(file_name, 'rb') as mp3_file:
+            # only the start of the file is parsed, the rest just counts
+            while not parser.done:
+                block = mp3_file.read(_READ_SIZE)
+                if not block:
+                    break
+                parser.update(block)
+            mp3_file.seek(0, 2)
+            parser.size = mp3_file.tell()
+            mp3_file.seek(max(0, parser.size - _ID3V1_SIZE))
+            parser.tail = mp3_file.read()
+    except (IOError, OSError):
+        return None
+    return parser.duration()
@@ -0,0 +1,79 @@
+"""
+Record how downloads went in the database as soon as each one finishes.
+
+Each result is written straight away but commits, which are what wait for
+the disk, are shared by a group of results.  The group is committed once it
+holds batch_size results or batch_seconds after the first of them was
+written, whichever comes first.  A crash or Ctrl-C part way through a long
+run then loses at most the last group rather than every result.
+
+The recorder is called from the thread which handles the download events,
+so the database is still only used from one thread.
+"""
+import time
+import pyres.retry as retry
+
+# results written before they are committed
+BATCH_SIZE = 20
+# seconds a result may wait to be committed
+BATCH_SECONDS = 10.0
+
+
+########################################################################
+class DownloadRecorder(object):
+    """ Write the result of each download to the database as it finishes,
+    committing them in groups """
+
+    # ----------------------------------------------------------------------
+    def __init__(self, database, batch_size=BATCH_SIZE,
+                 batch_seconds=BATCH_SECONDS, clock=time.time):
+        self.database = database
+        self.batch_size = batch_size
+        self.batch_seconds = batch_seconds
+        self.clock = clock
+        # results written since the last commit, and when the first was
+        self.uncommitted = 0
+        self.first_written = None
+        self.downloaded_files = []
+        # failed episodes which will not be tried again
+        self.given_up_files = []
+
+    def downloaded(self, episode):
+        """ Record an episode which downloaded successfully """
+        self.database.mark_episode_downloaded(episode)
+        self.downloaded_files.append(episode)
+        self._written()
+
+    def failed(self, episode):
+        """ Record a failed download and when to try it again """
+        episode.attempts += 1
+        next_attempt = retry.next_attempt(episode.error_class,
+                                          episode.attempts, self.clock())
+        self.database.mark_episode_failed(episode, next_attempt)
+        if next_attempt is None:
+            self.given_up_files.append(episode)
+        self._written()
+
+    def _written(self):
+        """ Count a result and commit if the group is full """
+        self.uncommitted += 1
+        if self.first_written is None:
+            self.first_written = self.clock()
+        if self.uncommitted >= self.batch_size:
+            self.commit()
+        else:
+            self.tick()
+
+    def tick(self):
+        """ Commit if the oldest uncommitted result has waited long
+        enough """
+        if self.uncommitted and \
+                self.clock() - self.first_written >= self.batch_seconds:
+            self.commit()
+
+    def commit(self):
+        """ Commit every result written so far """
+        if self.uncommitted:
+            self.database.commit()
+            self.uncommitted = 0
+            self.first_written = None
@@ -0,0 +1,95 @@
+"""
+Refresh podcast feeds in parallel.
+"""
+from six.moves import queue
+import sys
+import threading
+import six
+import pyres.rss
+
+DEFAULT_FEED_WORKERS = 4
+
+
+########################################################################
+class FeedFetcher(threading.Thread):
+    """ Threaded feed fetcher.  Pulls down and parses feeds but never touches
+    the database. """
+
+    # ----------------------------------------------------------------------
+    def __init__(self, in_queue, out_queue, base_dir, stop_event):
+        threading.Thread.__init__(self)
+        self.queue = in_queue
+        self.out_queue = out_queue
+        self.base_dir = base_dir
+        self.stop_event = stop_event
+
+    # ----------------------------------------------------------------------
+    def run(self):
+        while True:
+            task = self.queue.get()
+            if task is None:
+                break  # no more feeds for this thread
+            if self.stop_event.is_set():
+                continue  # the writer gave up, drain the queue
+            (podcast, validators) = task
+            try:
+                result = pyres.rss.fetch_episodes_from_feed(
+                    podcast[0], self.base_dir, podcast[2], validators,
+                    podcast[3])
+                self.out_queue.put((podcast, result, None))
+            except Exception:  # pylint: disable=broad-except
+                # hand the error back to the writer so it is raised there
+                self.out_queue.put((podcast, None, sys.exc_info()))
+
+
+# ----------------------------------------------------------------------
+class FeedRefresher(object):
+    """ Refresh a list of feeds using a bounded pool of fetcher threads.  The
+    thread calling refresh is the only one which writes to the database. """
+    def __init__(self, database, base_dir, num_workers=DEFAULT_FEED_WORKERS):
+        self.database = database
+        self.base_dir = base_dir
+        self.num_workers = max(1, num_workers)
+
+    def refresh(self, podcasts):
+        """ Fetch each of the (url, throttle, start_date, latest_title)
+        tuples in podcasts and store the new episodes.  Yields (podcast,
+        name, added) for each feed in the order in which the feeds
+        finish. """
+        podcasts = list(podcasts)
+        if not podcasts:
+            return
+        # validators from the last refresh let unchanged feeds be skipped
+        validators = self.database.get_feed_validators()
+        in_queue = queue.Queue()
+        out_queue = queue.Queue()
+        stop_event = threading.Event()
+        threads = list()
+        for _ in range(min(self.num_workers, len(podcasts))):
+            the_thread = FeedFetcher(in_queue, out_queue, self.base_dir,
+                                     stop_event)
+            the_thread.start()
+            threads.append(the_thread)
+
+        for podcast in podcasts:
+            in_queue.put((podcast, validators.get(podcast[0])))
+        # one stop marker for each thread
+        for _ in threads:
+            in_queue.put(None)
+
+        try:
+            for _ in range(len(podcasts)):
+                podcast, result, exc_info = out_queue.get()
+                if exc_info:
+                    six.reraise(*exc_info)
+                (name, episodes, feed_validators) = result
+                name, added = pyres.rss.store_episodes(self.database,
+                                                       podcast[0],
+                                                       int(podcast[1]),
+                                                       name, episodes,
+                                                       feed_validators)
+                yield podcast, name, added
+        finally:
+            stop_event.set()
+            for the_thread in threads:
+                the_thread.join()
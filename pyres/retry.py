@@ -0,0 +1,121 @@
+"""
+Classify download failures and decide when to try them again.
+
+Transient failures (timeouts, network trouble, server errors) are retried a
+couple of times in the same run after a short, jittered wait.  Whatever still
+fails is recorded in the database with a time before which it will not be
+tried again, which grows with each failed attempt.  Permanent failures (the
+server says the file is not there) and episodes which have failed too many
+times are given up on.  Episodes which do not fit on the disk are neither,
+they are left for a later run without counting as an attempt.
+"""
+import errno
+import random
+import socket
+import requests
+
+# classes of failure
+DNS = 'dns'
+TIMEOUT = 'timeout'
+CLIENT = '4xx'
+SERVER = '5xx'
+NETWORK = 'network'
+IO = 'io'
+DISK = 'disk'
+CANCELLED = 'cancelled'
+OTHER = 'error'
+
+# failures worth trying again straight away
+TRANSIENT = (DNS, TIMEOUT, SERVER, NETWORK)
+# failures which will never work
+PERMANENT = (CLIENT, )
+
+# retries of a transient failure in the same run, with the wait before each
+# one drawn from 0 to RETRY_DELAY * 2 ** retry seconds
+RETRIES_PER_RUN = 2
+RETRY_DELAY = 2.0
+
+# the wait before a failed episode is tried in a later run, drawn from
+# 0.5 to 1 times RUN_DELAY * 2 ** attempts seconds but never more than
+# MAX_RUN_DELAY
+RUN_DELAY = 15 * 60
+MAX_RUN_DELAY = 24 * 60 * 60
+# failed attempts before we give up on an episode
+MAX_ATTEMPTS = 10
+
+_DNS_MESSAGES = ('Name or service not known', 'Failed to resolve',
+                 'getaddrinfo failed', 'nodename nor servname',
+                 'Temporary failure in name resolution')
+
+
+def _causes(error):
+    """ Yield the error and every error it wraps """
+    seen = set()
+    pending = [error]
+    while pending:
+        error = pending.pop()
+        if not isinstance(error, BaseException) or id(error) in seen:
+            continue
+        seen.add(id(error))
+        yield error
+        # requests and urllib3 hide the real error in args or reason
+        pending.extend(error.args)
+        pending.extend([getattr(error, 'reason', None),
+                        getattr(error, '__cause__', None),
+                        getattr(error, '__context__', None)])
+
+
+def classify_exception(error):
+    """ Return the class of failure for an exception raised while
+    downloading """
+    causes = list(_causes(error))
+    for cause in causes:
+        if isinstance(cause, socket.gaierror) or \
+                any(message in str(cause) for message in _DNS_MESSAGES):
+            return DNS
+    for cause in causes:
+        if isinstance(cause, (socket.timeout, requests.exceptions.Timeout)) \
+                or 'Timeout' in type(cause).__name__:
+            return TIMEOUT
+    if isinstance(error, (requests.exceptions.RequestException,
+                          EnvironmentError)):
+        return NETWORK
+    return OTHER
+
+
+def classify_io_error(error):
+    """ Return the class of failure for an error writing a download """
+    if getattr(error, 'errno', None) == errno.ENOSPC:
+        return DISK
+    return IO
+
+
+def classify_status(status):
+    """ Return the class of failure for an HTTP status """
+    if status == 408:
+        return TIMEOUT
+    if status == 429 or status >= 500:
+        # too many requests is worth trying again later
+        return SERVER
+    if 400 <= status < 500:
+        return CLIENT
+    return OTHER
+
+
+def retry_delay(error_class, retries):
+    """ Return the seconds to wait before retrying a failure of error_class
+    in this run, having already retried it retries times, or None if it
+    should not be retried now """
+    if error_class not in TRANSIENT or retries >= RETRIES_PER_RUN:
+        return None
+    return random.uniform(0, RETRY_DELAY * 2 ** retries)
+
+
+def next_attempt(error_class, attempts, now):
+    """ Return the time after which an episode that has now failed attempts
+    times, most recently with error_class, should be tried again, or None to
+    give up on it """
+    if error_class in PERMANENT or attempts >= MAX_ATTEMPTS:
+        return None
+    delay = min(MAX_RUN_DELAY, RUN_DELAY * 2 ** (attempts - 1))
+    return now + random.uniform(delay / 2, delay)
@@ -2,22 +2,83 @@
 Tool to download and manage podcasts.
 """
 import feedparser
+import hashlib
 import os
 import logging
-import time
+import requests
+from six.moves.urllib.parse import urlsplit
 from pyres.episode import Episode
+import pyres.dates as dates
+import pyres.httpclient as httpclient
 import pyres.utils as utils
 
 
-def __process_feed(url, base_dir, start_date):
-    """ Pull down the rss feed and add return episodes """
-    feed = feedparser.parse(url)
+def __is_local(url):
+    """ Return True if url is a file rather than something to fetch over
+    HTTP """
+    return os.path.exists(url) or urlsplit(url).scheme == 'file'
+
+
+def __read_feed(url, validators):
+    """ Fetch the feed at url on the shared HTTP session, asking the server
+    to skip it if it has not changed.  Returns the response, or None if the
+    feed is unchanged or could not be read. """
+    headers = dict()
+    if validators:
+        (etag, modified, _) = validators
+        if etag:
+            headers['If-None-Match'] = etag
+        if modified:
+            headers['If-Modified-Since'] = modified
+    try:
+        response = httpclient.get(url, headers=headers)
+    except requests.exceptions.RequestException as err:
+        logging.error("Failed to read %s: %s", url, err)
+        return None
+    if response.status_code == 304:
+        logging.debug("%s not modified", url)
+        return None
+    if (200 > response.status_code) or (299 < response.status_code):
+        logging.error("Failed to read %s: HTTP STATUS: %s", url,
+                      response.status_code)
+        return None
+    return response
+
+
+def __process_feed(url, base_dir, start_date, validators=None,
+                   latest_title=None):
+    """ Pull down the rss feed and add return episodes.  validators is the
+    (etag, modified, content_hash) tuple from the last time this feed was
+    read.  If the feed has not changed since then no name or episodes are
+    returned, just any new validators to save. """
+    if __is_local(url):
+        # feedparser reads local files itself.  There is nothing to check
+        # them against so they are read every time
+        feed = feedparser.parse(url)
+        new_validators = None
+    else:
+        response = __read_feed(url, validators)
+        if response is None:
+            return None, None, None
+        # a hash of the body spots an unchanged feed even when the server
+        # does not support conditional requests, without parsing it
+        content_hash = hashlib.sha1(response.content).hexdigest()
+        new_validators = (response.headers.get('ETag'),
+                          response.headers.get('Last-Modified'),
+                          content_hash)
+        if validators and validators[2] == content_hash:
+            logging.debug("%s unchanged", url)
+            # the server may have sent new validators for the same content
+            return None, None, new_validators
+        # the headers let feedparser find the character set
+        feed = feedparser.parse(response.content,
+                                response_headers=dict(response.headers))
 
     # some feeds have ill formed entries.  Skip them if they
     # don't have a channel or a title or items
     if 'items' not in feed or 'channel' not in feed or \
        'title' not in feed['channel']:
-        return None, None
+        return None, None, None
 
     # get name and clean out any characters we don't like before we start
     # using it.
@@ -30,85 +91,122 @@ def __process_feed(url, base_dir, start_date):
     # create the podcast directory as long as we're here
     utils.mkdir_p(podcast_path_name)
 
-    episodes = __process_items(feed, podcast_path_name, podcast_name,
-                               start_date)
+    episodes = list(__process_items(feed, podcast_path_name, podcast_name,
+                                    start_date, latest_title))
 
-    return podcast_name, episodes
+    return podcast_name, episodes, new_validators
 
 
-def __process_items(feed, podcast_path_name, podcast_name, start_date):
-    """ Walk the list of items and return the list of episodes generated """
+def __process_items(feed, podcast_path_name, podcast_name, start_date,
+                    latest_title=None):
+    """ Walk the list of items and yield the episodes newer than start_date.
 
-    episodes = list()
+    Most feeds list the newest episode first, so once we reach the newest
+    episode we already have (latest_title, published at start_date) with
+    every item before it in order, there is nothing new left to find and we
+    stop without looking at the rest of the back catalog.  Otherwise we walk
+    all of it, as an item out of order could be anywhere.
+    """
+    newest_first = True
+    previous_date = None
     for feed_data in feed["items"]:
         if 'published' not in feed_data or 'title' not in feed_data or \
            'links' not in feed_data:
             continue  # only pull episodes that have dates
 
-        raw_date = feed_data['published']
-        # remove last word from published date - it's a timezone
-        # and we don't really care about the timezone as most feeds are
-        # likely to remain with the same timezone and we're only using
-        # dates for ordering.
-        raw_date = raw_date.rsplit(' ', 1)[0]
-        try:
-            date = time.strptime(raw_date, "%a, %d %b %Y %X")
-        except ValueError:
-            # having problems with radiolab, which changed its date format to
-            # look like:
-            #    '2015-08-23T17:38:36-04:00'
-            # for now I'm just cutting off more timezone info
-            raw_date = raw_date.rsplit('-', 1)[0]
-            date = time.strptime(raw_date, "%Y-%m-%dT%H:%M:%S")
+        # most feeds use RFC 822 dates but some, like radiolab, use ISO 8601
+        # dates that look like:
+        #    '2015-08-23T17:38:36-04:00'
+        # either way we get the date back in UTC
+        date = dates.parse_feed_date(feed_data['published'])
+        if previous_date and date > previous_date:
+            newest_first = False
+        previous_date = date
+        # make sure as end up with only ascii in the titles.  Not great
+        # for international users, but I"m currently only listening to
+        # english language podcasts.  We'll need something better here
+        # to support other character sets.
+        title = feed_data['title'].encode('ascii', 'replace')
+        # titles with single quotes (') provide an extra challenge for
+        # SQL entries.
+        title = title.replace("'".encode('utf-8'), "''".encode('utf-8'))
         # when comparing,  date None is always the least
         if start_date and start_date >= date:
+            if newest_first and title == latest_title and \
+                    date[:6] == start_date[:6]:
+                logging.debug("Stopping %s at %s", podcast_name,
+                              utils.date_as_string(date))
+                break
             continue
         try:
-            # make sure as end up with only ascii in the titles.  Not great
-            # for international users, but I"m currently only listening to
-            # english language podcasts.  We'll need something better here
-            # to support other character sets.
-            title = feed_data['title'].encode('ascii', 'replace')
-            # titles with single quotes (') provide an extra challenge for
-            # SQL entries.
-            title = title.replace("'".encode('utf-8'), "''".encode('utf-8'))
             # there can be multiple links to a single episode.  We only want
             # the audio one.
             link = None
+            size = None
             for kk in feed_data["links"]:
                 if 'type' in kk and 'audio' in kk['type']:
                     link = kk['href'] or link
+                    # the enclosure length lets downloads be scheduled by
+                    # size.  Feeds often leave it out or send 0
+                    length = str(kk.get('length') or '')
+                    size = int(length) if length.isdigit() else size
             if link:
                 # the memory palace and a few other podcasts have ocassionally
                 # published videos.  My player doesn't support them, and the
                 # above code ends up without a valid link for them.  Skip them
                 # without an error
-                episodes.append(Episode(base_path=podcast_path_name, date=date,
-                                        title=title, url=link,
-                                        podcast=podcast_name))
+                yield Episode(base_path=podcast_path_name, date=date,
+                              title=title, url=link, podcast=podcast_name,
+                              size=size or None)
         except KeyError:
             logging.error("Failed processing feed title")
             raise
-    return episodes
+
+
+def fetch_episodes_from_feed(url, base_dir, start_date=None,
+                             validators=None, latest_title=None):
+    """ Pull down and parse the feed at url without touching the database.
+    This is safe to call from worker threads.  latest_title is the title of
+    the episode we have from start_date.  Returns (name, episodes,
+    validators). """
+    return __process_feed(url, base_dir, start_date, validators,
+                          latest_title)
 
 
 def add_episodes_from_feed(database, url, base_dir, throttle, start_date=None):
     """ Add episodes from url into database. """
-    name, episodes = __process_feed(url, base_dir, start_date)
+    name, episodes, validators = fetch_episodes_from_feed(url, base_dir,
+                                                          start_date)
+    return store_episodes(database, url, throttle, name, episodes,
+                          validators)
+
+
+def store_episodes(database, url, throttle, name, episodes, validators=None):
+    """ Add the episodes fetched from the feed at url into the database.
+    Returns (name, number of episodes added). """
     if not name or not episodes:
+        if validators:
+            database.update_feed_validators(url, validators)
         return None, 0
 
     # adds table for podcast - likely to exist already
     database.add_podcast(name, url, throttle)
+    # dates stored before they were kept in UTC are put right the first
+    # time the feed is read again, and the episodes we already have do not
+    # count against the throttle
+    episodes = database.rebase_local_dates(name, episodes)
 
-    episodes_added = 0
     # sort the episodes so we get the oldest ones first - this is needed for
     # feeds for which we have a throttle value
     episodes.sort(key=lambda x: x.date, reverse=False)
 
     # get either all of the episodes or the throttle limit
-    for index in range(0, min(throttle, len(episodes))):
-        logging.debug("Adding %s", utils.date_as_string(episodes[index].date))
-        if database.add_new_episode_data(name, episodes[index]):
-            episodes_added += 1
+    episodes_added = database.add_new_episodes(name, episodes[:throttle])
+
+    if validators:
+        # if the throttle held some episodes back, the next refresh has to
+        # read the feed again even though it has not changed
+        if len(episodes) > throttle:
+            validators = (None, None, None)
+        database.update_feed_validators(url, validators)
     return name, episodes_added
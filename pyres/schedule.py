@@ -0,0 +1,138 @@
+"""
+Choose the order in which episodes are downloaded.
+
+Episodes come out of the database grouped by podcast, so one podcast with a
+long backlog holds up all the others.  The other schedules get a useful
+episode onto the disk sooner: the smallest files first, the newest episodes
+first, or one episode from each podcast in turn.  Downloads are started in
+the order given, so the schedule decides which episodes finish first.
+
+When the episodes arrive a few at a time, as they do while update reads the
+feeds, the schedule gives instead a sort key for the episodes waiting for a
+download thread.
+"""
+import collections
+import logging
+import threading
+from six.moves import queue, zip_longest
+import requests
+import pyres.httpclient as httpclient
+
+PODCAST = 'podcast'
+SHORTEST = 'shortest'
+NEWEST = 'newest'
+FAIR = 'fair'
+DEFAULT_SCHEDULE = PODCAST
+# number of HEAD requests sent at once to find the size of episodes
+PROBE_WORKERS = 8
+
+
+def by_podcast(episodes):
+    """ Leave the episodes in the order they came from the database """
+    return list(episodes)
+
+
+def _size_key(episode):
+    """ Sort smallest first, then those whose size we do not know """
+    return not episode.size, episode.size or 0
+
+
+def _newest_key(episode):
+    """ Sort the most recently published first """
+    return tuple(-field for field in episode.date[:6])
+
+
+def _turn_key():
+    """ Return a sort key giving the episodes of each podcast turns 0, 1,
+    2... in the order they are queued """
+    turns = collections.defaultdict(int)
+
+    def key(episode):
+        """ the next turn of the episode's podcast """
+        turn = turns[episode.podcast]
+        turns[episode.podcast] += 1
+        return turn
+    return key
+
+
+def shortest_first(episodes):
+    """ Smallest episodes first, then those whose size we do not know """
+    return sorted(episodes, key=_size_key)
+
+
+def newest_first(episodes):
+    """ Most recently published episodes first """
+    return sorted(episodes, key=_newest_key)
+
+
+def round_robin(episodes):
+    """ Take one episode from each podcast in turn, keeping the order of the
+    episodes within each podcast """
+    podcasts = collections.OrderedDict()
+    for episode in episodes:
+        podcasts.setdefault(episode.podcast, []).append(episode)
+    return [episode for turn in zip_longest(*podcasts.values())
+            for episode in turn if episode is not None]
+
+
+SCHEDULES = collections.OrderedDict([
+    (PODCAST, by_podcast),
+    (SHORTEST, shortest_first),
+    (NEWEST, newest_first),
+    (FAIR, round_robin),
+])
+
+
+def _probe(unknown):
+    """ Set the size of each episode in the queue from a HEAD request """
+    while True:
+        try:
+            episode = unknown.get_nowait()
+        except queue.Empty:
+            return
+        try:
+            response = httpclient.head(episode.url)
+        except requests.exceptions.RequestException as err:
+            logging.debug("Could not find size of %s: %s", episode.url, err)
+            continue
+        length = response.headers.get('content-length') or ''
+        if response.status_code == 200 and length.isdigit():
+            episode.size = int(length)
+        response.close()
+
+
+def probe_sizes(episodes, num_workers=PROBE_WORKERS):
+    """ Fill in the size of the episodes which do not know it yet with a
+    HEAD request for each.  Sizes the server does not give stay unknown. """
+    unknown = queue.Queue()
+    for episode in episodes:
+        if not episode.size:
+            unknown.put(episode)
+    threads = [threading.Thread(target=_probe, args=(unknown, ))
+               for _ in range(min(num_workers, unknown.qsize()))]
+    for the_thread in threads:
+        the_thread.start()
+    for the_thread in threads:
+        the_thread.join()
+
+
+def queue_key(name=DEFAULT_SCHEDULE):
+    """ Return the sort key for the named schedule to order the episodes
+    waiting to be downloaded as they arrive, or None to keep them in the
+    order they arrive.  No sizes are probed, so shortest first puts the
+    episodes whose size the feed did not give last. """
+    if name == SHORTEST:
+        return _size_key
+    if name == NEWEST:
+        return _newest_key
+    if name == FAIR:
+        return _turn_key()
+    return None
+
+
+def order_episodes(episodes, name=DEFAULT_SCHEDULE):
+    """ Return the episodes in the order the named schedule downloads them """
+    episodes = list(episodes)
+    if name == SHORTEST:
+        probe_sizes(episodes)
+    return SCHEDULES[name](episodes)
@@ -0,0 +1,346 @@
+""" Test the asyncio download engine against a local web server """
+import json
+import os
+import sys
+import time
+import threading
+import pytest
+from mock import patch
+from mock import Mock
+
+if sys.version_info < (3, 6):
+    pytest.skip("the asyncio engine needs python 3.6", allow_module_level=True)
+
+# pylint: disable=wrong-import-position
+from http.server import HTTPServer, BaseHTTPRequestHandler  # noqa: E402
+from socketserver import ThreadingMixIn  # noqa: E402
+import pyres.asyncdownload  # noqa: E402
+import pyres.diskspace  # noqa: E402
+import pyres.download  # noqa: E402
+import pyres.episode  # noqa: E402
+
+CONTENT = b'0123456789' * 10000
+ETAG = '"v1"'
+# the Range header of each request for /resumable
+RANGES = []
+# each request for /flaky
+FLAKY = []
+
+
+class StandInServer(ThreadingMixIn, HTTPServer):
+    """ Serve each connection on its own thread """
+    daemon_threads = True
+
+
+class StandInHandler(BaseHTTPRequestHandler):
+    """ Serve the paths the tests ask for """
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):  # pylint: disable=invalid-name
+        """ each path tests a different server behavior """
+        handler = self.HANDLERS.get(self.path)
+        if handler is None:
+            self.send_error(404)
+        else:
+            handler(self)
+
+    def _file(self):
+        """ send the whole file """
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(CONTENT)))
+        self.end_headers()
+        self.wfile.write(CONTENT)
+
+    def _chunked(self):
+        """ send the file in chunks """
+        self.send_response(200)
+        self.send_header('Transfer-Encoding', 'chunked')
+        self.end_headers()
+        for start in range(0, len(CONTENT), 30000):
+            chunk = CONTENT[start:start + 30000]
+            self.wfile.write(b'%x\r\n%s\r\n' % (len(chunk), chunk))
+        self.wfile.write(b'0\r\n\r\n')
+
+    def _redirect(self):
+        """ send the client to /file """
+        self.send_response(302)
+        self.send_header('Location', '/file')
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def _resumable(self):
+        """ send the rest of the file when asked for a range """
+        RANGES.append(self.headers.get('Range'))
+        start = 0
+        if self.headers.get('If-Range') == ETAG:
+            start = int(self.headers['Range'].split('=')[1].rstrip('-'))
+        self.send_response(206 if start else 200)
+        if start:
+            self.send_header('Content-Range', 'bytes %d-%d/%d' %
+                             (start, len(CONTENT) - 1, len(CONTENT)))
+        self.send_header('Content-Length', str(len(CONTENT) - start))
+        self.send_header('ETag', ETAG)
+        self.end_headers()
+        self.wfile.write(CONTENT[start:])
+
+    def _flaky(self):
+        """ fail every other request """
+        FLAKY.append(self.path)
+        if len(FLAKY) % 2:
+            self.send_error(503)
+            return
+        self._file()
+
+    def _slow(self):
+        """ the body only comes after the client has given up """
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(CONTENT)))
+        self.end_headers()
+        self.wfile.flush()
+        time.sleep(2)
+        self.wfile.write(CONTENT)
+
+    def _short(self):
+        """ close the connection part way through the file """
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(CONTENT)))
+        self.end_headers()
+        self.wfile.write(CONTENT[:100])
+        self.close_connection = True
+
+    HANDLERS = {
+        '/file': _file,
+        '/%E2%82%AC%20file?q=%C3%A9': _file,
+        '/chunked': _chunked,
+        '/redirect': _redirect,
+        '/resumable': _resumable,
+        '/flaky': _flaky,
+        '/slow': _slow,
+        '/short': _short,
+    }
+
+    def log_message(self, *_):  # pylint: disable=arguments-differ
+        """ keep the test output quiet """
+        pass
+
+
+@pytest.fixture(autouse=True)
+def no_retry_wait():
+    """ Retry failed downloads straight away """
+    with patch('pyres.retry.RETRY_DELAY', 0.001):
+        yield
+
+
+@pytest.fixture(scope='module')
+def server():
+    """ Run a web server in a thread and return its base url """
+    httpd = StandInServer(('127.0.0.1', 0), StandInHandler)
+    the_thread = threading.Thread(target=httpd.serve_forever)
+    the_thread.daemon = True
+    the_thread.start()
+    yield 'http://127.0.0.1:%d' % httpd.server_address[1]
+    httpd.shutdown()
+    httpd.server_close()
+
+
+def make_episodes(server_url, tmpdir, paths):
+    """ Build an episode for each path """
+    return [pyres.episode.Episode(date=time.localtime(), title=path + str(i),
+                                  url=server_url + path, podcast='podcast',
+                                  file_name=str(tmpdir.join('%d.mp3' % i)))
+            for i, path in enumerate(paths)]
+
+
+class TestAsyncDownload(object):
+    """ test the AsyncPodcastDownloader class """
+
+    # pylint: disable=W0621
+    @pytest.mark.parametrize("path", ['/file', '/chunked', '/redirect'])
+    def test_download(self, server, tmpdir, path):
+        """ the file is written and reported as successful """
+        assert self
+        episodes = make_episodes(server, tmpdir, [path])
+        downloader = pyres.asyncdownload.AsyncPodcastDownloader(episodes)
+        downloader.download_url_list()
+        assert downloader.return_successful_files() == episodes
+        assert downloader.return_failed_files() == []
+        assert episodes[0].size == len(CONTENT)
+        with open(episodes[0].file_name, 'rb') as podcast_file:
+            assert podcast_file.read() == CONTENT
+
+    @pytest.mark.parametrize("path", ['/missing', '/short'])
+    def test_failure(self, server, tmpdir, path):
+        """ bad status and truncated files are reported as failed """
+        assert self
+        episodes = make_episodes(server, tmpdir, [path])
+        downloader = pyres.asyncdownload.AsyncPodcastDownloader(episodes)
+        downloader.download_url_list()
+        assert downloader.return_successful_files() == []
+        assert downloader.return_failed_files() == episodes
+        assert episodes[0].error_msg
+
+    def test_unicode_url(self, server, tmpdir):
+        """ characters the request line cannot hold are escaped """
+        assert self
+        episodes = make_episodes(server, tmpdir, [u'/\u20ac file?q=\xe9'])
+        downloader = pyres.asyncdownload.AsyncPodcastDownloader(episodes)
+        downloader.download_url_list()
+        assert downloader.return_successful_files() == episodes
+
+    def test_unexpected_error(self, server, tmpdir):
+        """ an unexpected error fails just the one episode """
+        assert self
+        episodes = make_episodes(server, tmpdir, ['/file', '/file'])
+        real_bytes_to_come = pyres.asyncdownload.bytes_to_come
+
+        def bytes_to_come(episode, *args):
+            """ the first episode hits a bug """
+            if episode is episodes[0]:
+                raise RuntimeError("bug")
+            return real_bytes_to_come(episode, *args)
+
+        with patch('pyres.asyncdownload.bytes_to_come', bytes_to_come):
+            downloader = pyres.asyncdownload.AsyncPodcastDownloader(episodes)
+            downloader.download_url_list()
+        assert downloader.return_failed_files() == episodes[:1]
+        assert downloader.return_successful_files() == episodes[1:]
+
+    def test_bad_url(self, tmpdir):
+        """ a url which cannot be opened is reported as failed """
+        assert self
+        episodes = make_episodes('nothttp://x', tmpdir, ['/file'])
+        downloader = pyres.asyncdownload.AsyncPodcastDownloader(episodes)
+        downloader.download_url_list()
+        assert downloader.return_failed_files() == episodes
+
+    def test_retry(self, server, tmpdir):
+        """ a server error is tried again in the same run """
+        assert self
+        del FLAKY[:]
+        episodes = make_episodes(server, tmpdir, ['/flaky'])
+        downloader = pyres.asyncdownload.AsyncPodcastDownloader(episodes)
+        downloader.download_url_list()
+        assert len(FLAKY) == 2
+        assert downloader.return_successful_files() == episodes
+        assert downloader.return_failed_files() == []
+
+    def test_retry_frees_slot(self, server, tmpdir):
+        """ an episode waiting to be tried again does not hold its slot """
+        assert self
+        del FLAKY[:]
+        episodes = make_episodes(server, tmpdir, ['/flaky', '/file'])
+        with patch('pyres.retry.RETRY_DELAY', 0.5):
+            downloader = pyres.asyncdownload.AsyncPodcastDownloader(episodes,
+                                                                    1)
+            downloader.download_url_list()
+        assert downloader.return_successful_files() == episodes[::-1]
+
+    def test_many(self, server, tmpdir):
+        """ more episodes than download slots are all fetched """
+        assert self
+        paths = ['/file', '/chunked', '/missing'] * 5
+        episodes = make_episodes(server, tmpdir, paths)
+        downloader = pyres.asyncdownload.AsyncPodcastDownloader(episodes, 4)
+        assert downloader.num_threads == 4
+        downloader.download_url_list()
+        assert len(downloader.return_successful_files()) == 10
+        assert len(downloader.return_failed_files()) == 5
+
+    def test_deferred(self, server, tmpdir):
+        """ an episode which does not fit on the disk is deferred, not
+        failed """
+        assert self
+        episodes = make_episodes(server, tmpdir, ['/file'])
+        disk = pyres.diskspace.DiskSpace(reserve=0, free=lambda _: 100)
+        downloader = pyres.asyncdownload.AsyncPodcastDownloader(episodes,
+                                                                disk=disk)
+        downloader.download_url_list()
+        assert downloader.return_deferred_files() == episodes
+        assert downloader.return_failed_files() == []
+        assert not os.path.exists(episodes[0].file_name)
+
+    @pytest.mark.parametrize("etag, expected", [
+        (ETAG, 'bytes=1000-'), ('"old"', 'bytes=1000-'), (None, None)])
+    def test_resume(self, server, tmpdir, etag, expected):
+        """ an interrupted download continues from the end of the part file
+        if the file has not changed on the server """
+        assert self
+        episodes = make_episodes(server, tmpdir, ['/resumable'])
+        part_name = episodes[0].file_name + '.part'
+        with open(part_name, 'wb') as part_file:
+            part_file.write(CONTENT[:1000])
+        with open(part_name + '.json', 'w') as state_file:
+            json.dump({'url': episodes[0].url, 'etag': etag}, state_file)
+
+        del RANGES[:]
+        downloader = pyres.asyncdownload.AsyncPodcastDownloader(episodes)
+        downloader.download_url_list()
+        assert RANGES == [expected]
+        assert downloader.return_successful_files() == episodes
+        with open(episodes[0].file_name, 'rb') as podcast_file:
+            assert podcast_file.read() == CONTENT
+        assert not os.path.exists(part_name)
+        assert not os.path.exists(part_name + '.json')
+
+    def test_writes_off_loop(self, server, tmpdir):
+        """ the part file is written from the thread pool, not the thread
+        running the event loop """
+        assert self
+        episodes = make_episodes(server, tmpdir, ['/file'])
+        writers = set()
+        real_write = pyres.download.PartFile.write
+
+        def write(part_file, block):
+            """ note which thread is writing """
+            writers.add(threading.current_thread())
+            real_write(part_file, block)
+
+        with patch('pyres.download.PartFile.write', write):
+            downloader = pyres.asyncdownload.AsyncPodcastDownloader(episodes)
+            downloader.download_url_list()
+        assert downloader.return_successful_files() == episodes
+        assert writers
+        assert threading.current_thread() not in writers
+
+    def test_interrupted(self, server, tmpdir):
+        """ the downloads still running when the run is interrupted are
+        cancelled and allowed to close their connections and files """
+        assert self
+        episodes = make_episodes(server, tmpdir, ['/slow'] * 3)
+        real_bytes_to_come = pyres.asyncdownload.bytes_to_come
+        started = []
+
+        def bytes_to_come(episode, *args):
+            """ Ctrl-C once every download has its response """
+            started.append(episode)
+            if len(started) == len(episodes):
+                raise KeyboardInterrupt()
+            return real_bytes_to_come(episode, *args)
+
+        closed = []
+        real_close = pyres.asyncdownload.Response.close
+
+        def close(response):
+            """ note each connection closed """
+            closed.append(response.url)
+            real_close(response)
+
+        with patch('pyres.asyncdownload.bytes_to_come', bytes_to_come), \
+                patch('pyres.asyncdownload.Response.close', close):
+            downloader = pyres.asyncdownload.AsyncPodcastDownloader(episodes)
+            with pytest.raises(KeyboardInterrupt):
+                downloader.download_url_list()
+        assert len(closed) == len(episodes)
+
+    def test_recorder_ticked(self, server, tmpdir):
+        """ the recorder is given the chance to commit while downloads are
+        running """
+        assert self
+        episodes = make_episodes(server, tmpdir, ['/file'])
+        recorder = Mock()
+        with patch('pyres.asyncdownload.EVENT_TIMEOUT', 0):
+            downloader = pyres.asyncdownload.AsyncPodcastDownloader(
+                episodes, recorder=recorder)
+            downloader.download_url_list()
+        recorder.downloaded.assert_called_once_with(episodes[0])
+        assert recorder.tick.called
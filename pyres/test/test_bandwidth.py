@@ -0,0 +1,83 @@
+""" Test the bandwidth module """
+import pytest
+from pyres.bandwidth import TokenBucket
+from pyres.bandwidth import Bandwidth
+
+
+class Clock(object):  # pylint: disable=too-few-public-methods
+    """ A clock the tests can move forward """
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def clock():
+    """ Provide a fake clock """
+    return Clock()
+
+
+class TestTokenBucket(object):
+    """ test the TokenBucket class """
+
+    def test_burst(self, clock):  # pylint: disable=W0621
+        """ the first burst is free then readers wait """
+        assert self
+        bucket = TokenBucket(100, clock=clock)
+        assert bucket.reserve(100) == 0
+        assert bucket.reserve(50) == pytest.approx(0.5)
+        # the debt is paid off as time passes
+        clock.now += 1.5
+        assert bucket.reserve(100) == 0
+
+    def test_capacity(self, clock):  # pylint: disable=W0621
+        """ idle time does not save up more than one burst """
+        assert self
+        bucket = TokenBucket(100, burst=200, clock=clock)
+        clock.now += 60
+        assert bucket.reserve(200) == 0
+        assert bucket.reserve(100) == pytest.approx(1.0)
+
+
+class TestBandwidth(object):
+    """ test the Bandwidth class """
+
+    def test_unlimited(self, clock):  # pylint: disable=W0621
+        """ with no limits nobody waits but bytes are counted """
+        assert self
+        bandwidth = Bandwidth(clock=clock)
+        assert bandwidth.reserve('host', 10 ** 9) == 0
+        clock.now += 2
+        assert bandwidth.reserve('host', 10 ** 9) == 0
+        assert bandwidth.throughput() == pytest.approx(10 ** 9)
+
+    def test_global_limit(self, clock):  # pylint: disable=W0621
+        """ all hosts share the global limit """
+        assert self
+        bandwidth = Bandwidth(rate=100, clock=clock)
+        assert bandwidth.reserve('one', 100) == 0
+        assert bandwidth.reserve('two', 100) == pytest.approx(1.0)
+
+    def test_host_limit(self, clock):  # pylint: disable=W0621
+        """ each host has its own limit """
+        assert self
+        bandwidth = Bandwidth(rate=1000, host_rate=100, clock=clock)
+        assert bandwidth.reserve('one', 100) == 0
+        assert bandwidth.reserve('two', 100) == 0
+        assert bandwidth.reserve('one', 100) == pytest.approx(1.0)
+
+    def test_throughput(self, clock):  # pylint: disable=W0621
+        """ throughput is reported per host and in total """
+        assert self
+        bandwidth = Bandwidth(clock=clock)
+        bandwidth.reserve('one', 100)
+        bandwidth.reserve('two', 100)
+        clock.now += 10
+        bandwidth.reserve('one', 900)
+        assert bandwidth.hosts() == ['one', 'two']
+        assert bandwidth.throughput('one') == pytest.approx(100)
+        assert bandwidth.throughput('two') == 0
+        assert bandwidth.throughput('three') == 0
+        assert bandwidth.throughput() == pytest.approx(110)
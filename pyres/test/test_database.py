@@ -7,6 +7,9 @@ import pytest
 import sqlite3
 import time
 from pyres.database import PodcastDatabase
+from pyres.database import CURRENT_VERSION
+from pyres.rss import store_episodes
+from pyres.database import FAILED_STATE
 import pyres.episode
 from mock import patch
 
@@ -62,6 +65,19 @@ def add_and_check(database, table_name, episode, expected=1):
     assert len(eps) == 0
 
 
+def remove_local_dates(connection):
+    """ take the local_dates column back out of the podcasts table as it was
+    not there before version 8 """
+    connection.execute("CREATE TABLE old (id integer primary key, "
+                       "name text unique, url text unique, needsfix bool, "
+                       "throttle int, etag text, modified text, "
+                       "content_hash text)")
+    connection.execute("INSERT INTO old SELECT id, name, url, needsfix, "
+                       "throttle, etag, modified, content_hash FROM podcasts")
+    connection.execute("DROP TABLE podcasts")
+    connection.execute("ALTER TABLE old RENAME TO podcasts")
+
+
 class TestOpen(object):
     """ test the open functionality """
 
@@ -88,6 +104,28 @@ class TestOpen(object):
             PodcastDatabase(emptyfile)
         os.chmod(emptyfile, stat.S_IWRITE)
 
+    @pytest.mark.parametrize("profile, journal, synchronous", [
+        ('default', 'delete', 2), ('fast', 'wal', 1),
+    ])
+    def test_profile(self, emptyfile, profile, journal,
+                     synchronous):  # pylint: disable=W0621
+        """ the performance profile is applied when the database opens """
+        assert self
+        with PodcastDatabase(emptyfile, profile) as _database:
+            cursor = _database.cursor
+            assert cursor.execute("PRAGMA journal_mode").fetchone()[0] == \
+                journal
+            assert cursor.execute("PRAGMA synchronous").fetchone()[0] == \
+                synchronous
+            _database.add_podcast('name', 'url', sys.maxsize)
+        with PodcastDatabase(emptyfile) as _database:
+            assert _database.get_podcast_names() == ['name']
+
+    def test_bad_profile(self, emptyfile):  # pylint: disable=W0621
+        """ an unknown profile name is an error """
+        assert self
+        pytest.raises(KeyError, PodcastDatabase, emptyfile, 'bogus')
+
     def test_empty_params(self):
         """ Testing no parameters to open"""
         assert self
@@ -313,6 +351,49 @@ class TestAddEpisode(object):
             episode.url = save
 
 
+class TestAddEpisodes(object):
+    """ Test adding a batch of episodes """
+    @staticmethod
+    def make_episodes(count, podcast='name'):
+        """ Utility to build a list of episodes with unique titles """
+        return [pyres.episode.Episode(base_path='path',
+                                      date=time.localtime(),
+                                      title='title%d' % index,
+                                      url='link%d' % index,
+                                      podcast=podcast)
+                for index in range(count)]
+
+    def test_count_new_only(self, emptyfile):  # pylint: disable=W0621
+        """ only episodes which are really new are counted """
+        assert self
+        with PodcastDatabase(emptyfile) as _database:
+            _database.add_podcast('name', 'url', sys.maxsize)
+            assert _database.add_new_episodes('name', []) == 0
+            episodes = self.make_episodes(5)
+            assert _database.add_new_episodes('name', episodes[:3]) == 3
+            # three are already there
+            assert _database.add_new_episodes('name', episodes) == 2
+            assert _database.add_new_episodes('name', episodes) == 0
+            assert len(_database.find_episodes_to_download('name')) == 5
+
+    def test_bad_episodes_skipped(self, emptyfile):  # pylint: disable=W0621
+        """ ill-formed episodes are left out of the batch """
+        assert self
+        with PodcastDatabase(emptyfile) as _database:
+            _database.add_podcast('name', 'url', sys.maxsize)
+            episodes = self.make_episodes(3)
+            episodes[1].title = None
+            assert _database.add_new_episodes('name', episodes) == 2
+
+    def test_bad_podcast(self, emptyfile):  # pylint: disable=W0621
+        """ adding to a podcast which does not exist raises """
+        assert self
+        with PodcastDatabase(emptyfile) as _database:
+            pytest.raises(sqlite3.OperationalError,
+                          _database.add_new_episodes, 'name',
+                          self.make_episodes(1))
+
+
 class TestState(object):
     """ test functions to modify state and sort based on state """
     @staticmethod
@@ -376,6 +457,127 @@ class TestState(object):
             self.check_download_and_copy_counts(_database, 2, 0)
 
 
+class TestIterEpisodes(object):
+    """ test the queries across all podcasts """
+    def test_iter_and_count(self, filledfile):  # pylint: disable=W0621
+        """ episodes from every podcast come back from one query """
+        assert self
+        with PodcastDatabase(filledfile) as _database:
+            _database.add_podcast('another', 'url2', sys.maxsize)
+            episode = pyres.episode.Episode(
+                base_path='path', date=time.strptime('2015/4/1', "%Y/%m/%d"),
+                title='other', url='link', podcast='another')
+            add_and_check(_database, 'another', episode)
+
+            assert _database.count_episodes(0) == [('another', 1),
+                                                   (_FILLED_TABLE_NAME, 2)]
+            assert _database.count_episodes(1) == []
+
+            episodes = _database.iter_episodes(0)
+            assert not isinstance(episodes, list)
+            episodes = list(episodes)
+            assert [ep.title for ep in episodes] == ['other', 'title',
+                                                     'title2']
+            assert [ep.podcast for ep in episodes] == [
+                'another', _FILLED_TABLE_NAME, _FILLED_TABLE_NAME]
+            assert episodes[1].date == time.strptime('2015/4/19', "%Y/%m/%d")
+
+            by_podcast = list(_database.iter_episodes(0, order_by='podcast'))
+            assert [ep.title for ep in by_podcast] == ['other', 'title',
+                                                       'title2']
+
+            # change state while walking the results
+            for episode in _database.iter_episodes(0):
+                _database.mark_episode_downloaded(episode)
+            assert list(_database.iter_episodes(0)) == []
+            assert _database.count_episodes(1) == [('another', 1),
+                                                   (_FILLED_TABLE_NAME, 2)]
+
+    def test_failed_downloads(self, filledfile):  # pylint: disable=W0621
+        """ failed episodes wait for their next attempt or are given up """
+        assert self
+        with PodcastDatabase(filledfile) as _database:
+            (first, second) = list(_database.iter_episodes(0))
+            first.attempts = 1
+            first.error_class = 'timeout'
+            _database.mark_episode_failed(first, 1000.0)
+            second.attempts = 3
+            second.error_class = '4xx'
+            _database.mark_episode_failed(second, None)
+
+            # the given up episode is no longer waiting to download
+            assert [ep.title for ep in _database.iter_episodes(0)] == \
+                ['title']
+            assert [ep.title for ep in
+                    _database.iter_episodes(FAILED_STATE)] == ['title2']
+            # the other has to wait until its next attempt
+            assert list(_database.iter_episodes(0, ready_at=999.0)) == []
+            ready = list(_database.iter_episodes(0, ready_at=1000.0))
+            assert [ep.attempts for ep in ready] == [1]
+            row = _database.cursor.execute(
+                "SELECT last_error, next_attempt FROM episodes WHERE "
+                "title = 'title'").fetchone()
+            assert tuple(row) == ('timeout', 1000.0)
+
+            # a successful download clears the record of failures
+            _database.mark_episode_downloaded(ready[0])
+            row = _database.cursor.execute(
+                "SELECT attempts, last_error, next_attempt FROM episodes "
+                "WHERE title = 'title'").fetchone()
+            assert tuple(row) == (0, None, None)
+
+    def test_hashes(self, filledfile):  # pylint: disable=W0621
+        """ the hash of a download is kept to find the same file again """
+        assert self
+        with PodcastDatabase(filledfile) as _database:
+            (first, second) = list(_database.iter_episodes(0))
+            first.hash = second.hash = 'abc'
+            assert _database.find_files_with_hash(second) == []
+            _database.mark_episode_downloaded(first)
+            assert _database.find_files_with_hash(second) == [first.file_name]
+            # an episode is not a copy of itself
+            assert _database.find_files_with_hash(first) == []
+            assert [ep.hash for ep in _database.iter_episodes(1)] == ['abc']
+            second.hash = None
+            assert _database.find_files_with_hash(second) == []
+
+    def test_durations(self, filledfile):  # pylint: disable=W0621
+        """ the duration is stored with the download or filled in later """
+        assert self
+        with PodcastDatabase(filledfile) as _database:
+            (first, second) = list(_database.iter_episodes(0))
+            first.duration = 61.5
+            _database.mark_episode_downloaded(first)
+            _database.mark_episode_downloaded(second)
+            _database.set_episode_duration(second, 30.0)
+            assert [ep.duration for ep in _database.iter_episodes(1)] == \
+                [61.5, 30.0]
+
+    def test_one_podcast(self, filledfile):  # pylint: disable=W0621
+        """ the episodes of just one podcast can be asked for """
+        assert self
+        with PodcastDatabase(filledfile) as _database:
+            _database.add_podcast('other', 'url2', sys.maxsize)
+            _database.add_new_episode_data('other', pyres.episode.Episode(
+                base_path='path', date=time.localtime(), title='other',
+                url='link', podcast='other'))
+            assert len(list(_database.iter_episodes(0))) == 3
+            assert [ep.title for ep in _database.iter_episodes(
+                0, podcast='other')] == ['other']
+            assert [ep.title for ep in _database.iter_episodes(
+                0, ready_at=time.time(), podcast=_FILLED_TABLE_NAME)] == \
+                ['title', 'title2']
+
+    def test_state_index(self, filledfile):  # pylint: disable=W0621
+        """ the state query does not scan the whole table """
+        assert self
+        with PodcastDatabase(filledfile) as _database:
+            plan = _database.cursor.execute(
+                "EXPLAIN QUERY PLAN SELECT * FROM episodes WHERE state = 0 "
+                "ORDER BY date").fetchall()
+            assert 'episodes_by_state' in str(plan)
+
+
 class TestGetUrls(object):
     """ test the Get Urls method """
     def test_on_empty_file(self, emptyfile):  # pylint: disable=W0621
@@ -394,6 +596,29 @@ class TestGetUrls(object):
             names = _database.get_podcast_urls()
             assert len(names) == 1
 
+    def test_latest_date(self, filledfile):  # pylint: disable=W0621
+        """ the newest episode date is returned for each podcast """
+        assert self
+        with PodcastDatabase(filledfile) as _database:
+            _database.add_podcast('another', 'url2', 3)
+            episode = pyres.episode.Episode(
+                base_path='path', date=time.strptime('2016/1/2', "%Y/%m/%d"),
+                title='other', url='link', podcast='another')
+            add_and_check(_database, 'another', episode)
+            names = _database.get_podcast_urls()
+            assert names == [
+                ['url2', 3, time.strptime('2016/1/2', "%Y/%m/%d"), 'other'],
+                ['url', sys.maxsize, time.strptime('2015/4/20', "%Y/%m/%d"),
+                 'title2'],
+            ]
+
+            # the latest episode uses the date index rather than a sort
+            plan = _database.cursor.execute(
+                "EXPLAIN QUERY PLAN SELECT rowid FROM episodes WHERE "
+                "podcast_id = 1 ORDER BY date DESC LIMIT 1").fetchall()
+            assert 'TEMP B-TREE' not in str(plan)
+            assert 'episodes_date' in str(plan)
+
     def test_on_podcast_no_episode(self, emptyfile):  # pylint: disable=W0621
         """ tests on a podcast without episodes """
         assert self
@@ -451,5 +676,252 @@ class TestConvertVersion(object):
         with PodcastDatabase(filledfile) as _database:
             assert _database
             with patch('pyres.database.sys.exit') as exit_mock:
-                _database.convert_to_new_version(0, 2)
+                _database.convert_to_new_version(0, 99)
                 assert exit_mock.called
+
+    def test_convert_from_version_1(self, emptyfile):  # pylint: disable=W0621
+        """  a version 1 database picks up the feed validator columns """
+        assert self
+        connection = sqlite3.connect(emptyfile)
+        connection.execute("CREATE TABLE podcasts (name text, "
+                           "url text unique, needsfix bool, throttle int)")
+        connection.execute("INSERT INTO podcasts VALUES ('name', 'url', 0, "
+                           "5)")
+        connection.execute("PRAGMA user_version = 1")
+        connection.commit()
+        connection.close()
+
+        with PodcastDatabase(emptyfile) as _database:
+            assert _database.get_podcast_names() == ['name']
+            assert _database.get_feed_validators() == {}
+            _database.update_feed_validators('url', ('tag', None, 'hash'))
+            assert _database.get_feed_validators() == {
+                'url': ('tag', None, 'hash')}
+
+    def test_convert_from_version_2(self, emptyfile):  # pylint: disable=W0621
+        """  the per podcast tables are merged into the episodes table """
+        assert self
+        connection = sqlite3.connect(emptyfile)
+        connection.execute("CREATE TABLE podcasts (name text, "
+                           "url text unique, needsfix bool, throttle int, "
+                           "etag text, modified text, content_hash text)")
+        for name in ('one', 'two'):
+            connection.execute("INSERT INTO podcasts VALUES (?, ?, 0, 5, "
+                               "'tag', NULL, 'hash')", (name, 'url' + name))
+            connection.execute("CREATE TABLE '%s' (date text, title text "
+                               "unique, file text, url text, size integer, "
+                               "state integer)" % name)
+            connection.execute("INSERT INTO '%s' VALUES "
+                               "('2015/04/19:00:00:00', 'title', 'file', "
+                               "'link', 10, 0)" % name)
+            connection.execute("INSERT INTO '%s' VALUES "
+                               "('2015/04/20:00:00:00', 'title2', 'file2', "
+                               "'link2', 10, 1)" % name)
+        connection.execute("PRAGMA user_version = 2")
+        connection.commit()
+        connection.close()
+
+        with PodcastDatabase(emptyfile) as _database:
+            assert _database.get_podcast_names() == ['one', 'two']
+            assert _database.get_feed_validators() == {
+                'urlone': ('tag', None, 'hash'),
+                'urltwo': ('tag', None, 'hash')}
+            for name in ('one', 'two'):
+                to_download = _database.find_episodes_to_download(name)
+                assert [ep.title for ep in to_download] == ['title']
+                to_copy = _database.find_episodes_to_copy(name)
+                assert [ep.title for ep in to_copy] == ['title2']
+
+        connection = sqlite3.connect(emptyfile)
+        tables = [row[0] for row in connection.execute(
+            "SELECT name FROM sqlite_master WHERE type = 'table' ORDER BY "
+            "name")]
+        version = connection.execute("PRAGMA user_version").fetchone()[0]
+        connection.close()
+        assert tables == ['episodes', 'podcasts']
+        assert version == CURRENT_VERSION
+
+    def test_convert_from_version_4(self, filledfile):  # pylint: disable=W0621
+        """  a version 4 database picks up the retry columns """
+        assert self
+        # take the columns back out as they were not there in version 4
+        connection = sqlite3.connect(filledfile)
+        remove_local_dates(connection)
+        connection.execute("CREATE TABLE old AS SELECT podcast_id, date, "
+                           "title, file, url, size, state FROM episodes")
+        connection.execute("DROP TABLE episodes")
+        connection.execute("ALTER TABLE old RENAME TO episodes")
+        connection.execute("PRAGMA user_version = 4")
+        connection.commit()
+        connection.close()
+
+        with PodcastDatabase(filledfile) as _database:
+            episodes = list(_database.iter_episodes(0, ready_at=time.time()))
+            assert [ep.attempts for ep in episodes] == [0, 0]
+
+    def test_convert_from_version_5(self, filledfile):  # pylint: disable=W0621
+        """  a version 5 database picks up the hash column """
+        assert self
+        # take the column back out as it was not there in version 5
+        connection = sqlite3.connect(filledfile)
+        remove_local_dates(connection)
+        connection.execute("CREATE TABLE old AS SELECT podcast_id, date, "
+                           "title, file, url, size, state, attempts, "
+                           "last_error, next_attempt FROM episodes")
+        connection.execute("DROP TABLE episodes")
+        connection.execute("ALTER TABLE old RENAME TO episodes")
+        connection.execute("PRAGMA user_version = 5")
+        connection.commit()
+        connection.close()
+
+        with PodcastDatabase(filledfile) as _database:
+            episodes = list(_database.iter_episodes(0))
+            assert [ep.hash for ep in episodes] == [None, None]
+
+    def test_convert_from_version_6(self, filledfile):  # pylint: disable=W0621
+        """  a version 6 database picks up the duration column """
+        assert self
+        # take the column back out as it was not there in version 6
+        connection = sqlite3.connect(filledfile)
+        remove_local_dates(connection)
+        connection.execute("CREATE TABLE old AS SELECT podcast_id, date, "
+                           "title, file, url, size, state, attempts, "
+                           "last_error, next_attempt, hash FROM episodes")
+        connection.execute("DROP TABLE episodes")
+        connection.execute("ALTER TABLE old RENAME TO episodes")
+        connection.execute("PRAGMA user_version = 6")
+        connection.commit()
+        connection.close()
+
+        with PodcastDatabase(filledfile) as _database:
+            episodes = list(_database.iter_episodes(0))
+            assert [ep.duration for ep in episodes] == [None, None]
+
+    def test_convert_from_version_7(self, filledfile):  # pylint: disable=W0621
+        """  a version 7 database already has its dates in UTC """
+        assert self
+        connection = sqlite3.connect(filledfile)
+        remove_local_dates(connection)
+        connection.execute("PRAGMA user_version = 7")
+        connection.commit()
+        connection.close()
+
+        with PodcastDatabase(filledfile) as _database:
+            (podcast, ) = _database.get_podcast_urls()
+            assert podcast[2] == time.strptime('2015/4/20', "%Y/%m/%d")
+            assert podcast[3] == 'title2'
+
+    def test_convert_from_version_8(self, filledfile):  # pylint: disable=W0621
+        """  durations found by a version 8 database are found again """
+        assert self
+        connection = sqlite3.connect(filledfile)
+        connection.execute("UPDATE episodes SET duration = 500")
+        connection.execute("PRAGMA user_version = 8")
+        connection.commit()
+        connection.close()
+
+        with PodcastDatabase(filledfile) as _database:
+            episodes = list(_database.iter_episodes(0))
+            assert [ep.duration for ep in episodes] == [None, None]
+
+
+class TestLocalDates(object):
+    """ test putting right the dates stored before they were in UTC """
+    def test_upgrade_from_version_1(self, emptyfile):  # pylint: disable=W0621
+        """ the dates of an old database are rebased the first time its
+        feed is read """
+        assert self
+        connection = sqlite3.connect(emptyfile)
+        connection.execute("CREATE TABLE podcasts (name text, "
+                           "url text unique, needsfix bool, throttle int)")
+        connection.execute("INSERT INTO podcasts VALUES ('pod', 'url', 0, "
+                           "1)")
+        connection.execute("CREATE TABLE 'pod' (date text, title text "
+                           "unique, file text, url text, size integer, "
+                           "state integer)")
+        # published at 04:47:53 UTC but stored as the feed's local time
+        connection.execute("INSERT INTO 'pod' VALUES ('2015/05/20:00:47:53', "
+                           "'old', 'file', 'link', 10, 1)")
+        connection.execute("PRAGMA user_version = 1")
+        connection.commit()
+        connection.close()
+
+        with PodcastDatabase(emptyfile) as _database:
+            # nothing published since the episode we have can be missed
+            (podcast, ) = _database.get_podcast_urls()
+            assert podcast[2] == time.strptime('2015/05/19 10:47:53',
+                                               "%Y/%m/%d %H:%M:%S")
+            assert podcast[3] is None
+
+            # the old episode read again is not new, even with a throttle
+            feed = [pyres.episode.Episode(
+                base_path='path', title=title, url='link', podcast='pod',
+                date=time.strptime(date, "%Y/%m/%d %H:%M:%S"))
+                    for title, date in (('old', '2015/05/20 04:47:53'),
+                                        ('new', '2015/05/20 06:00:00'))]
+            assert store_episodes(_database, 'url', 1, 'pod', feed) == \
+                ('pod', 1)
+            assert [ep.title for ep in _database.iter_episodes(0)] == \
+                ['new']
+            assert [ep.date for ep in _database.iter_episodes(1)] == \
+                [feed[0].date]
+
+            # once put right the dates are used as they are
+            (podcast, ) = _database.get_podcast_urls()
+            assert podcast[2] == feed[1].date
+            assert podcast[3] == 'new'
+            assert _database.rebase_local_dates('pod', feed) == feed
+
+    def test_new_podcast(self, emptyfile):  # pylint: disable=W0621
+        """ a podcast added since dates were kept in UTC is left alone """
+        assert self
+        with PodcastDatabase(emptyfile) as _database:
+            _database.add_podcast('pod', 'url', 1)
+            feed = [pyres.episode.Episode(
+                base_path='path', title='title', url='link', podcast='pod',
+                date=time.localtime())]
+            assert _database.rebase_local_dates('pod', feed) == feed
+
+
+class TestSchema(object):
+    """ test the layout of a new database """
+    def test_no_table_per_podcast(self, filledfile):  # pylint: disable=W0621
+        """ episodes live in one indexed table no matter how many podcasts """
+        assert self
+        with PodcastDatabase(filledfile) as _database:
+            _database.add_podcast('another', 'url2', sys.maxsize)
+
+        connection = sqlite3.connect(filledfile)
+        tables = [row[0] for row in connection.execute(
+            "SELECT name FROM sqlite_master WHERE type = 'table' ORDER BY "
+            "name")]
+        indexes = [row[0] for row in connection.execute(
+            "SELECT name FROM sqlite_master WHERE type = 'index' AND "
+            "sql IS NOT NULL ORDER BY name")]
+        plan = connection.execute(
+            "EXPLAIN QUERY PLAN SELECT * FROM episodes WHERE podcast_id = 1 "
+            "AND state = 0").fetchall()
+        connection.close()
+        assert tables == ['episodes', 'podcasts']
+        assert indexes == ['episodes_by_state', 'episodes_date',
+                           'episodes_hash', 'episodes_state']
+        assert 'episodes_state' in str(plan)
+
+
+class TestFeedValidators(object):
+    """ test saving the feed cache validators """
+    def test_round_trip(self, emptyfile):  # pylint: disable=W0621
+        """ validators are saved per podcast url """
+        assert self
+        with PodcastDatabase(emptyfile) as _database:
+            _database.add_podcast('one', 'url1', sys.maxsize)
+            _database.add_podcast('two', 'url2', sys.maxsize)
+            assert _database.get_feed_validators() == {}
+
+            _database.update_feed_validators('url1', ('etag', 'date', 'hash'))
+            assert _database.get_feed_validators() == {
+                'url1': ('etag', 'date', 'hash')}
+
+            # clearing them removes the podcast from the dict
+            _database.update_feed_validators('url1', (None, None, None))
+            assert _database.get_feed_validators() == {}
@@ -0,0 +1,83 @@
+""" Test the dates module """
+import time
+import pytest
+import pyres.dates as dates
+
+
+def utc(date_string):
+    """ helper to build the expected struct_time """
+    return time.strptime(date_string, "%Y/%m/%d %H:%M:%S")
+
+
+class TestFeedDates(object):
+    """ test parsing dates from feeds """
+
+    @pytest.mark.parametrize("date_string, expected", [
+        (u'Wed, 20 May 2015 04:47:53 +0000', '2015/05/20 04:47:53'),
+        (u'Wed, 20 May 2015 04:47:53 GMT', '2015/05/20 04:47:53'),
+        (u'Wed, 20 May 2015 04:47:53 -0400', '2015/05/20 08:47:53'),
+        (u'Wed, 20 May 2015 23:47:53 EDT', '2015/05/21 03:47:53'),
+        (u'Wed, 20 May 2015 04:47:53 +0530', '2015/05/19 23:17:53'),
+        (u'Wed, 20 May 2015 04:47 PST', '2015/05/20 12:47:00'),
+        (u'Wednesday, 20 May 2015 04:47:53 +0000', '2015/05/20 04:47:53'),
+        (u'20 May 2015 04:47:53', '2015/05/20 04:47:53'),
+        (u'Wed, 3 June 15 04:47:53 +0000', '2015/06/03 04:47:53'),
+        (u'Wed, 20 May 2015 04:47:53 XYZ', '2015/05/20 04:47:53'),
+        (u'2015-08-23T17:38:36-04:00', '2015/08/23 21:38:36'),
+        (u'2015-08-23T17:38:36Z', '2015/08/23 17:38:36'),
+        (u'2015-08-23T17:38:36.123+0100', '2015/08/23 16:38:36'),
+        (u'2015-08-23 17:38:36', '2015/08/23 17:38:36'),
+        (u'2015-08-23', '2015/08/23 00:00:00'),
+    ])
+    def test_valid_dates(self, date_string, expected):
+        """ each of the formats found in the wild is converted to UTC """
+        assert self
+        assert dates.parse_feed_date(date_string) == utc(expected)
+
+    @pytest.mark.parametrize("date_string", [
+        u'not a valid date', u'', u'Wed, 20 Foo 2015 04:47:53 +0000',
+        u'Wed, 40 May 2015 04:47:53 +0000', u'2015-13-23T17:38:36Z',
+        u'2015/08/23:17:38:36',
+    ])
+    def test_invalid_dates(self, date_string):
+        """ anything we do not recognize raises ValueError """
+        assert self
+        pytest.raises(ValueError, dates.parse_feed_date, date_string)
+
+    def test_cache(self):
+        """ parsed dates are remembered and the cache stays bounded """
+        assert self
+        date_string = u'Thu, 21 May 2015 04:47:53 +0000'
+        first = dates.parse_feed_date(date_string)
+        assert date_string in dates.parse_feed_date.cache
+        assert dates.parse_feed_date(date_string) is first
+
+        for day in range(dates.CACHE_SIZE + 10):
+            date = time.gmtime(day * 86400)
+            dates.parse_feed_date(time.strftime('%Y-%m-%dT%H:%M:%SZ', date))
+        assert len(dates.parse_feed_date.cache) <= dates.CACHE_SIZE
+
+
+class TestDatabaseDates(object):
+    """ test parsing dates stored in the database """
+
+    def test_round_trip(self):
+        """ database dates match what strptime gives """
+        assert self
+        date_string = '2015/04/19:13:14:15'
+        assert dates.parse_database_date(date_string) == \
+            time.strptime(date_string, "%Y/%m/%d:%H:%M:%S")
+
+    def test_invalid(self):
+        """ bad database dates raise ValueError """
+        assert self
+        pytest.raises(ValueError, dates.parse_database_date, 'bad')
+        pytest.raises(ValueError, dates.parse_database_date,
+                      '2015/13/19:13:14:15')
+
+    def test_earlier(self):
+        """ moving a date back crosses days like strptime dates """
+        assert self
+        date = dates.parse_database_date('2015/04/19:10:00:00')
+        assert dates.earlier(date, dates.MAX_ZONE_OFFSET) == \
+            time.strptime('2015/04/18:20:00:00', "%Y/%m/%d:%H:%M:%S")
@@ -0,0 +1,59 @@
+""" Test the diskspace module """
+import os
+import time
+import pytest
+import pyres.episode
+from pyres.diskspace import DiskSpace
+from pyres.diskspace import existing_directory
+from pyres.diskspace import free_space
+
+
+def make_episode(directory, name):
+    """ Build an episode which downloads into directory """
+    return pyres.episode.Episode(file_name=os.path.join(directory, name),
+                                 date=time.localtime(), title=name,
+                                 url='link', podcast='podcast_name')
+
+
+@pytest.fixture
+def disk():
+    """ Provide a disk with 1000 bytes free keeping 100 in reserve """
+    return DiskSpace(reserve=100, free=lambda directory: 1000)
+
+
+class TestDiskSpace(object):
+    """ test the DiskSpace class """
+
+    # pylint: disable=W0621
+    def test_claim(self, disk, tmpdir):
+        """ claims are refused once they would eat into the reserve """
+        assert self
+        first = make_episode(str(tmpdir), 'first.mp3')
+        second = make_episode(str(tmpdir), 'second.mp3')
+        assert disk.claim(first, 600)
+        assert not disk.claim(second, 301)
+        assert disk.claim(second, 300)
+        disk.release(first)
+        assert disk.claim(second, 900)
+
+    def test_claim_replaced(self, disk, tmpdir):
+        """ claiming again for an episode replaces its claim """
+        assert self
+        episode = make_episode(str(tmpdir), 'file.mp3')
+        assert disk.claim(episode, 900)
+        assert disk.claim(episode, 900)
+        assert not disk.claim(episode, 901)
+        # a refused claim gives up the old one
+        assert disk.claim(make_episode(str(tmpdir), 'other.mp3'), 900)
+
+    def test_missing_directory(self, disk, tmpdir):
+        """ the space is checked on the disk the directory will be made on """
+        assert self
+        episode = make_episode(str(tmpdir.join('new', 'dir')), 'file.mp3')
+        assert existing_directory(episode.file_name) == str(tmpdir)
+        assert disk.claim(episode, 10)
+
+    def test_free_space(self, tmpdir):
+        """ the real free space is found """
+        assert self
+        assert free_space(str(tmpdir)) > 0
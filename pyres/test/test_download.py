@@ -1,12 +1,29 @@
-""" Test the download module - mock out urllib """
-import pytest
+""" Test the download module - mock out requests """
+import errno
+import hashlib
+import json
+import os
 import time
+import threading
+import pytest
 from mock import patch
 from mock import Mock
-from mock import mock_open
-from six.moves.urllib_error import URLError
+from six.moves import BaseHTTPServer, socketserver
+import requests
+import pyres.diskspace
 import pyres.download
 import pyres.episode
+import pyres.httpclient
+import pyres.recorder
+
+CONTENT = b"aaaaaaaaaaaaaaaaaaaa"
+
+
+@pytest.fixture(autouse=True)
+def no_retry_wait():
+    """ Retry failed downloads straight away """
+    with patch('pyres.retry.RETRY_DELAY', 0.001):
+        yield
 
 
 @pytest.fixture
@@ -18,16 +35,51 @@ def episode():
 
 
 @pytest.fixture
-def urllib_mock():
-    """ Mocks out the urllib urlopen command with general, working values """
-    pyres.download.urlopen = Mock()
-    pyres.download.urlopen.return_value.getcode.return_value = 200
-    # create the metadata object - this needs to have enough metadata for the
-    # downloader to get the content length
-    meta = Mock()
-    meta.getheaders.return_value = ["20", ]
-    pyres.download.urlopen.return_value.info.return_value = meta
-    return pyres.download.urlopen
+def tmp_episode(tmpdir):
+    """ Provide an episode which downloads to a temp directory """
+    return pyres.episode.Episode(file_name=str(tmpdir.join('file.mp3')),
+                                 date=time.localtime(), title='title',
+                                 url='link', podcast='podcast_name')
+
+
+def make_response(status=200, headers=None, blocks=(CONTENT, )):
+    """ Build a mock requests response """
+    response = Mock()
+    response.status_code = status
+    response.url = 'http://example.com/file.mp3'
+    response.headers = headers if headers is not None else \
+        {'content-length': str(sum(len(block) for block in blocks))}
+    response.iter_content.return_value = iter(blocks)
+    return response
+
+
+@pytest.fixture
+def requests_mock():
+    """ Mocks out the shared session get with general, working values """
+    with patch('pyres.download.httpclient.get') as get:
+        get.return_value = make_response()
+        yield get
+
+
+class NotFoundServer(socketserver.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    """ Serve each connection on its own thread """
+    daemon_threads = True
+
+
+class NotFoundHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """ Answer every request with a 404, keeping the connection open """
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):  # pylint: disable=invalid-name
+        """ nothing is here """
+        self.send_response(404)
+        self.send_header('Content-Length', '9')
+        self.end_headers()
+        self.wfile.write(b'not found')
+
+    def log_message(self, *_):  # pylint: disable=arguments-differ
+        """ keep the test output quiet """
+        pass
 
 
 class TestOpen(object):
@@ -36,20 +88,21 @@ class TestOpen(object):
     def test_bad_url(self, episode):  # pylint: disable=W0621
         """  tests opening bad url """
         assert self
-        # mock out open to raise an error
-        pyres.download.urlopen = Mock(side_effect=URLError("test"))
-        downloader = pyres.download.PodcastDownloader([episode])
-        downloader.download_url_list()
+        # mock out get to raise an error
+        with patch('pyres.download.httpclient.get',
+                   Mock(side_effect=requests.exceptions.ConnectionError())):
+            downloader = pyres.download.PodcastDownloader([episode])
+            downloader.download_url_list()
         failed = downloader.return_failed_files()
         assert len(failed) == 1
         worked = downloader.return_successful_files()
         assert len(worked) == 0
 
-    def test_bad_status(self, episode, urllib_mock):  # pylint: disable=W0621
+    def test_bad_status(self, episode, requests_mock):  # pylint: disable=W0621
         """ Test website returning bad status """
         assert self
         # change mock to return a 404
-        urllib_mock.return_value.getcode.return_value = 404
+        requests_mock.return_value = make_response(404)
 
         downloader = pyres.download.PodcastDownloader([episode])
         downloader.download_url_list()
@@ -57,12 +110,44 @@ class TestOpen(object):
         assert len(failed) == 1
         worked = downloader.return_successful_files()
         assert len(worked) == 0
+        # the connection goes back to the pool
+        assert requests_mock.return_value.close.called
 
-    def test_fileio_error(self, episode, urllib_mock):
+    def test_many_bad_status(self, tmpdir):
+        """ more failed requests to one host than its pool holds do not
+        leave later requests waiting for a connection """
+        assert self
+        httpd = NotFoundServer(('127.0.0.1', 0), NotFoundHandler)
+        server = threading.Thread(target=httpd.serve_forever)
+        server.daemon = True
+        server.start()
+        episodes = [pyres.episode.Episode(
+            file_name=str(tmpdir.join('%d.mp3' % index)),
+            date=time.localtime(), title=str(index), podcast='podcast',
+            url='http://127.0.0.1:%d/%d.mp3' % (httpd.server_address[1],
+                                                index))
+                    for index in range(5)]
+        downloader = pyres.download.PodcastDownloader(episodes, 1)
+        try:
+            with patch('pyres.httpclient.get_session',
+                       return_value=pyres.httpclient.make_session(
+                           pool_size=2)):
+                runner = threading.Thread(target=downloader.download_url_list)
+                runner.daemon = True
+                runner.start()
+                runner.join(10)
+        finally:
+            httpd.shutdown()
+            httpd.server_close()
+        assert not runner.is_alive()
+        assert downloader.return_failed_files() == episodes
+
+    # pylint: disable=W0621
+    def test_fileio_error(self, episode, requests_mock):
         """  test writing to filesystem failure """
         assert self
         # need to assert this as it's all configured for this test
-        assert urllib_mock
+        assert requests_mock
 
         # path in the given episode fails to open, cause IO error
         downloader = pyres.download.PodcastDownloader([episode])
@@ -72,20 +157,603 @@ class TestOpen(object):
         worked = downloader.return_successful_files()
         assert len(worked) == 0
 
-    def test_file_write(self, episode, urllib_mock):  # pylint: disable=W0621
+    def test_file_write(self, tmp_episode,  # pylint: disable=W0621
+                        requests_mock):  # pylint: disable=W0621
         """  test writing to filesystem successfully """
         assert self
-        # now make sure the read of the metadata works
-        urllib_mock.return_value.read = Mock(
-            side_effect=["aaaaaaaaaaaaaaaaaaaa", None])
-
-        mock_file = mock_open()
-        with patch('pyres.download.open', mock_file, create=True):
-            downloader = pyres.download.PodcastDownloader([episode])
-            downloader.download_url_list()
+        assert requests_mock
+        downloader = pyres.download.PodcastDownloader([tmp_episode])
+        downloader.download_url_list()
         failed = downloader.return_failed_files()
         assert len(failed) == 0
         worked = downloader.return_successful_files()
         assert len(worked) == 1
-        handle = mock_file()
-        assert handle.write.called_once()
+        with open(tmp_episode.file_name, 'rb') as podcast_file:
+            assert podcast_file.read() == CONTENT
+        # nothing left over from the download
+        assert os.listdir(os.path.dirname(tmp_episode.file_name)) == \
+            ['file.mp3']
+
+
+class TestSupervisor(object):
+    """ test the thread pool running the downloads """
+
+    # pylint: disable=W0621
+    def test_no_polling_delay(self, tmp_episode, requests_mock):
+        """ a quick download is recorded as soon as it finishes """
+        assert self
+        assert requests_mock
+        start = time.time()
+        downloader = pyres.download.PodcastDownloader([tmp_episode])
+        downloader.download_url_list()
+        assert downloader.return_successful_files() == [tmp_episode]
+        assert time.time() - start < 0.5
+
+    def test_threads_stopped(self, tmpdir, requests_mock):
+        """ no download threads are left running afterwards """
+        assert self
+        requests_mock.side_effect = lambda *_, **__: make_response()
+        episodes = [pyres.episode.Episode(
+            file_name=str(tmpdir.join('%d.mp3' % index)),
+            date=time.localtime(), title='title', url='link',
+            podcast='podcast_name') for index in range(10)]
+        running = threading.active_count()
+        downloader = pyres.download.PodcastDownloader(episodes, 4)
+        downloader.download_url_list()
+        assert len(downloader.return_successful_files()) == 10
+        assert threading.active_count() == running
+
+    def test_unexpected_error(self, tmp_episode, requests_mock):
+        """ an unexpected exception fails the episode instead of hanging """
+        assert self
+        requests_mock.return_value.iter_content.side_effect = \
+            RuntimeError("boom")
+        downloader = pyres.download.PodcastDownloader([tmp_episode])
+        downloader.download_url_list()
+        assert downloader.return_failed_files() == [tmp_episode]
+        assert "boom" in tmp_episode.error_msg
+
+    def test_interrupted(self, tmp_episode, requests_mock):
+        """ the threads are stopped if the supervisor is interrupted """
+        assert self
+        assert requests_mock
+        running = threading.active_count()
+        downloader = pyres.download.PodcastDownloader([tmp_episode])
+        with patch.object(downloader, 'handle_event',
+                          side_effect=KeyboardInterrupt):
+            with pytest.raises(KeyboardInterrupt):
+                downloader.download_url_list()
+        assert threading.active_count() == running
+
+
+class TestRetry(object):
+    """ test retrying failed downloads in the same run """
+
+    # pylint: disable=W0621
+    def test_transient(self, tmp_episode, requests_mock):
+        """ a server error is retried and can then succeed """
+        assert self
+        requests_mock.side_effect = [make_response(503), make_response()]
+        downloader = pyres.download.PodcastDownloader([tmp_episode])
+        downloader.download_url_list()
+        assert requests_mock.call_count == 2
+        assert downloader.return_successful_files() == [tmp_episode]
+        assert downloader.return_failed_files() == []
+        assert tmp_episode.error_msg is None
+
+    def test_gives_up(self, tmp_episode, requests_mock):
+        """ a transient failure which keeps happening fails in the end """
+        assert self
+        requests_mock.side_effect = lambda *_, **__: make_response(503)
+        downloader = pyres.download.PodcastDownloader([tmp_episode])
+        downloader.download_url_list()
+        assert requests_mock.call_count == 1 + \
+            pyres.download.retry.RETRIES_PER_RUN
+        assert downloader.return_failed_files() == [tmp_episode]
+        assert tmp_episode.error_class == '5xx'
+
+    def test_permanent(self, tmp_episode, requests_mock):
+        """ a missing file is not retried """
+        assert self
+        requests_mock.return_value = make_response(404)
+        downloader = pyres.download.PodcastDownloader([tmp_episode])
+        downloader.download_url_list()
+        assert requests_mock.call_count == 1
+        assert downloader.return_failed_files() == [tmp_episode]
+        assert tmp_episode.error_class == '4xx'
+
+
+class TestProgress(object):
+    """ test the progress events sent by downloads """
+
+    # pylint: disable=W0621
+    def test_limiter(self):
+        """ progress is due after enough time or enough bytes """
+        assert self
+        with patch('pyres.download.time.time') as clock:
+            clock.return_value = 100.0
+            limiter = pyres.download.ProgressLimiter(interval=1, step=1000)
+            assert not limiter.ready(10)
+            assert limiter.ready(1000)
+            assert not limiter.ready(1500)
+            clock.return_value = 101.5
+            assert limiter.ready(1600)
+
+    def test_coalesced(self, tmp_episode, requests_mock):
+        """ a file read in many blocks sends few events, ending with one
+        completed event """
+        assert self
+        blocks = [b"a" * 1024] * 1000
+        requests_mock.return_value = make_response(blocks=blocks)
+        downloader = pyres.download.PodcastDownloader([tmp_episode])
+        with patch.object(downloader, 'handle_event',
+                          wraps=downloader.handle_event) as handle_event:
+            downloader.download_url_list()
+        events = [call[0][1] for call in handle_event.call_args_list]
+        assert len(events) < 10
+        assert events[-1] == pyres.download.COMPLETED
+        assert events.count(pyres.download.COMPLETED) == 1
+        assert requests_mock.return_value.iter_content.call_args[0] == \
+            (pyres.download.DEFAULT_READ_SIZE, )
+
+    def test_completed_without_length(self, tmp_episode, requests_mock):
+        """ success does not depend on the server sending a length """
+        assert self
+        requests_mock.return_value = make_response(headers={})
+        downloader = pyres.download.PodcastDownloader([tmp_episode])
+        downloader.download_url_list()
+        assert downloader.return_successful_files() == [tmp_episode]
+        assert tmp_episode.size == len(CONTENT)
+
+
+class TestBandwidth(object):
+    """ test bandwidth limits on downloads """
+
+    # pylint: disable=W0621
+    def test_limited(self, tmp_episode, requests_mock):
+        """ the download waits when it is over its limit """
+        assert self
+        requests_mock.return_value = make_response(blocks=[b"a" * 3000] * 4)
+        bandwidth = pyres.download.Bandwidth(rate=10000)
+        downloader = pyres.download.PodcastDownloader([tmp_episode],
+                                                      bandwidth=bandwidth)
+        start = time.time()
+        downloader.download_url_list()
+        assert downloader.return_successful_files() == [tmp_episode]
+        # the first 10000 bytes are a burst, the last 2000 wait 0.2 seconds
+        assert time.time() - start >= 0.15
+        assert bandwidth.hosts() == ['example.com']
+        assert bandwidth.throughput('example.com') > 0
+
+
+class TestDiskSpace(object):
+    """ test deferring downloads which do not fit on the disk """
+
+    @staticmethod
+    def disk(free):
+        """ a disk with free bytes and no reserve """
+        return pyres.diskspace.DiskSpace(reserve=0, free=lambda _: free)
+
+    # pylint: disable=W0621
+    def test_known_size(self, tmp_episode, requests_mock):
+        """ an episode we know is too big is not even asked for """
+        assert self
+        tmp_episode.size = 100
+        downloader = pyres.download.PodcastDownloader(
+            [tmp_episode], disk=self.disk(50))
+        downloader.download_url_list()
+        assert not requests_mock.called
+        assert downloader.return_deferred_files() == [tmp_episode]
+        assert downloader.return_failed_files() == []
+
+    def test_content_length(self, tmp_episode, requests_mock):
+        """ the length the server sends is checked before writing """
+        assert self
+        downloader = pyres.download.PodcastDownloader(
+            [tmp_episode], disk=self.disk(len(CONTENT) - 1))
+        downloader.download_url_list()
+        assert requests_mock.call_count == 1
+        assert downloader.return_deferred_files() == [tmp_episode]
+        assert downloader.return_failed_files() == []
+        assert tmp_episode.error_class == 'disk'
+        assert os.listdir(os.path.dirname(tmp_episode.file_name)) == []
+
+    def test_readmitted(self, tmpdir, requests_mock):
+        """ a deferred episode starts once another one finishes """
+        assert self
+        episodes = [pyres.episode.Episode(
+            file_name=str(tmpdir.join('%d.mp3' % number)),
+            date=time.localtime(), title='title', url='link', podcast='pod',
+            size=len(CONTENT)) for number in range(2)]
+        requests_mock.side_effect = lambda *args, **kwargs: make_response()
+        downloader = pyres.download.PodcastDownloader(
+            episodes, disk=self.disk(len(CONTENT) + 1))
+        downloader.download_url_list()
+        assert requests_mock.call_count == 2
+        assert downloader.return_successful_files() == episodes
+        assert downloader.return_deferred_files() == []
+        assert not downloader.disk.claims
+
+    def test_disk_full(self, tmp_episode, requests_mock):
+        """ running out of space while writing defers the episode """
+        assert self
+        with patch('pyres.download.PartialDownload.open',
+                   side_effect=IOError(errno.ENOSPC, 'No space')):
+            downloader = pyres.download.PodcastDownloader([tmp_episode])
+            downloader.download_url_list()
+        assert requests_mock.call_count == 1
+        assert downloader.return_deferred_files() == [tmp_episode]
+        assert downloader.return_failed_files() == []
+
+
+class TestPipeline(object):
+    """ test giving episodes to a running downloader """
+
+    # pylint: disable=W0621
+    def test_added(self, tmpdir, requests_mock):
+        """ episodes added after the threads start are all downloaded """
+        assert self
+        episodes = [pyres.episode.Episode(
+            file_name=str(tmpdir.join('%d.mp3' % number)),
+            date=time.localtime(), title='title', url='link', podcast='pod')
+                    for number in range(3)]
+        requests_mock.side_effect = lambda *args, **kwargs: make_response()
+        downloader = pyres.download.PodcastDownloader([], num_threads=2)
+        assert downloader.num_threads == 2
+        downloader.start()
+        try:
+            for episode in episodes:
+                downloader.add(episode)
+            downloader.join()
+        finally:
+            downloader.stop()
+        assert not downloader.threads
+        assert sorted(downloader.return_successful_files(),
+                      key=lambda episode: episode.file_name) == episodes
+        assert downloader.status.total_files == 3
+        assert downloader.pending() == 0
+
+    def test_schedule_queue(self):
+        """ waiting episodes come out smallest key first, then the stop
+        markers """
+        assert self
+        waiting = pyres.download.ScheduleQueue(key=len)
+        for item in ('ccc', None, 'a', 'bb', 'd'):
+            waiting.put(item)
+        assert [waiting.get() for _ in range(5)] == \
+            ['a', 'd', 'bb', 'ccc', None]
+        in_order = pyres.download.ScheduleQueue()
+        for item in ('ccc', 'a', None, 'bb'):
+            in_order.put(item)
+        assert [in_order.get() for _ in range(4)] == \
+            ['ccc', 'a', 'bb', None]
+
+    def test_recorder(self, tmp_episode, requests_mock):
+        """ each result goes to the recorder as soon as it arrives """
+        assert self
+        assert requests_mock
+        recorder = Mock()
+        downloader = pyres.download.PodcastDownloader([tmp_episode],
+                                                      recorder=recorder)
+        downloader.download_url_list()
+        recorder.downloaded.assert_called_once_with(tmp_episode)
+        assert not recorder.failed.called
+
+    def test_quiet_commit(self, tmp_episode):
+        """ a lone result is committed once it has waited long enough, even
+        if no other events arrive """
+        assert self
+        database = Mock()
+        clock = [1000.0]
+        recorder = pyres.recorder.DownloadRecorder(
+            database, batch_seconds=10, clock=lambda: clock[0])
+        downloader = pyres.download.PodcastDownloader([tmp_episode],
+                                                      recorder=recorder)
+        tmp_episode.size = 0
+        downloader.handle_event(0, pyres.download.COMPLETED, 0, tmp_episode)
+        assert not downloader.poll(0.01)
+        assert not database.commit.called
+        # nothing else happens for a while
+        clock[0] += 10
+        assert not downloader.poll(0.01)
+        assert database.commit.call_count == 1
+
+    def test_backpressure(self, tmpdir, requests_mock):
+        """ add waits for earlier episodes once max_pending are
+        unfinished """
+        assert self
+        requests_mock.side_effect = lambda *args, **kwargs: make_response()
+        downloader = pyres.download.PodcastDownloader([], num_threads=1,
+                                                      max_pending=1)
+        downloader.start()
+        try:
+            for number in range(4):
+                downloader.add(pyres.episode.Episode(
+                    file_name=str(tmpdir.join('%d.mp3' % number)),
+                    date=time.localtime(), title='title', url='link',
+                    podcast='pod'))
+                assert downloader.pending() <= 1
+            downloader.join()
+        finally:
+            downloader.stop()
+        assert len(downloader.return_successful_files()) == 4
+
+
+class TestResume(object):
+    """ test resuming interrupted downloads """
+
+    # pylint: disable=W0621
+    @staticmethod
+    def interrupted(episode, etag='"v1"', url='link'):
+        """ leave a part file behind as if a download had failed """
+        part_name = episode.file_name + pyres.download.PART_SUFFIX
+        with open(part_name, 'wb') as part_file:
+            part_file.write(CONTENT[:5])
+        with open(part_name + pyres.download.STATE_SUFFIX, 'w') as state:
+            json.dump({'url': url, 'etag': etag, 'last_modified': None},
+                      state)
+
+    def test_interrupted(self, tmp_episode, requests_mock):
+        """ a failed transfer leaves the part file to resume from """
+        assert self
+        response = make_response(headers={'content-length': '20',
+                                          'etag': '"v1"'})
+        response.iter_content.side_effect = \
+            requests.exceptions.ConnectionError()
+        requests_mock.return_value = response
+
+        downloader = pyres.download.PodcastDownloader([tmp_episode])
+        downloader.download_url_list()
+        assert downloader.return_failed_files() == [tmp_episode]
+        assert not os.path.exists(tmp_episode.file_name)
+        partial = pyres.download.PartialDownload(tmp_episode)
+        assert partial.validator == '"v1"'
+
+    def test_resume(self, tmp_episode, requests_mock):
+        """ only the rest of the file is requested and appended """
+        assert self
+        self.interrupted(tmp_episode)
+        requests_mock.return_value = make_response(
+            206, {'content-range': 'bytes 5-19/20', 'etag': '"v1"'},
+            [CONTENT[5:]])
+
+        downloader = pyres.download.PodcastDownloader([tmp_episode])
+        downloader.download_url_list()
+        assert downloader.return_successful_files() == [tmp_episode]
+        headers = requests_mock.call_args[1]['headers']
+        assert headers == {'Range': 'bytes=5-', 'If-Range': '"v1"'}
+        assert tmp_episode.size == 20
+        with open(tmp_episode.file_name, 'rb') as podcast_file:
+            assert podcast_file.read() == CONTENT
+        assert os.listdir(os.path.dirname(tmp_episode.file_name)) == \
+            ['file.mp3']
+
+    def test_changed_on_server(self, tmp_episode, requests_mock):
+        """ a 200 reply to a range request replaces the part file """
+        assert self
+        self.interrupted(tmp_episode)
+        new_content = b"b" * 30
+        requests_mock.return_value = make_response(blocks=[new_content])
+
+        downloader = pyres.download.PodcastDownloader([tmp_episode])
+        downloader.download_url_list()
+        assert downloader.return_successful_files() == [tmp_episode]
+        with open(tmp_episode.file_name, 'rb') as podcast_file:
+            assert podcast_file.read() == new_content
+
+    @pytest.mark.parametrize("etag, url", [(None, 'link'), ('"v1"', 'new')])
+    def test_not_resumable(self, tmp_episode, requests_mock, etag, url):
+        """ without a validator or for a different url we start over """
+        assert self
+        self.interrupted(tmp_episode, etag, url)
+        downloader = pyres.download.PodcastDownloader([tmp_episode])
+        downloader.download_url_list()
+        assert requests_mock.call_args[1]['headers'] == {}
+        assert downloader.return_successful_files() == [tmp_episode]
+        with open(tmp_episode.file_name, 'rb') as podcast_file:
+            assert podcast_file.read() == CONTENT
+
+    def test_range_not_satisfiable(self, tmp_episode, requests_mock):
+        """ a 416 reply discards the part file and asks again """
+        assert self
+        self.interrupted(tmp_episode)
+        requests_mock.side_effect = [make_response(416), make_response()]
+        downloader = pyres.download.PodcastDownloader([tmp_episode])
+        downloader.download_url_list()
+        assert requests_mock.call_count == 2
+        assert downloader.return_successful_files() == [tmp_episode]
+        with open(tmp_episode.file_name, 'rb') as podcast_file:
+            assert podcast_file.read() == CONTENT
+
+
+class TestPreallocate(object):
+    """ test preallocating and syncing part files """
+
+    # pylint: disable=W0621
+    def test_preallocated(self, tmp_episode, requests_mock):
+        """ the whole file is preallocated before it is written """
+        assert self
+        with patch('pyres.download.utils.preallocate',
+                   return_value=True) as preallocate:
+            downloader = pyres.download.PodcastDownloader([tmp_episode])
+            downloader.download_url_list()
+        assert preallocate.call_args[0][1] == len(CONTENT)
+        assert downloader.return_successful_files() == [tmp_episode]
+        with open(tmp_episode.file_name, 'rb') as podcast_file:
+            assert podcast_file.read() == CONTENT
+
+    def test_interrupted(self, tmp_episode, requests_mock):
+        """ a preallocated file is cut back to what was written so it can
+        be resumed """
+        assert self
+
+        def blocks():
+            """ send part of the file then fail """
+            yield CONTENT[:5]
+            raise requests.exceptions.ConnectionError()
+        response = make_response(headers={'content-length': '20',
+                                          'etag': '"v1"'})
+        response.iter_content.return_value = blocks()
+        requests_mock.return_value = response
+        with patch('pyres.download.utils.preallocate',
+                   side_effect=lambda the_file, size:
+                   the_file.truncate(size) or True):
+            downloader = pyres.download.PodcastDownloader([tmp_episode])
+            with patch('pyres.retry.RETRIES_PER_RUN', 0):
+                downloader.download_url_list()
+        assert downloader.return_failed_files() == [tmp_episode]
+        part_name = tmp_episode.file_name + pyres.download.PART_SUFFIX
+        assert os.path.getsize(part_name) == 5
+        assert pyres.download.PartialDownload(tmp_episode).offset == 5
+
+    def test_crashed(self, tmp_episode):
+        """ after a crash a preallocated file is trusted only as far as we
+        know it was written """
+        assert self
+        part_name = tmp_episode.file_name + pyres.download.PART_SUFFIX
+        with open(part_name, 'wb') as part_file:
+            part_file.write(CONTENT)
+        with open(part_name + pyres.download.STATE_SUFFIX, 'w') as state:
+            json.dump({'url': 'link', 'etag': '"v1"', 'written': 3}, state)
+        partial = pyres.download.PartialDownload(tmp_episode)
+        assert partial.request_headers()['Range'] == 'bytes=3-'
+
+    @pytest.mark.parametrize("policy, syncs", [
+        ('never', 0), ('finish', 1), ('periodic', 5)])
+    def test_fsync(self, tmp_episode, requests_mock, policy, syncs):
+        """ files are synced as often as the policy says """
+        assert self
+        requests_mock.return_value = make_response(blocks=[b"a"] * 4)
+        with patch('pyres.download.FSYNC_BYTES', 1), \
+                patch('pyres.download.os.fsync') as fsync, \
+                patch('pyres.download.utils.sync_file') as sync_file, \
+                patch('pyres.download.utils.sync_directory'):
+            downloader = pyres.download.PodcastDownloader([tmp_episode],
+                                                          fsync=policy)
+            downloader.download_url_list()
+        assert downloader.return_successful_files() == [tmp_episode]
+        assert fsync.call_count + sync_file.call_count == syncs
+
+
+class TestHash(object):
+    """ test hashing downloads as they are written """
+
+    # pylint: disable=W0621
+    def test_hash(self, tmp_episode, requests_mock):
+        """ the hash of the whole file is found without reading it back """
+        assert self
+        requests_mock.return_value = make_response(
+            blocks=[CONTENT[:7], CONTENT[7:]])
+        downloader = pyres.download.PodcastDownloader([tmp_episode])
+        downloader.download_url_list()
+        assert tmp_episode.hash == hashlib.sha256(CONTENT).hexdigest()
+        # which is not an MP3 file so it has no duration
+        assert tmp_episode.duration is None
+
+    def test_resumed(self, tmp_episode, requests_mock):
+        """ a resumed download hashes what was there already """
+        assert self
+        TestResume.interrupted(tmp_episode)
+        requests_mock.return_value = make_response(
+            206, {'content-range': 'bytes 5-19/20', 'etag': '"v1"'},
+            [CONTENT[5:]])
+        downloader = pyres.download.PodcastDownloader([tmp_episode])
+        downloader.download_url_list()
+        assert downloader.return_successful_files() == [tmp_episode]
+        assert tmp_episode.hash == hashlib.sha256(CONTENT).hexdigest()
+
+    def test_duration(self, tmp_episode, requests_mock):
+        """ the duration of an MP3 file is found as it is written """
+        assert self
+        # ten 128 kbit/s frames, each 417 bytes
+        frame = b'\xff\xfb\x90\x00' + b'\0' * 413
+        requests_mock.return_value = make_response(blocks=[frame * 10])
+        downloader = pyres.download.PodcastDownloader([tmp_episode])
+        downloader.download_url_list()
+        assert tmp_episode.duration == pytest.approx(4170 * 8 / 128000.0)
+
+
+class TestSegments(object):
+    """ test downloading a large file in parallel segments """
+
+    content = b"0123456789" * 10
+
+    def ranged_get(self, fail=None):
+        """ Build a get which serves slices of content for Range requests,
+        failing the request for the slice starting at fail """
+        headers = {'content-length': str(len(self.content)),
+                   'accept-ranges': 'bytes', 'etag': '"v1"'}
+
+        def get(url, **kwargs):
+            """ serve the whole file, or the range asked for """
+            assert url == 'link'
+            requested = kwargs['headers'].get('Range')
+            if not requested:
+                return make_response(headers=headers, blocks=[self.content])
+            assert kwargs['headers']['If-Range'] == '"v1"'
+            first, last = [int(x) for x in
+                           requested.split('=')[1].split('-')]
+            if first == fail:
+                return make_response(503)
+            # send the slice in small blocks, and more than was asked for
+            body = self.content[first:]
+            blocks = [body[i:i + 7] for i in range(0, len(body), 7)]
+            return make_response(206, {
+                'content-range': 'bytes %d-%d/%d' % (first, last,
+                                                     len(self.content))},
+                                 blocks)
+        return get
+
+    def test_split_ranges(self):
+        """ ranges cover the file with no gaps """
+        assert self
+        assert pyres.download.split_ranges(10, 3) == [(0, 3), (4, 7), (8, 9)]
+        assert pyres.download.split_ranges(2, 4) == [(0, 0), (1, 1)]
+
+    # pylint: disable=W0621
+    def test_segmented(self, tmp_episode, requests_mock):
+        """ the segments are fetched with range requests and put together """
+        assert self
+        requests_mock.side_effect = self.ranged_get()
+        downloader = pyres.download.PodcastDownloader(
+            [tmp_episode], segments=4, segment_size=50)
+        downloader.download_url_list()
+        assert downloader.return_successful_files() == [tmp_episode]
+        assert requests_mock.call_count == 4
+        assert tmp_episode.size == len(self.content)
+        with open(tmp_episode.file_name, 'rb') as podcast_file:
+            assert podcast_file.read() == self.content
+        assert os.listdir(os.path.dirname(tmp_episode.file_name)) == \
+            ['file.mp3']
+        assert tmp_episode.hash == hashlib.sha256(self.content).hexdigest()
+
+    @pytest.mark.parametrize("header, segment_size", [
+        ('accept-ranges', 50), ('etag', 50), (None, 1000)])
+    def test_not_segmented(self, tmp_episode, requests_mock, header,
+                           segment_size):
+        """ small files, or servers which cannot serve checked ranges, are
+        downloaded with one request """
+        assert self
+        get = self.ranged_get()
+        response = get('link', headers={})
+        response.headers.pop(header, None)
+        requests_mock.side_effect = None
+        requests_mock.return_value = response
+        downloader = pyres.download.PodcastDownloader(
+            [tmp_episode], segments=4, segment_size=segment_size)
+        downloader.download_url_list()
+        assert requests_mock.call_count == 1
+        with open(tmp_episode.file_name, 'rb') as podcast_file:
+            assert podcast_file.read() == self.content
+
+    def test_failed_segment(self, tmp_episode, requests_mock):
+        """ one failed segment fails the episode and leaves no part file """
+        assert self
+        with patch('pyres.retry.RETRIES_PER_RUN', 0):
+            requests_mock.side_effect = self.ranged_get(fail=50)
+            downloader = pyres.download.PodcastDownloader(
+                [tmp_episode], segments=2, segment_size=50)
+            downloader.download_url_list()
+        assert downloader.return_failed_files() == [tmp_episode]
+        assert tmp_episode.error_class == '5xx'
+        assert os.listdir(os.path.dirname(tmp_episode.file_name)) == []
@@ -51,6 +51,38 @@ class TestFilemanager(object):
         assert mock_copy.called
         assert mock_copy.call_count == 2
 
+    @patch('shutil.copyfile')
+    def test_copy_same_hash(self, mock_copy):   # pylint: disable=W0621
+        """  a file posted under two titles is only copied once """
+        assert self
+        episodes = [
+            pyres.episode.Episode(date=time.localtime(), title=title,
+                                  url='url', podcast='podcast', state=1,
+                                  file_name=title, hash=file_hash)
+            for title, file_hash in (('one', 'abc'), ('two', 'abc'),
+                                     ('three', None), ('four', None))]
+
+        filemgr = pyres.filemanager.FileManager(base_dir='copy_base')
+        filemgr.copy_episodes_to_player(episodes)
+        assert mock_copy.call_count == 3
+
+    @patch('shutil.copyfile')
+    def test_copy_iterator(self, mock_copy):   # pylint: disable=W0621
+        """  episodes are copied in the order given, each reported when it
+        is done """
+        assert self
+        episodes = [
+            pyres.episode.Episode(date=time.localtime(), title=title,
+                                  url='url', podcast='podcast', state=1,
+                                  file_name=title)
+            for title in ('one', 'two')]
+        done = []
+
+        filemgr = pyres.filemanager.FileManager(base_dir='copy_base')
+        filemgr.copy_episodes_to_player(iter(episodes), 2, done.append)
+        assert mock_copy.call_count == 2
+        assert done == episodes
+
     @patch('shutil.copyfile')
     @patch('pyres.filemanager.utils.mkdir_p')
     @patch('pyres.filemanager.os.walk')
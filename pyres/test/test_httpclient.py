@@ -0,0 +1,43 @@
+""" Test the httpclient module """
+from mock import patch
+import pyres.httpclient as httpclient
+
+
+class TestSession(object):
+    """ test the shared session """
+
+    def test_shared(self):
+        """ every caller gets the same session """
+        assert self
+        assert httpclient.get_session() is httpclient.get_session()
+
+    def test_pool(self):
+        """ the session keeps a pool of connections per host """
+        assert self
+        session = httpclient.make_session(pool_hosts=5, pool_size=3)
+        for prefix in ('http://', 'https://'):
+            adapter = session.get_adapter(prefix + 'example.com')
+            assert adapter._pool_connections == 5  # pylint: disable=W0212
+            assert adapter._pool_maxsize == 3  # pylint: disable=W0212
+            # a full pool must not leave requests waiting forever
+            assert not adapter._pool_block  # pylint: disable=W0212
+        assert session.headers['User-Agent'] == httpclient.USER_AGENT
+
+    def test_timeout(self):
+        """ requests get the default timeout unless they ask for another """
+        assert self
+        with patch.object(httpclient.get_session(), 'get') as get:
+            httpclient.get('url', stream=True)
+            get.assert_called_once_with('url', stream=True,
+                                        timeout=httpclient.TIMEOUT)
+            get.reset_mock()
+            httpclient.get('url', timeout=5)
+            get.assert_called_once_with('url', timeout=5)
+
+    def test_head(self):
+        """ HEAD requests follow redirects and get the default timeout """
+        assert self
+        with patch.object(httpclient.get_session(), 'head') as head:
+            httpclient.head('url')
+            head.assert_called_once_with('url', allow_redirects=True,
+                                         timeout=httpclient.TIMEOUT)
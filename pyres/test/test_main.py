@@ -7,8 +7,11 @@ import shutil
 import sqlite3
 import time
 import pyres.main
+import pyres.download
+import pyres.episode
 from mock import patch
 from mock import Mock
+from mock import ANY
 import argparse
 
 # For some reason, one of the mocks is getting called an extra time in python
@@ -218,7 +221,7 @@ class TestParseCmdLine(object):
         sys.argv = ['test', 'add', 'url', '--max-update', '15', ]
         util_add_tester('Files', '15', None, 'url')
 
-    def test_update_command(self):
+    def test_update_command(self, tmpdir):
         """  update subcommand """
         assert self
         # test command with no optional params
@@ -244,6 +247,39 @@ class TestParseCmdLine(object):
         assert not results.no_backup
         assert not results.verbose
 
+        # test picking a database profile, directly or from a file
+        sys.argv = ['test', 'update', '--db-profile', 'fast', ]
+        results = pyres.main.parse_command_line()
+        assert results.db_profile == 'fast'
+        conf_file = tmpdir.join('pyres_test.conf')
+        conf_file.write('--db-profile\nfast\n--backup-keep\n3\n')
+        sys.argv = ['test', 'update', '@%s' % conf_file, ]
+        results = pyres.main.parse_command_line()
+        assert results.db_profile == 'fast'
+        assert results.backup_keep == 3
+
+        # options given before the subcommand are kept too
+        for argv in (['@%s' % conf_file, 'names'],
+                     ['--db-profile', 'fast', '--backup-keep', '3',
+                      'process']):
+            sys.argv = ['test'] + argv
+            results = pyres.main.parse_command_line()
+            assert results.db_profile == 'fast'
+            assert results.backup_keep == 3
+            assert results.database == 'rss.db'
+            assert not results.verbose
+        sys.argv = ['test', '-v', '-d', 'other.db', 'names', ]
+        results = pyres.main.parse_command_line()
+        assert results.verbose
+        assert results.database == 'other.db'
+        assert results.db_profile == pyres.main.DEFAULT_PROFILE
+
+        # test command with feed workers option
+        sys.argv = ['test', 'update', '--feed-workers', '8', ]
+        results = pyres.main.parse_command_line()
+        assert results.command == 'update'
+        assert results.feed_workers == 8
+
     def test_process_command(self):
         """  process subcommand """
         assert self
@@ -259,6 +295,67 @@ class TestParseCmdLine(object):
         # test base args
         self.util_base_args(sys.argv)
 
+        # test choosing the download engine
+        assert results.engine == 'threads'
+        assert results.concurrency is None
+        sys.argv = ['test', 'process', '--engine', 'async',
+                    '--concurrency', '20', ]
+        results = pyres.main.parse_command_line()
+        assert results.engine == 'async'
+        assert results.concurrency == 20
+        assert results.read_size == pyres.main.DEFAULT_READ_SIZE
+        sys.argv = ['test', 'process', '--read-size', '8192', ]
+        results = pyres.main.parse_command_line()
+        assert results.read_size == 8192
+
+        # test bandwidth limits
+        assert results.max_rate is None
+        assert results.max_host_rate is None
+        sys.argv = ['test', 'process', '--max-rate', '500',
+                    '--max-host-rate', '200', ]
+        results = pyres.main.parse_command_line()
+        assert results.max_rate == 500
+        assert results.max_host_rate == 200
+        downloader = pyres.main.make_downloader(results, ['episode'])
+        assert downloader.bandwidth.bucket.rate == 500 * 1024
+        assert downloader.bandwidth.host_rate == 200 * 1024
+
+        # test segmented downloads
+        assert results.segments == 1
+        sys.argv = ['test', 'process', '--segments', '4',
+                    '--segment-size', '50', ]
+        results = pyres.main.parse_command_line()
+        downloader = pyres.main.make_downloader(results, ['episode'])
+        assert downloader.segments == 4
+        assert downloader.segment_size == 50 * 1024 * 1024
+
+        # test the download schedule
+        assert results.schedule == 'podcast'
+        sys.argv = ['test', 'process', '--schedule', 'fair', ]
+        results = pyres.main.parse_command_line()
+        assert results.schedule == 'fair'
+
+        # test the disk reserve
+        assert results.disk_reserve == \
+            pyres.main.DEFAULT_RESERVE // (1024 * 1024)
+        sys.argv = ['test', 'process', '--disk-reserve', '10', ]
+        results = pyres.main.parse_command_line()
+        downloader = pyres.main.make_downloader(results, ['episode'])
+        assert downloader.disk.reserve == 10 * 1024 * 1024
+
+        # test the fsync policy
+        assert results.fsync == 'finish'
+        sys.argv = ['test', 'process', '--fsync', 'periodic', ]
+        results = pyres.main.parse_command_line()
+        downloader = pyres.main.make_downloader(results, ['episode'])
+        assert downloader.fsync == 'periodic'
+
+        # test the durations command
+        sys.argv = ['test', 'durations', '--workers', '2', ]
+        results = pyres.main.parse_command_line()
+        assert results.func == pyres.main.find_durations
+        assert results.workers == 2
+
     def test_download_command(self):
         """  download subcommand """
         assert self
@@ -410,6 +507,128 @@ class TestMain(object):
         assert copyfile.assert_not_called
 
 
+class TestBackup(object):
+    """ Test the backup_database function"""
+    @staticmethod
+    def make_args(database, keep=10, days=0):
+        """ Utility to build the arguments backup_database needs """
+        args = argparse.Namespace()
+        args.database = database
+        args.backup_keep = keep
+        args.backup_days = days
+        return args
+
+    @staticmethod
+    def touch_database(database, offset):
+        """ Utility to pretend the database changed offset seconds ago """
+        mod_time = time.time() - offset
+        os.utime(database, (mod_time, mod_time))
+
+    def test_skip_unchanged(self, tmpdir, monkeypatch):
+        """ a database which has not changed is not backed up again """
+        assert self
+        monkeypatch.chdir(tmpdir)
+        with pyres.main.PodcastDatabase('rss.db') as _database:
+            _database.add_podcast('name', 'url', sys.maxsize)
+        self.touch_database('rss.db', 100)
+        args = self.make_args('rss.db')
+
+        pyres.main.backup_database(args)
+        backups = os.listdir('BACKUP')
+        assert len(backups) == 1
+        assert backups[0].startswith('rss.db_')
+        # the backup is a working copy of the database
+        with pyres.main.PodcastDatabase(os.path.join('BACKUP', backups[0])) \
+                as _database:
+            assert _database.get_podcast_names() == ['name']
+
+        pyres.main.backup_database(args)
+        assert os.listdir('BACKUP') == backups
+
+        # the database changes, so we need a new backup
+        self.touch_database('rss.db', 0)
+        with patch('pyres.main.utils.current_date_time_as_string') as stamp:
+            stamp.return_value = '9999_12_31_00_00_00'
+            pyres.main.backup_database(args)
+        assert len(os.listdir('BACKUP')) == 2
+
+    def test_changed_in_log(self, tmpdir, monkeypatch):
+        """ changes only written to the write-ahead log still need a new
+        backup """
+        assert self
+        monkeypatch.chdir(tmpdir)
+        with pyres.main.PodcastDatabase('rss.db') as _database:
+            _database.add_podcast('name', 'url', sys.maxsize)
+        self.touch_database('rss.db', 100)
+        args = self.make_args('rss.db')
+        pyres.main.backup_database(args)
+        db_time = os.path.getmtime('rss.db')
+
+        # another process writes to the log and leaves the database file
+        # as it was
+        connection = sqlite3.connect('rss.db')
+        try:
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA wal_autocheckpoint=0")
+            connection.execute("DELETE FROM podcasts")
+            connection.commit()
+            assert os.path.getsize('rss.db-wal')
+            os.utime('rss.db', (db_time, db_time))
+            with patch('pyres.main.utils.current_date_time_as_string') \
+                    as stamp:
+                stamp.return_value = '9999_12_31_00_00_00'
+                pyres.main.backup_database(args)
+        finally:
+            connection.close()
+        backups = sorted(os.listdir('BACKUP'))
+        assert len(backups) == 2
+        with pyres.main.PodcastDatabase(os.path.join('BACKUP', backups[-1])) \
+                as _database:
+            assert _database.get_podcast_names() == []
+
+    @pytest.mark.parametrize("keep, days, left", [
+        (0, 0, 6), (10, 0, 6), (3, 0, 3), (1, 0, 1), (0, 3, 3), (2, 3, 2),
+    ])  # pylint: disable=too-many-arguments
+    def test_retention(self, tmpdir, monkeypatch, keep, days, left):
+        """ old backups are pruned by count and by age """
+        assert self
+        monkeypatch.chdir(tmpdir)
+        os.mkdir('BACKUP')
+        # five old backups, one a day, newest last
+        for day in range(5):
+            name = os.path.join('BACKUP', 'rss.db_2015_05_%02d_00_00_00' %
+                                (day + 1))
+            open(name, 'w').close()
+            self.touch_database(name, (5 - day) * 24 * 60 * 60 + 60)
+        # something which is not one of our backups
+        open(os.path.join('BACKUP', 'other.db_2015_05_01_00_00_00'),
+             'w').close()
+        open('rss.db', 'w').close()
+
+        pyres.main.backup_database(self.make_args('rss.db', keep, days))
+        backups = sorted(os.listdir('BACKUP'))
+        assert 'other.db_2015_05_01_00_00_00' in backups
+        backups.remove('other.db_2015_05_01_00_00_00')
+        assert len(backups) == left
+        # the newest is the one we just made
+        assert backups[-1] != 'rss.db_2015_05_05_00_00_00'
+
+    @patch('pyres.main.backup_database')
+    def test_read_only_commands(self, backup_mock):
+        """ commands which do not change the database are not backed up """
+        assert self
+        for command, backed_up in (('names', False), ('database', False),
+                                   ('update', True), ('download', True)):
+            backup_mock.reset_mock()
+            sys.argv = ['test', command, ]
+            results = pyres.main.parse_command_line()
+            results.func = Mock()
+            with patch('pyres.main.parse_command_line') as mock_parse:
+                mock_parse.return_value = results
+                pyres.main.main()
+            assert backup_mock.called == backed_up
+
+
 class TestDebugDatabase(object):
     """ Test the debug database function"""
     def test_show_all(self, emptyfile):  # pylint: disable=W0621
@@ -465,6 +684,13 @@ def test_audiobook(newplayer):  # pylint: disable=W0621
         copy_mock.assert_called_once_with('test_dir')
 
 
+def copy_episodes(episodes, total, copied):
+    """ stand in for copying to the player, which marks each episode """
+    assert total
+    for episode in episodes:
+        copied(episode)
+
+
 class TestDownload(object):
     """ Test the download to player function"""
     def test_no_podcasts(self, emptyfile):  # pylint: disable=W0621
@@ -472,10 +698,10 @@ class TestDownload(object):
         assert self
         with patch('pyres.main.PodcastDatabase.mark_episode_on_mp3_player') \
                 as mark_episode:
-            with patch('pyres.main.PodcastDatabase.get_podcast_names') as \
-                    get_names:
+            with patch('pyres.main.PodcastDatabase.count_episodes') as \
+                    count:
                 # set up the patch to return an empty list
-                get_names.return_value = []
+                count.return_value = []
 
                 # set up the arguments
                 args = argparse.Namespace()
@@ -485,19 +711,19 @@ class TestDownload(object):
                 pyres.main.download_to_player(args)
 
                 # test that we called the right things
-                get_names.assert_called_once_with()
+                count.assert_called_once_with(1)
                 assert mark_episode.call_count == 0
 
     def test_one_podcast_no_episodes(self, emptyfile):  # pylint: disable=W0621
         """ one podcast but no episodes to download """
         assert self
-        with patch('pyres.main.PodcastDatabase.find_episodes_to_copy') \
+        with patch('pyres.main.PodcastDatabase.iter_episodes') \
                 as to_copy:
-            with patch('pyres.main.PodcastDatabase.get_podcast_names') as \
-                    get_names:
+            with patch('pyres.main.PodcastDatabase.count_episodes') as \
+                    count:
                 # set up the patch to return an empty list
-                get_names.return_value = ['podcast', ]
-                to_copy.return_value = []
+                count.return_value = []
+                to_copy.return_value = iter([])
 
                 # set up the arguments
                 args = argparse.Namespace()
@@ -507,8 +733,8 @@ class TestDownload(object):
                 pyres.main.download_to_player(args)
 
                 # test that we called the right things
-                get_names.assert_called_once_with()
-                to_copy.assert_called_once_with('podcast')
+                count.assert_called_once_with(1)
+                assert not to_copy.called
 
     @patch('pyres.main.FileManager.copy_episodes_to_player')
     def test_one_podcast_two_episodes(self, copier,
@@ -516,16 +742,18 @@ class TestDownload(object):
                                       newplayer):  # pylint: disable=W0621
         """ one podcast with two episodes to download """
         assert self
-        with patch('pyres.main.PodcastDatabase.find_episodes_to_copy') \
+        with patch('pyres.main.PodcastDatabase.iter_episodes') \
                 as to_copy:
-            with patch('pyres.main.PodcastDatabase.get_podcast_names') as \
-                    get_names:
+            with patch('pyres.main.PodcastDatabase.count_episodes') as \
+                    count:
                 with patch('pyres.main.PodcastDatabase.'
                            'mark_episode_on_mp3_player') as mark_eps:
                     # set up the patch to return an empty list
-                    get_names.return_value = ['podcast', ]
+                    count.return_value = [('podcast', 2), ]
                     episode_list = ['ep1', 'ep2', ]
-                    to_copy.return_value = episode_list
+                    to_copy.return_value = iter(episode_list)
+
+                    copier.side_effect = copy_episodes
 
                     # set up the arguments
                     args = argparse.Namespace()
@@ -536,9 +764,10 @@ class TestDownload(object):
                     pyres.main.download_to_player(args)
 
                     # test that we called the right things
-                    get_names.assert_called_once_with()
-                    to_copy.assert_called_once_with('podcast')
-                    copier.assert_called_once_with(episode_list)
+                    count.assert_called_once_with(1)
+                    to_copy.assert_called_once_with(1)
+                    copier.assert_called_once_with(to_copy.return_value, 2,
+                                                   ANY)
                     assert mark_eps.call_count == 2
 
     @patch('pyres.main.FileManager.copy_episodes_to_player')
@@ -547,16 +776,18 @@ class TestDownload(object):
                                        newplayer):  # pylint: disable=W0621
         """ two podcast with two episodes each to download """
         assert self
-        with patch('pyres.main.PodcastDatabase.find_episodes_to_copy') \
+        with patch('pyres.main.PodcastDatabase.iter_episodes') \
                 as to_copy:
-            with patch('pyres.main.PodcastDatabase.get_podcast_names') as \
-                    get_names:
+            with patch('pyres.main.PodcastDatabase.count_episodes') as \
+                    count:
                 with patch('pyres.main.PodcastDatabase.'
                            'mark_episode_on_mp3_player') as mark_eps:
                     # set up the patch to return an empty list
-                    get_names.return_value = ['podcast1', 'podcast2', ]
-                    episode_list = ['ep1', 'ep2', ]
-                    to_copy.side_effect = (episode_list, episode_list)
+                    count.return_value = [('podcast1', 2), ('podcast2', 2), ]
+                    episode_list = ['ep1', 'ep2', 'ep3', 'ep4', ]
+                    to_copy.return_value = iter(episode_list)
+
+                    copier.side_effect = copy_episodes
 
                     # set up the arguments
                     args = argparse.Namespace()
@@ -567,11 +798,10 @@ class TestDownload(object):
                     pyres.main.download_to_player(args)
 
                     # test that we called the right things
-                    get_names.assert_called_once_with()
-                    assert to_copy.call_count == 2
-                    list_to_copy = episode_list
-                    list_to_copy.extend(episode_list)
-                    copier.assert_called_once_with(list_to_copy)
+                    count.assert_called_once_with(1)
+                    assert to_copy.call_count == 1
+                    copier.assert_called_once_with(to_copy.return_value, 4,
+                                                   ANY)
                     assert mark_eps.call_count == 4
 
 
@@ -582,10 +812,10 @@ class TestProcess(object):
         assert self
         with patch('pyres.main.PodcastDatabase.mark_episode_on_mp3_player') \
                 as mark_episode:
-            with patch('pyres.main.PodcastDatabase.get_podcast_names') as \
-                    get_names:
+            with patch('pyres.main.PodcastDatabase.count_episodes') as \
+                    count:
                 # set up the patch to return an empty list
-                get_names.return_value = []
+                count.return_value = []
 
                 # set up the arguments
                 args = argparse.Namespace()
@@ -595,19 +825,19 @@ class TestProcess(object):
                 pyres.main.process_rss_feeds(args)
 
                 # test that we called the right things
-                get_names.assert_called_once_with()
+                count.assert_called_once_with(0)
                 assert mark_episode.call_count == 0
 
     def test_one_podcast_no_episodes(self, emptyfile):  # pylint: disable=W0621
         """ one podcast but no episodes to download """
         assert self
-        with patch('pyres.main.PodcastDatabase.find_episodes_to_download') \
+        with patch('pyres.main.PodcastDatabase.iter_episodes') \
                 as to_download:
-            with patch('pyres.main.PodcastDatabase.get_podcast_names') as \
-                    get_names:
+            with patch('pyres.main.PodcastDatabase.count_episodes') as \
+                    count:
                 # set up the patch to return an empty list
-                get_names.return_value = ['podcast', ]
-                to_download.return_value = []
+                count.return_value = []
+                to_download.return_value = iter([])
 
                 # set up the arguments
                 args = argparse.Namespace()
@@ -617,11 +847,11 @@ class TestProcess(object):
                 pyres.main.process_rss_feeds(args)
 
                 # test that we called the right things
-                get_names.assert_called_once_with()
-                to_download.assert_called_once_with('podcast')
+                count.assert_called_once_with(0)
+                to_download.assert_called_once_with(0, order_by='podcast',
+                                                    ready_at=ANY)
 
-    @patch('pyres.main.PodcastDownloader.return_successful_files')
-    def test_one_podcast_two_episodes(self, downloader,
+    def test_one_podcast_two_episodes(self,
                                       emptyfile,  # pylint: disable=W0621
                                       newplayer):  # pylint: disable=W0621
         """ one podcast with two episodes to download """
@@ -632,22 +862,30 @@ class TestProcess(object):
             def __init__(self, file_name, podcast):
                 self.file_name = file_name
                 self.podcast = podcast
+                self.hash = None
+                self.duration = None
+                self.size = 0
+
+        def download_url_list(downloader):
+            """ each episode downloads """
+            for episode in episode_list:
+                downloader.handle_event(0, pyres.download.COMPLETED, 0,
+                                        episode)
 
-        with patch('pyres.main.PodcastDatabase.find_episodes_to_download') \
+        with patch('pyres.main.PodcastDatabase.iter_episodes') \
                 as to_download:
-            with patch('pyres.main.PodcastDatabase.get_podcast_names') as \
-                    get_names:
+            with patch('pyres.main.PodcastDatabase.count_episodes') as \
+                    count:
                 with patch('pyres.main.PodcastDatabase.'
                            'mark_episode_downloaded') as mark_eps:
                     with patch('pyres.main.PodcastDownloader.'
-                               'download_url_list') as download_list:
-                        assert download_list
+                               'download_url_list', autospec=True,
+                               side_effect=download_url_list) as downloader:
                         # set up the patch to return an empty list
-                        get_names.return_value = ['podcast1', ]
+                        count.return_value = [('podcast1', 2), ]
                         episode_list = [FakeEpisode('ep1', 'podcast1'),
                                         FakeEpisode('ep2', 'podcast1'), ]
-                        to_download.return_value = episode_list
-                        downloader.return_value = episode_list
+                        to_download.return_value = iter(episode_list)
 
                         # set up the arguments
                         args = argparse.Namespace()
@@ -658,12 +896,159 @@ class TestProcess(object):
                         pyres.main.process_rss_feeds(args)
 
                         # test that we called the right things
-                        get_names.assert_called_once_with()
-                        to_download.assert_called_once_with('podcast1')
-                        downloader.assert_called_once_with()
+                        count.assert_called_once_with(0)
+                        to_download.assert_called_once_with(
+                            0, order_by='podcast', ready_at=ANY)
+                        assert downloader.call_count == 1
                         assert mark_eps.call_count == 2
 
 
+class TestProcessInterrupted(object):
+    """ Test keeping results when downloading is interrupted """
+    def test_interrupted(self, emptyfile):  # pylint: disable=W0621
+        """ downloads which finished before Ctrl-C are not lost """
+        assert self
+        with pyres.main.PodcastDatabase(emptyfile) as _database:
+            _database.add_podcast('pod', 'url', 0)
+            for title in ('done', 'not done'):
+                _database.add_new_episode_data('pod', pyres.episode.Episode(
+                    base_path='path', date=time.localtime(), title=title,
+                    url='url', podcast='pod'))
+
+        def download_url_list(downloader):
+            """ one episode finishes before we are interrupted """
+            episode = downloader.episodes[0]
+            episode.size = 1
+            downloader.handle_event(0, pyres.download.COMPLETED, 0, episode)
+            raise KeyboardInterrupt()
+
+        args = argparse.Namespace()
+        args.database = emptyfile
+        args.schedule = 'podcast'
+        with patch('pyres.main.PodcastDownloader.download_url_list',
+                   autospec=True, side_effect=download_url_list):
+            with pytest.raises(KeyboardInterrupt):
+                pyres.main.process_rss_feeds(args)
+
+        with pyres.main.PodcastDatabase(emptyfile) as _database:
+            assert [ep.title for ep in _database.iter_episodes(1)] == \
+                ['done']
+
+
+class TestProcessFailures(object):
+    """ Test recording failed downloads """
+    @patch('pyres.main.PodcastDatabase.mark_episode_failed')
+    @patch('pyres.main.PodcastDatabase.iter_episodes')
+    def test_failures_recorded(self, to_download, mark_failed,
+                               emptyfile):  # pylint: disable=W0621
+        """ each failure is counted and given a time for the next try """
+        assert self
+        episodes = [pyres.episode.Episode(
+            date=time.localtime(), title=title, url='url', podcast='pod',
+            file_name=title, attempts=attempts)
+                    for title, attempts in (('missing', 0), ('slow', 2))]
+        episodes[0].error_class = '4xx'
+        episodes[1].error_class = 'timeout'
+        to_download.return_value = iter(episodes)
+
+        args = argparse.Namespace()
+        args.database = emptyfile
+
+        def download_url_list(downloader):
+            """ each episode fails for good this run """
+            for episode in episodes:
+                downloader.handle_event(0, pyres.download.FAILED, 0, episode)
+
+        with patch('pyres.main.PodcastDownloader.download_url_list',
+                   autospec=True, side_effect=download_url_list):
+            pyres.main.process_rss_feeds(args)
+
+        assert [ep.attempts for ep in episodes] == [1, 3]
+        # the missing file is given up on, the slow one tried again later
+        mark_failed.assert_any_call(episodes[0], None)
+        (episode, next_attempt), _ = mark_failed.call_args_list[1]
+        assert episode is episodes[1]
+        assert next_attempt > time.time()
+
+    @patch('pyres.main.PodcastDownloader.download_url_list')
+    @patch('pyres.main.PodcastDatabase.iter_episodes')
+    def test_schedule(self, to_download, download_list,
+                      emptyfile):  # pylint: disable=W0621
+        """ episodes are handed to the downloader in schedule order """
+        assert self
+        assert download_list
+        episodes = [pyres.episode.Episode(
+            date=time.localtime(), title=title, url='url', podcast=title,
+            file_name=title) for title in ('a', 'b')]
+        to_download.return_value = iter(episodes)
+
+        args = argparse.Namespace()
+        args.database = emptyfile
+        args.schedule = 'newest'
+        with patch('pyres.main.schedule.order_episodes',
+                   return_value=episodes[::-1]) as order_episodes, \
+                patch('pyres.main.make_downloader',
+                      wraps=pyres.main.make_downloader) as make_downloader:
+            pyres.main.process_rss_feeds(args)
+        order_episodes.assert_called_once_with(to_download.return_value,
+                                               'newest')
+        assert make_downloader.call_args[0][1] == episodes[::-1]
+
+
+class TestLinkDuplicate(object):
+    """ Test storing identical episodes once """
+    def test_linked(self, tmpdir):
+        """ a new file the same as one we have becomes a link to it """
+        assert self
+        existing = tmpdir.join('existing.mp3')
+        existing.write('same')
+        tmpdir.join('new.mp3').write('same')
+        episode = pyres.episode.Episode(
+            date=time.localtime(), title='new', url='url', podcast='pod',
+            file_name=str(tmpdir.join('new.mp3')), hash='abc')
+        database = Mock()
+        database.find_files_with_hash.return_value = [
+            str(tmpdir.join('gone.mp3')), str(existing)]
+        assert pyres.main.link_duplicate(database, episode)
+        assert os.path.samefile(str(existing), episode.file_name)
+
+    def test_nothing_to_link(self, tmpdir):
+        """ a file we only have once is left alone """
+        assert self
+        episode = pyres.episode.Episode(
+            date=time.localtime(), title='new', url='url', podcast='pod',
+            file_name=str(tmpdir.join('new.mp3')), hash='abc')
+        database = Mock()
+        database.find_files_with_hash.return_value = [episode.file_name]
+        assert not pyres.main.link_duplicate(database, episode)
+
+
+class TestFindDurations(object):
+    """ Test filling in the duration of episodes """
+    def test_durations(self, emptyfile, tmpdir):  # pylint: disable=W0621
+        """ downloaded files without a duration are timed """
+        assert self
+        frame = b'\xff\xfb\x90\x00' + b'\0' * 413
+        tmpdir.join('one.mp3').write(frame * 10, mode='wb')
+        tmpdir.join('two.txt').write('not an mp3')
+        episodes = [pyres.episode.Episode(
+            date=time.localtime(), title=name, url='url', podcast='pod',
+            file_name=str(tmpdir.join(name)))
+                    for name in ('one.mp3', 'two.txt', 'gone.mp3')]
+
+        args = argparse.Namespace()
+        args.database = emptyfile
+        args.workers = 1
+        with patch('pyres.main.PodcastDatabase.iter_episodes',
+                   side_effect=[iter(episodes), iter([])]), \
+                patch('pyres.main.PodcastDatabase.set_episode_duration') \
+                as set_duration:
+            pyres.main.find_durations(args)
+        set_duration.assert_called_once_with(episodes[0], ANY)
+        assert set_duration.call_args[0][1] == \
+            pytest.approx(4170 * 8 / 128000.0)
+
+
 class TestMainDelete(object):
     """ Test the delete_podcast function"""
     def test_no_podcasts(self, emptyfile):  # pylint: disable=W0621
@@ -784,17 +1169,110 @@ class TestUpdate(object):
         """ call add_url with a an episode to add """
         assert self
         with patch('pyres.main.PodcastDatabase.get_podcast_urls') as get_pod:
-            with patch('pyres.main.pyres.rss.add_episodes_from_feed') as add_e:
-                # set up the arguments
-                args = argparse.Namespace()
-                args.database = emptyfile
-                args.base_dir = "base_dir"
+            with patch('pyres.refresh.pyres.rss.fetch_episodes_from_feed') \
+                    as fetch:
+                with patch('pyres.refresh.pyres.rss.store_episodes') as add_e:
+                    # set up the arguments
+                    args = argparse.Namespace()
+                    args.database = emptyfile
+                    args.base_dir = "base_dir"
 
-                add_e.return_value = "name", 1
-                get_pod.return_value = ((0, 1,
-                                         time.strptime("04/17/15", "%x")), )
+                    fetch.return_value = "name", ["episode", ], None
+                    add_e.return_value = "name", 1
+                    get_pod.return_value = ((0, 1,
+                                             time.strptime("04/17/15",
+                                                           "%x"),
+                                             None), )
 
-                # call the routine
-                pyres.main.update_download_list(args)
+                    # call the routine
+                    pyres.main.update_download_list(args)
 
-                assert add_e.call_count == 1
+                    assert fetch.call_count == 1
+                    assert add_e.call_count == 1
+
+    def test_pipelined(self, emptyfile):  # pylint: disable=W0621
+        """ the new episodes of a feed are downloaded before the other feeds
+        have been refreshed """
+        assert self
+        episodes = [pyres.episode.Episode(
+            date=time.localtime(), title=title, url='url', podcast=podcast,
+            file_name=title) for title, podcast in (('old', 'first'),
+                                                    ('one', 'first'),
+                                                    ('two', 'second'))]
+        downloader = Mock()
+        downloader.return_successful_files.return_value = []
+        downloader.return_failed_files.return_value = []
+        # the episodes added by the time each feed is refreshed
+        added = list()
+
+        def refresh_feeds(_database, _args):
+            """ two feeds with new episodes """
+            for name in ('first', 'second'):
+                added.append(downloader.add.call_count)
+                yield name
+
+        def iter_episodes(_state, order_by, ready_at, podcast=None):
+            """ the episodes in the database at each point """
+            assert order_by == 'podcast' and ready_at
+            known = episodes[:len(added) + 1]
+            return [episode for episode in known
+                    if podcast in (None, episode.podcast)]
+
+        with patch('pyres.main.make_downloader', return_value=downloader), \
+                patch('pyres.main.refresh_feeds', refresh_feeds), \
+                patch('pyres.main.PodcastDatabase.iter_episodes',
+                      side_effect=iter_episodes):
+            args = argparse.Namespace()
+            args.database = emptyfile
+            args.base_dir = "base_dir"
+            pyres.main.update_download_list(args)
+
+        assert added == [1, 2]
+        assert [call[0][0] for call in downloader.add.call_args_list] == \
+            episodes
+        downloader.start.assert_called_once_with()
+        downloader.join.assert_called_once_with()
+        downloader.stop.assert_called_once_with()
+
+    def test_schedule(self, emptyfile):  # pylint: disable=W0621
+        """ the schedule orders the waiting episodes across podcasts, and
+        no sizes are probed while the feeds are read """
+        assert self
+        episodes = [pyres.episode.Episode(
+            date=time.localtime(), title=podcast, url='url', podcast=podcast,
+            file_name=podcast) for podcast in ('first', 'second')]
+        downloader = Mock()
+        downloader.return_successful_files.return_value = []
+        downloader.return_failed_files.return_value = []
+        with patch('pyres.main.make_downloader',
+                   return_value=downloader) as make_downloader, \
+                patch('pyres.main.refresh_feeds', return_value=iter([])), \
+                patch('pyres.main.PodcastDatabase.iter_episodes',
+                      return_value=iter(episodes)), \
+                patch('pyres.schedule.probe_sizes') as probe_sizes:
+            args = argparse.Namespace()
+            args.database = emptyfile
+            args.base_dir = "base_dir"
+            args.schedule = 'shortest'
+            pyres.main.update_download_list(args)
+        assert make_downloader.call_args[0][3] is \
+            pyres.schedule.queue_key('shortest')
+        assert [call[0][0] for call in downloader.add.call_args_list] == \
+            episodes
+        assert not probe_sizes.called
+
+    def test_async_engine(self, emptyfile,  # pylint: disable=W0621
+                          capsys):
+        """ the asyncio engine refreshes every feed before downloading, and
+        says so """
+        assert self
+        with patch('pyres.main.refresh_feeds', return_value=iter(['pod'])), \
+                patch('pyres.main.process_rss_feeds') as process:
+            args = argparse.Namespace()
+            args.database = emptyfile
+            args.base_dir = "base_dir"
+            args.engine = 'async'
+            pyres.main.update_download_list(args)
+            process.assert_called_once_with(args)
+        out, _ = capsys.readouterr()
+        assert "once every feed has been read" in out
@@ -0,0 +1,145 @@
+""" Test the mp3 module """
+import random
+import struct
+import pytest
+import pyres.mp3 as mp3
+
+# MPEG 1 layer III, 128 kbit/s, 44100 Hz, stereo
+HEADER = b'\xff\xfb\x90\x00'
+FRAME_SIZE = 417
+
+
+def id3v2(size):
+    """ Build an ID3v2 tag of size bytes, including its header """
+    body = size - 10
+    syncsafe = bytearray([(body >> shift) & 0x7F for shift in (21, 14, 7, 0)])
+    return b'ID3\x03\x00\x00' + bytes(syncsafe) + b'\0' * body
+
+
+def frame(extra=b''):
+    """ Build a frame with extra data after the side information """
+    data = HEADER + b'\0' * 32 + extra
+    return data + b'\0' * (FRAME_SIZE - len(data))
+
+
+def feed(data, block_size):
+    """ Feed data to a parser block_size bytes at a time """
+    parser = mp3.DurationParser()
+    for start in range(0, len(data), block_size):
+        parser.update(data[start:start + block_size])
+    return parser.duration()
+
+
+class TestFrameHeader(object):
+    """ test reading frame headers """
+
+    def test_header(self):
+        """ the fields of a good header """
+        assert self
+        assert mp3.parse_frame_header(HEADER) == (128000, 44100, 1152, 36)
+        # MPEG 2 layer III, 64 kbit/s, 22050 Hz, mono
+        assert mp3.parse_frame_header(b'\xff\xf3\x80\xc0') == \
+            (64000, 22050, 576, 13)
+
+    def test_frame_length(self):
+        """ the bytes in a frame, with and without padding """
+        assert self
+        assert mp3.frame_length(HEADER) == FRAME_SIZE
+        assert mp3.frame_length(b'\xff\xfb\x92\x00') == FRAME_SIZE + 1
+        # MPEG 2 layer III, 64 kbit/s, 22050 Hz
+        assert mp3.frame_length(b'\xff\xf3\x80\xc0') == 208
+        # MPEG 1 layer I, 128 kbit/s, 44100 Hz
+        assert mp3.frame_length(b'\xff\xff\x40\x00') == 136
+        assert mp3.frame_length(b'\xff\x00\x90\x00') is None
+
+    @pytest.mark.parametrize("header", [
+        b'\xff\x00\x90\x00',   # no sync
+        b'\xff\xeb\x90\x00',   # reserved version
+        b'\xff\xf9\x90\x00',   # reserved layer
+        b'\xff\xfb\xf0\x00',   # bad bit rate
+        b'\xff\xfb\x9c\x00',   # reserved sample rate
+    ])
+    def test_bad_header(self, header):
+        """ anything else is not a frame """
+        assert self
+        assert mp3.parse_frame_header(header) is None
+
+
+class TestDuration(object):
+    """ test the DurationParser class """
+
+    @pytest.mark.parametrize("block_size", [1, 7, 4096, 1 << 20])
+    def test_cbr(self, block_size):
+        """ constant bit rate files are timed by their size, skipping tags """
+        assert self
+        data = id3v2(1000) + frame() * 100 + b'TAG' + b'\0' * 125
+        assert feed(data, block_size) == pytest.approx(
+            100 * FRAME_SIZE * 8 / 128000.0)
+
+    @pytest.mark.parametrize("block_size", [1, 4096])
+    def test_xing(self, block_size):
+        """ a Xing header gives the number of frames """
+        assert self
+        xing = b'Xing' + struct.pack('>II', 1, 1000)
+        data = id3v2(20) + frame(xing) + frame() * 10
+        assert feed(data, block_size) == pytest.approx(1000 * 1152 / 44100.0)
+
+    def test_vbri(self):
+        """ a VBRI header gives the number of frames """
+        assert self
+        vbri = b'VBRI' + struct.pack('>HHHII', 1, 0, 0, 0, 500)
+        assert feed(frame(vbri) + frame(), 100) == \
+            pytest.approx(500 * 1152 / 44100.0)
+
+    def test_junk_before_frame(self):
+        """ bytes which only look like a frame start are skipped """
+        assert self
+        data = b'\xff\x00junk' + frame() * 2
+        assert feed(data, 3) == pytest.approx((len(data) - 6) * 8 / 128000.0)
+
+    def test_short_file(self):
+        """ a file ending just after its first frame header """
+        assert self
+        assert feed(id3v2(20) + HEADER + b'\0' * 10, 4) == \
+            pytest.approx(14 * 8 / 128000.0)
+
+    @pytest.mark.parametrize("data", [b'', b'not an mp3 file' * 10000])
+    def test_not_mp3(self, data):
+        """ files we cannot time have no duration """
+        assert self
+        assert feed(data, 4096) is None
+
+    def test_lone_header(self):
+        """ a frame header with no frame after it is not taken as the start
+        of the audio """
+        assert self
+        data = b'\0' * 100 + HEADER + b'\0' * 1000 + frame() * 2
+        assert feed(data, 4096) == pytest.approx(2 * FRAME_SIZE * 8 /
+                                                 128000.0)
+
+    @pytest.mark.parametrize("seed", range(50))
+    def test_m4a(self, seed):
+        """ an AAC file, whose data holds many bytes which look like frame
+        headers, has no duration """
+        assert self
+        rand = random.Random(seed)
+        data = struct.pack('>I', 24) + b'ftypM4A ' + b'\0' * 12 + \
+            bytes(bytearray(rand.getrandbits(8) for _ in range(100000)))
+        assert feed(data, 65536) is None
+
+
+class TestFileDuration(object):
+    """ test timing files on disk """
+
+    def test_file(self, tmpdir):
+        """ the duration of a file is found """
+        assert self
+        tmpdir.join('file.mp3').write(id3v2(100) + frame() * 50,
+                                      mode='wb')
+        assert mp3.file_duration(str(tmpdir.join('file.mp3'))) == \
+            pytest.approx(50 * FRAME_SIZE * 8 / 128000.0)
+
+    def test_missing(self, tmpdir):
+        """ a missing file has no duration """
+        assert self
+        assert mp3.file_duration(str(tmpdir.join('missing.mp3'))) is None
@@ -0,0 +1,88 @@
+""" Test the recorder module """
+import time
+import pytest
+from mock import Mock
+import pyres.episode
+from pyres.recorder import DownloadRecorder
+
+
+@pytest.fixture
+def episode():
+    """ an episode which has been tried twice before """
+    return pyres.episode.Episode(date=time.localtime(), title='title',
+                                 url='url', podcast='pod', file_name='file',
+                                 attempts=2)
+
+
+class Clock(object):  # pylint: disable=too-few-public-methods
+    """ a clock which only moves when told to """
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+class TestRecorder(object):
+    """ test writing download results as they finish """
+
+    # pylint: disable=W0621
+    def test_written_at_once(self, episode):
+        """ each result is written as soon as it arrives """
+        assert self
+        database = Mock()
+        recorder = DownloadRecorder(database)
+        recorder.downloaded(episode)
+        database.mark_episode_downloaded.assert_called_once_with(episode)
+        assert recorder.downloaded_files == [episode]
+        assert not database.commit.called
+
+    def test_batch_size(self, episode):
+        """ a full group of results is committed """
+        assert self
+        database = Mock()
+        recorder = DownloadRecorder(database, batch_size=3)
+        for _ in range(7):
+            recorder.downloaded(episode)
+        assert database.commit.call_count == 2
+        assert recorder.uncommitted == 1
+        recorder.commit()
+        assert database.commit.call_count == 3
+        # nothing left to commit
+        recorder.commit()
+        assert database.commit.call_count == 3
+
+    def test_batch_seconds(self, episode):
+        """ a result is committed once it has waited long enough """
+        assert self
+        database = Mock()
+        clock = Clock()
+        recorder = DownloadRecorder(database, batch_seconds=10, clock=clock)
+        recorder.downloaded(episode)
+        clock.now += 9
+        recorder.tick()
+        assert not database.commit.called
+        clock.now += 1
+        recorder.tick()
+        assert database.commit.call_count == 1
+        # the time starts again with the next result
+        recorder.downloaded(episode)
+        recorder.tick()
+        assert database.commit.call_count == 1
+
+    def test_failed(self, episode):
+        """ a failure is counted and tried again later or given up on """
+        assert self
+        database = Mock()
+        recorder = DownloadRecorder(database)
+        episode.error_class = 'timeout'
+        recorder.failed(episode)
+        assert episode.attempts == 3
+        (_, next_attempt), _ = database.mark_episode_failed.call_args
+        assert next_attempt > time.time()
+        assert recorder.given_up_files == []
+
+        episode.error_class = '4xx'
+        recorder.failed(episode)
+        database.mark_episode_failed.assert_called_with(episode, None)
+        assert recorder.given_up_files == [episode]
@@ -0,0 +1,84 @@
+""" Test the refresh module """
+import threading
+import time
+import pytest
+from mock import patch
+from mock import Mock
+from pyres.refresh import FeedRefresher
+
+
+def podcast_list(count):
+    """ Build a list of (url, throttle, start_date, latest_title)
+    tuples """
+    date = time.strptime('2015/4/19', "%Y/%m/%d")
+    return [('url%d' % index, 5, date, b'title') for index in range(count)]
+
+
+class TestRefresh(object):
+    """ test the FeedRefresher class """
+
+    @patch('pyres.refresh.pyres.rss.store_episodes')
+    @patch('pyres.refresh.pyres.rss.fetch_episodes_from_feed')
+    def test_no_podcasts(self, fetch, store):
+        """ nothing is fetched or stored for an empty list """
+        assert self
+        refresher = FeedRefresher(Mock(), 'bdir', 3)
+        assert list(refresher.refresh([])) == []
+        assert not fetch.called
+        assert not store.called
+
+    @patch('pyres.refresh.pyres.rss.store_episodes')
+    @patch('pyres.refresh.pyres.rss.fetch_episodes_from_feed')
+    def test_all_feeds_stored(self, fetch, store):
+        """ every feed is fetched and stored exactly once """
+        assert self
+        fetch.side_effect = lambda url, *_: (url, [url], None)
+        store.side_effect = lambda db, url, throttle, name, *_: (name, 1)
+
+        podcasts = podcast_list(10)
+        database = Mock()
+        refresher = FeedRefresher(database, 'bdir', 3)
+        results = list(refresher.refresh(podcasts))
+
+        assert len(results) == 10
+        assert sorted(name for _, name, _ in results) == \
+            sorted(podcast[0] for podcast in podcasts)
+        assert fetch.call_count == 10
+        assert store.call_count == 10
+        for call in store.call_args_list:
+            assert call[0][0] is database
+            assert call[0][2] == 5
+
+    @patch('pyres.refresh.pyres.rss.store_episodes')
+    @patch('pyres.refresh.pyres.rss.fetch_episodes_from_feed')
+    def test_single_writer(self, fetch, store):
+        """ database writes all happen on the calling thread """
+        assert self
+        writers = set()
+        fetch.return_value = 'name', ['episode'], None
+
+        def record_writer(*_):
+            """ remember which thread called us """
+            writers.add(threading.current_thread())
+            return 'name', 1
+        store.side_effect = record_writer
+
+        refresher = FeedRefresher(Mock(), 'bdir', 4)
+        list(refresher.refresh(podcast_list(8)))
+        assert writers == set([threading.current_thread()])
+
+    @patch('pyres.refresh.pyres.rss.store_episodes')
+    @patch('pyres.refresh.pyres.rss.fetch_episodes_from_feed')
+    def test_fetch_error_raised(self, fetch, store):
+        """ an exception in a fetcher thread is raised to the caller """
+        assert self
+        fetch.side_effect = ValueError("bad date")
+        store.return_value = 'name', 1
+
+        running = threading.active_count()
+        refresher = FeedRefresher(Mock(), 'bdir', 2)
+        with pytest.raises(ValueError):
+            list(refresher.refresh(podcast_list(4)))
+        assert not store.called
+        # no fetcher threads left running
+        assert threading.active_count() == running
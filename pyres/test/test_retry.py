@@ -0,0 +1,85 @@
+""" Test the retry module """
+import errno
+import socket
+import pytest
+import requests
+from mock import patch
+import pyres.retry as retry
+
+
+class TestClassify(object):
+    """ test sorting failures into classes """
+
+    @pytest.mark.parametrize("error, expected", [
+        (requests.exceptions.ConnectionError(
+            socket.gaierror(-2, 'Name or service not known')), retry.DNS),
+        (requests.exceptions.ConnectionError(
+            "HTTPConnectionPool: Failed to resolve 'bad.example'"), retry.DNS),
+        (socket.gaierror(-2, 'oops'), retry.DNS),
+        (requests.exceptions.ReadTimeout(), retry.TIMEOUT),
+        (requests.exceptions.ConnectTimeout(), retry.TIMEOUT),
+        (socket.timeout(), retry.TIMEOUT),
+        (requests.exceptions.ConnectionError("reset by peer"),
+         retry.NETWORK),
+        (requests.exceptions.ChunkedEncodingError(), retry.NETWORK),
+        (ValueError("odd"), retry.OTHER),
+    ])
+    def test_exceptions(self, error, expected):
+        """ the class is found even when the error is wrapped """
+        assert self
+        assert retry.classify_exception(error) == expected
+
+    @pytest.mark.parametrize("status, expected", [
+        (404, retry.CLIENT), (410, retry.CLIENT), (403, retry.CLIENT),
+        (408, retry.TIMEOUT), (429, retry.SERVER), (500, retry.SERVER),
+        (503, retry.SERVER), (302, retry.OTHER),
+    ])
+    def test_status(self, status, expected):
+        """ HTTP status codes """
+        assert self
+        assert retry.classify_status(status) == expected
+
+    @pytest.mark.parametrize("error, expected", [
+        (IOError(errno.ENOSPC, 'No space left on device'), retry.DISK),
+        (IOError(errno.EACCES, 'Permission denied'), retry.IO),
+        (OSError('odd'), retry.IO),
+    ])
+    def test_io_errors(self, error, expected):
+        """ a full disk is told apart from other write errors """
+        assert self
+        assert retry.classify_io_error(error) == expected
+
+
+class TestDelays(object):
+    """ test when failures are tried again """
+
+    def test_in_run(self):
+        """ transient failures are retried a few times with growing waits """
+        assert self
+        with patch('pyres.retry.random.uniform', lambda low, high: high):
+            assert retry.retry_delay(retry.TIMEOUT, 0) == retry.RETRY_DELAY
+            assert retry.retry_delay(retry.SERVER, 1) == \
+                retry.RETRY_DELAY * 2
+            assert retry.retry_delay(retry.SERVER,
+                                     retry.RETRIES_PER_RUN) is None
+        for error_class in (retry.CLIENT, retry.IO, retry.OTHER,
+                            retry.CANCELLED):
+            assert retry.retry_delay(error_class, 0) is None
+
+    def test_later_runs(self):
+        """ the wait for the next run doubles up to a limit, with jitter """
+        assert self
+        now = 1000.0
+        first = retry.next_attempt(retry.TIMEOUT, 1, now)
+        assert now + retry.RUN_DELAY / 2 <= first <= now + retry.RUN_DELAY
+        third = retry.next_attempt(retry.TIMEOUT, 3, now)
+        assert now + retry.RUN_DELAY * 2 <= third <= \
+            now + retry.RUN_DELAY * 4
+        last = retry.next_attempt(retry.IO, retry.MAX_ATTEMPTS - 1, now)
+        assert last <= now + retry.MAX_RUN_DELAY
+
+    def test_give_up(self):
+        """ permanent failures and too many attempts give up """
+        assert self
+        assert retry.next_attempt(retry.CLIENT, 1, 0) is None
+        assert retry.next_attempt(retry.TIMEOUT, retry.MAX_ATTEMPTS, 0) is None
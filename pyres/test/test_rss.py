@@ -3,7 +3,10 @@ import sys
 import os
 import time
 import pytest
+import requests
 from pyres.rss import add_episodes_from_feed
+from pyres.rss import fetch_episodes_from_feed
+from pyres.rss import store_episodes
 from pyres.database import PodcastDatabase
 from mock import patch
 from mock import Mock
@@ -25,6 +28,24 @@ def emptyfile(request):
     return file_name
 
 
+@pytest.fixture(autouse=True)
+def http_get():
+    """ Mock out the shared HTTP session.  The feed content it returns is
+    just 'a', which feedparser is mocked to turn into a feed. """
+    with patch('pyres.rss.httpclient.get') as get:
+        get.return_value.status_code = 200
+        get.return_value.content = b'a'
+        get.return_value.headers = dict()
+        yield get
+
+
+def mock_database():
+    """ A stand in database which has no dates to put right """
+    database = Mock()
+    database.rebase_local_dates.side_effect = lambda name, episodes: episodes
+    return database
+
+
 @pytest.fixture
 def basicfeed():
     """ Provide a simple feed  """
@@ -129,7 +150,7 @@ class TestRss(object):
                                              None)
 
         # test that we were called correctly and that the return values are ok
-        feedparser.assert_called_once_with('a')
+        feedparser.assert_called_once_with(b'a', response_headers={})
         assert not name
         assert not added
 
@@ -148,7 +169,7 @@ class TestRss(object):
                                              None)
 
         # test that we were called correctly and that the return values are ok
-        feedparser.assert_called_once_with('a')
+        feedparser.assert_called_once_with(b'a', response_headers={})
         assert not name
         assert not added
 
@@ -167,7 +188,7 @@ class TestRss(object):
                                              None)
 
         # test that we were called correctly and that the return values are ok
-        feedparser.assert_called_once_with('a')
+        feedparser.assert_called_once_with(b'a', response_headers={})
         assert not name
         assert not added
 
@@ -183,8 +204,8 @@ class TestRss(object):
         basicfeed['items'][0]['published'] = "not a valid date"
         feedparser.return_value = basicfeed
         # set up a mock for the database so we don't need to actually write one
-        database = Mock()
-        database.add_new_episode_data.return_value = True
+        database = mock_database()
+        database.add_new_episodes.side_effect = lambda name, eps: len(eps)
 
         # call the routine
         # I want this to raise and kill the program to know if we need to
@@ -205,15 +226,15 @@ class TestRss(object):
         del basicfeed['items'][0]['published']
         feedparser.return_value = basicfeed
         # set up a mock for the database so we don't need to actually write one
-        database = Mock()
-        database.add_new_episode_data.return_value = True
+        database = mock_database()
+        database.add_new_episodes.side_effect = lambda name, eps: len(eps)
 
         # call the routine
         name, added = add_episodes_from_feed(database, 'a', 'bdir',
                                              sys.maxsize, None)
 
         # check the feedparser mock
-        feedparser.assert_called_once_with('a')
+        feedparser.assert_called_once_with(b'a', response_headers={})
         assert not name
         assert not added
 
@@ -229,15 +250,15 @@ class TestRss(object):
         del basicfeed['items'][0]['title']
         feedparser.return_value = basicfeed
         # set up a mock for the database so we don't need to actually write one
-        database = Mock()
-        database.add_new_episode_data.return_value = True
+        database = mock_database()
+        database.add_new_episodes.side_effect = lambda name, eps: len(eps)
 
         # call the routine
         name, added = add_episodes_from_feed(database, 'a', 'bdir',
                                              sys.maxsize, None)
 
         # check the feedparser mock
-        feedparser.assert_called_once_with('a')
+        feedparser.assert_called_once_with(b'a', response_headers={})
         assert not name
         assert not added
 
@@ -253,15 +274,15 @@ class TestRss(object):
         del basicfeed['items'][0]['links']
         feedparser.return_value = basicfeed
         # set up a mock for the database so we don't need to actually write one
-        database = Mock()
-        database.add_new_episode_data.return_value = True
+        database = mock_database()
+        database.add_new_episodes.side_effect = lambda name, eps: len(eps)
 
         # call the routine
         name, added = add_episodes_from_feed(database, 'a', 'bdir',
                                              sys.maxsize, None)
 
         # check the feedparser mock
-        feedparser.assert_called_once_with('a')
+        feedparser.assert_called_once_with(b'a', response_headers={})
         assert not name
         assert not added
 
@@ -278,15 +299,15 @@ class TestRss(object):
         feedparser.return_value = basicfeed
 
         # set up a mock for the database so we don't need to actually write one
-        database = Mock()
-        database.add_new_episode_data.return_value = True
+        database = mock_database()
+        database.add_new_episodes.side_effect = lambda name, eps: len(eps)
 
         # call the routine
         name, added = add_episodes_from_feed(database, 'a', 'bdir',
                                              sys.maxsize, None)
 
         # check the feedparser mock
-        feedparser.assert_called_once_with('a')
+        feedparser.assert_called_once_with(b'a', response_headers={})
         assert not name
         assert not added
 
@@ -303,8 +324,8 @@ class TestRss(object):
         feedparser.return_value = basicfeed
 
         # set up a mock for the database so we don't need to actually write one
-        database = Mock()
-        database.add_new_episode_data.return_value = True
+        database = mock_database()
+        database.add_new_episodes.side_effect = lambda name, eps: len(eps)
 
         # call the routine
         pytest.raises(KeyError, add_episodes_from_feed, database, 'a', 'bdir',
@@ -320,23 +341,24 @@ class TestRss(object):
         # set up the mode for feedparser
         feedparser.return_value = basicfeed
         # set up a mock for the database so we don't need to actually write one
-        database = Mock()
-        database.add_new_episode_data.return_value = True
+        database = mock_database()
+        database.add_new_episodes.side_effect = lambda name, eps: len(eps)
 
         # call the routine
         name, added = add_episodes_from_feed(database, 'a', 'bdir',
                                              sys.maxsize, None)
 
         # check the feedparser mock
-        feedparser.assert_called_once_with('a')
+        feedparser.assert_called_once_with(b'a', response_headers={})
         assert name == u'99 Invisible'
         assert added == 1
 
-        # test database mock - note the "add new episode data" call takes a
+        # test database mock - note the "add new episodes" call takes a
         # complex structure.  I don't really want to test that here
         database.add_podcast.assert_called_once_with(u'99 Invisible', "a",
                                                      sys.maxsize)
-        assert database.add_new_episode_data.call_count == 1
+        assert database.add_new_episodes.call_count == 1
+        assert len(database.add_new_episodes.call_args[0][1]) == 1
 
     @patch('pyres.rss.utils.mkdir_p')
     @patch('pyres.rss.feedparser.parse')
@@ -367,23 +389,24 @@ class TestRss(object):
         # set up the mode for feedparser
         feedparser.return_value = largefeed
         # set up a mock for the database so we don't need to actually write one
-        database = Mock()
-        database.add_new_episode_data.return_value = True
+        database = mock_database()
+        database.add_new_episodes.side_effect = lambda name, eps: len(eps)
 
         # call the routine
         name, added = add_episodes_from_feed(database, 'a', 'bdir', throttle,
                                              None)
 
         # check the feedparser mock
-        feedparser.assert_called_once_with('a')
+        feedparser.assert_called_once_with(b'a', response_headers={})
         assert name == u'99 Invisible'
         assert added == expected
 
-        # test database mock - note the "add new episode data" call takes a
+        # test database mock - note the "add new episodes" call takes a
         # complex structure.  I don't really want to test that here
         database.add_podcast.assert_called_once_with(u'99 Invisible', "a",
                                                      throttle)
-        assert database.add_new_episode_data.call_count == expected
+        assert database.add_new_episodes.call_count == 1
+        assert len(database.add_new_episodes.call_args[0][1]) == expected
 
     @patch('pyres.rss.utils.mkdir_p')
     @patch('pyres.rss.feedparser.parse')
@@ -402,8 +425,8 @@ class TestRss(object):
         # set up the mode for feedparser
         feedparser.return_value = largefeed
         # set up a mock for the database so we don't need to actually write one
-        database = Mock()
-        database.add_new_episode_data.return_value = True
+        database = mock_database()
+        database.add_new_episodes.side_effect = lambda name, eps: len(eps)
 
         # convert the date string to the internally used date time
         date = time.strptime(start_date, "%Y/%m/%d")
@@ -413,7 +436,7 @@ class TestRss(object):
                                              sys.maxsize, date)
 
         # check the feedparser mock
-        feedparser.assert_called_once_with('a')
+        feedparser.assert_called_once_with(b'a', response_headers={})
         if expected:
             assert name == u'99 Invisible'
         assert added == expected
@@ -423,7 +446,8 @@ class TestRss(object):
         if expected:
             database.add_podcast.assert_called_once_with(u'99 Invisible', "a",
                                                          sys.maxsize)
-            assert database.add_new_episode_data.call_count == expected
+            assert len(database.add_new_episodes.call_args[0][1]) == \
+                expected
 
     @patch('pyres.rss.utils.mkdir_p')
     @patch('pyres.rss.feedparser.parse')
@@ -450,7 +474,7 @@ class TestRss(object):
                                                  date)
 
             # check the feedparser mock
-            feedparser.assert_called_once_with('a')
+            feedparser.assert_called_once_with(b'a', response_headers={})
             assert name == u'99 Invisible'
             assert added == 2
 
@@ -473,3 +497,212 @@ class TestRss(object):
             # be
             to_download = _database.find_episodes_to_download(u'99 Invisible')
             assert len(to_download) == 4
+
+    @patch('pyres.rss.utils.mkdir_p')
+    @patch('pyres.rss.feedparser.parse')
+    def test_rss_not_modified(self, feedparser, mkdir,
+                              http_get):  # pylint: disable=W0621
+        """  a 304 from the server means nothing is parsed or added """
+        assert self
+        assert mkdir
+        http_get.return_value.status_code = 304
+        database = mock_database()
+
+        name, episodes, validators = fetch_episodes_from_feed(
+            'a', 'bdir', None, ('tag', 'date', 'hash'))
+
+        http_get.assert_called_once_with(
+            'a', headers={'If-None-Match': 'tag',
+                          'If-Modified-Since': 'date'})
+        assert not feedparser.called
+        assert not name
+        assert not episodes
+        assert not validators
+        name, added = store_episodes(database, 'a', sys.maxsize, name,
+                                     episodes, validators)
+        assert not added
+        assert not database.add_new_episodes.called
+        assert not database.update_feed_validators.called
+
+    @patch('pyres.rss.feedparser.parse')
+    @pytest.mark.parametrize("error", [
+        requests.exceptions.ConnectionError(), 404])
+    # pylint: disable=W0621
+    def test_rss_read_error(self, feedparser, http_get, error):
+        """  a feed which cannot be read is skipped """
+        assert self
+        if isinstance(error, int):
+            http_get.return_value.status_code = error
+        else:
+            http_get.side_effect = error
+        name, episodes, validators = fetch_episodes_from_feed('a', 'bdir')
+        assert not name
+        assert not episodes
+        assert not validators
+        assert not feedparser.called
+
+    @patch('pyres.rss.utils.mkdir_p')
+    @patch('pyres.rss.feedparser.parse')
+    def test_rss_unchanged_content(self, feedparser, mkdir, http_get,
+                                   largefeed):  # pylint: disable=W0621
+        """  a feed whose content matches the saved hash is not parsed but
+        the new validators are still saved """
+        assert self
+        assert mkdir
+        http_get.return_value.headers['ETag'] = 'tag'
+        feedparser.return_value = largefeed
+
+        name, episodes, validators = fetch_episodes_from_feed('a', 'bdir')
+        feedparser.assert_called_once_with(
+            b'a', response_headers={'ETag': 'tag'})
+        assert name == u'99 Invisible'
+        assert len(episodes) == 4
+        assert validators[0] == 'tag'
+        assert validators[2]
+
+        # same content a second time around gives nothing back, but the
+        # server's new ETag is kept for the next request
+        http_get.return_value.headers['ETag'] = 'tag2'
+        name, episodes, new_validators = fetch_episodes_from_feed(
+            'a', 'bdir', None, (None, None, validators[2]))
+        assert feedparser.call_count == 1
+        assert not name
+        assert not episodes
+        assert new_validators == ('tag2', None, validators[2])
+        database = mock_database()
+        store_episodes(database, 'a', sys.maxsize, name, episodes,
+                       new_validators)
+        database.update_feed_validators.assert_called_once_with(
+            'a', new_validators)
+
+        # new content changes the hash
+        http_get.return_value.content = b'b'
+        name, episodes, new_validators = fetch_episodes_from_feed(
+            'a', 'bdir', None, (None, None, validators[2]))
+        assert name == u'99 Invisible'
+        assert new_validators[2] != validators[2]
+
+    @patch('pyres.rss.utils.mkdir_p')
+    @patch('pyres.rss.feedparser.parse')
+    @pytest.mark.parametrize("throttle, saved", [
+        (sys.maxsize, True), (4, True), (3, False),
+    ])  # pylint: disable=too-many-arguments
+    def test_rss_throttle_validators(self, feedparser, mkdir, throttle,
+                                     saved, http_get,
+                                     largefeed):  # pylint: disable=W0621
+        """  validators are only kept if every episode was added """
+        assert self
+        assert mkdir
+        http_get.return_value.headers['ETag'] = 'tag'
+        feedparser.return_value = largefeed
+        database = mock_database()
+        database.add_new_episodes.side_effect = lambda name, eps: len(eps)
+
+        name, episodes, validators = fetch_episodes_from_feed('a', 'bdir')
+        store_episodes(database, 'a', throttle, name, episodes, validators)
+
+        if saved:
+            database.update_feed_validators.assert_called_once_with(
+                'a', validators)
+        else:
+            database.update_feed_validators.assert_called_once_with(
+                'a', (None, None, None))
+
+    @patch('pyres.rss.utils.mkdir_p')
+    @patch('pyres.rss.feedparser.parse')
+    def test_rss_local_file(self, feedparser, mkdir, http_get, tmpdir,
+                            basicfeed):  # pylint: disable=W0621
+        """  feeds in local files are read by feedparser, not over
+        HTTP """
+        assert self
+        assert mkdir
+        feedparser.return_value = basicfeed
+        feed_file = tmpdir.join('feed.xml')
+        feed_file.write('feed')
+        for url in (str(feed_file), 'file://' + str(feed_file)):
+            name, episodes, validators = fetch_episodes_from_feed(url, 'bdir')
+            feedparser.assert_called_with(url)
+            assert name == u'99 Invisible'
+            assert len(episodes) == 1
+            assert validators is None
+        assert not http_get.called
+
+    @patch('pyres.rss.utils.mkdir_p')
+    @patch('pyres.rss.feedparser.parse')
+    def test_rss_stops_at_old_items(self, feedparser, mkdir,
+                                    largefeed):  # pylint: disable=W0621
+        """  a newest first feed is not read past the old episodes """
+        assert self
+        assert mkdir
+        # newest first, followed by an item which would raise if it was read
+        largefeed['items'].reverse()
+        largefeed['items'].append({
+            'published': u'not a valid date',
+            'title': u'0 - never read',
+            'links': [{'href': u'Link 0', 'type': u'audio/mpeg'}],
+        })
+        feedparser.return_value = largefeed
+        # the newest episode we have is the third one
+        date = time.strptime('2015/05/21 04:47:53', "%Y/%m/%d %H:%M:%S")
+
+        name, episodes, _ = fetch_episodes_from_feed('a', 'bdir', date, None,
+                                                     b'3 - title 3')
+        assert name == u'99 Invisible'
+        assert len(episodes) == 1
+
+        # the bad item is reached if the episode we have is not in the feed
+        pytest.raises(ValueError, fetch_episodes_from_feed, 'a', 'bdir', date,
+                      None, b'3 - old title')
+
+    @patch('pyres.rss.utils.mkdir_p')
+    @patch('pyres.rss.feedparser.parse')
+    def test_rss_unsorted_feed(self, feedparser, mkdir,
+                               largefeed):  # pylint: disable=W0621
+        """  a feed out of date order is read all the way through """
+        assert self
+        assert mkdir
+        # three old episodes out of order, then a new one at the end
+        items = largefeed['items']
+        largefeed['items'] = [items[1], items[2], items[0], items[3]]
+        feedparser.return_value = largefeed
+        date = time.strptime('2015/05/21 12', "%Y/%m/%d %H")
+
+        name, episodes, _ = fetch_episodes_from_feed('a', 'bdir', date)
+        assert name == u'99 Invisible'
+        assert len(episodes) == 1
+        assert episodes[0].url == u'Link 4'
+
+    @patch('pyres.rss.utils.mkdir_p')
+    @patch('pyres.rss.feedparser.parse')
+    def test_rss_new_item_after_old(self, feedparser, mkdir,
+                                    largefeed):  # pylint: disable=W0621
+        """  a new episode after several old ones in date order is still
+        found when the episode we have is not in the feed """
+        assert self
+        assert mkdir
+        items = largefeed['items']
+        largefeed['items'] = [items[2], items[1], items[0], items[3]]
+        feedparser.return_value = largefeed
+        date = time.strptime('2015/05/21 12', "%Y/%m/%d %H")
+
+        name, episodes, _ = fetch_episodes_from_feed('a', 'bdir', date, None,
+                                                     b'deleted episode')
+        assert name == u'99 Invisible'
+        assert [episode.url for episode in episodes] == [u'Link 4']
+
+    @patch('pyres.rss.utils.mkdir_p')
+    @patch('pyres.rss.feedparser.parse')
+    @pytest.mark.parametrize("length, size", [
+        ('1234', 1234), ('0', None), ('', None), (None, None)])
+    def test_rss_enclosure_length(self, feedparser, mkdir, basicfeed,
+                                  length, size):  # pylint: disable=W0621
+        """  the enclosure length is used as the size of the episode """
+        assert self
+        assert mkdir
+        if length is not None:
+            basicfeed['items'][0]['links'][0]['length'] = length
+        feedparser.return_value = basicfeed
+        _, episodes, _ = fetch_episodes_from_feed('a', 'bdir')
+        episodes = list(episodes)
+        assert len(episodes) == 1
+        assert episodes[0].size == size
@@ -0,0 +1,125 @@
+""" Test the schedule module """
+import time
+import pytest
+import requests
+from mock import patch
+from mock import Mock
+import pyres.episode
+import pyres.schedule as schedule
+
+
+def make_episode(title, podcast, day, size=None):
+    """ Build an episode published on the given day of 2015 """
+    return pyres.episode.Episode(date=time.strptime("2015 %d" % day, "%Y %j"),
+                                 title=title, url='http://x/' + title,
+                                 podcast=podcast, file_name=title,
+                                 size=size)
+
+
+@pytest.fixture
+def episodes():
+    """ Provide episodes as the database returns them, by podcast """
+    return [make_episode('a1', 'a', 1, 300),
+            make_episode('a2', 'a', 5, None),
+            make_episode('a3', 'a', 9, 100),
+            make_episode('b1', 'b', 2, 200),
+            make_episode('c1', 'c', 3, 50),
+            make_episode('c2', 'c', 4, 0)]
+
+
+def titles(ordered):
+    """ Return the titles of the episodes in order """
+    return [episode.title for episode in ordered]
+
+
+class TestSchedules(object):
+    """ test each schedule """
+
+    # pylint: disable=W0621
+    def test_by_podcast(self, episodes):
+        """ the order from the database is kept """
+        assert self
+        assert titles(schedule.by_podcast(episodes)) == titles(episodes)
+
+    def test_shortest_first(self, episodes):
+        """ smallest first with unknown sizes last """
+        assert self
+        assert titles(schedule.shortest_first(episodes)) == \
+            ['c1', 'a3', 'b1', 'a1', 'a2', 'c2']
+
+    def test_newest_first(self, episodes):
+        """ most recent first """
+        assert self
+        assert titles(schedule.newest_first(episodes)) == \
+            ['a3', 'a2', 'c2', 'c1', 'b1', 'a1']
+
+    def test_round_robin(self, episodes):
+        """ one from each podcast in turn """
+        assert self
+        assert titles(schedule.round_robin(episodes)) == \
+            ['a1', 'b1', 'c1', 'a2', 'c2', 'a3']
+
+    def test_order_episodes(self, episodes):
+        """ schedules are chosen by name and only shortest probes sizes """
+        assert self
+        with patch('pyres.schedule.probe_sizes') as probe_sizes:
+            assert titles(schedule.order_episodes(
+                iter(episodes), schedule.FAIR)) == \
+                titles(schedule.round_robin(episodes))
+            assert not probe_sizes.called
+            schedule.order_episodes(episodes, schedule.SHORTEST)
+            probe_sizes.assert_called_once_with(episodes)
+
+
+class TestQueueKey(object):
+    """ test ordering episodes as they arrive """
+
+    # pylint: disable=W0621
+    @pytest.mark.parametrize("name", [schedule.SHORTEST, schedule.NEWEST,
+                                      schedule.FAIR])
+    def test_same_order(self, episodes, name):
+        """ sorting by the key gives the order of the schedule """
+        assert self
+        with patch('pyres.schedule.probe_sizes') as probe_sizes:
+            assert titles(sorted(episodes,
+                                 key=schedule.queue_key(name))) == \
+                titles(schedule.order_episodes(episodes, name))
+        assert probe_sizes.call_count == (name == schedule.SHORTEST)
+
+    def test_by_podcast(self):
+        """ the podcast schedule keeps the order they arrive in """
+        assert self
+        assert schedule.queue_key(schedule.PODCAST) is None
+
+
+class TestProbe(object):
+    """ test finding sizes with HEAD requests """
+
+    # pylint: disable=W0621
+    def test_probe_sizes(self, episodes):
+        """ only unknown sizes are asked for and bad answers are ignored """
+        assert self
+
+        def head(url):
+            """ a2 has a length, c2 fails """
+            if url.endswith('c2'):
+                raise requests.exceptions.ConnectionError()
+            return Mock(status_code=200,
+                        headers={'content-length': '400'})
+
+        with patch('pyres.schedule.httpclient.head',
+                   side_effect=head) as mock_head:
+            schedule.probe_sizes(episodes)
+        assert sorted(call[0][0] for call in mock_head.call_args_list) == \
+            ['http://x/a2', 'http://x/c2']
+        assert [episode.size for episode in episodes] == \
+            [300, 400, 100, 200, 50, 0]
+
+    def test_no_length(self, episodes):
+        """ a reply without a usable length leaves the size unknown """
+        assert self
+        with patch('pyres.schedule.httpclient.head',
+                   return_value=Mock(status_code=404, headers={
+                       'content-length': '12'})):
+            schedule.probe_sizes(episodes)
+        assert episodes[1].size is None
@@ -1,11 +1,110 @@
 """ Test the utils package """
+import os
 import pytest
 import errno
+import hashlib
 import pyres.utils
 from mock import patch
 from mock import Mock
 
 
+class TestReplaceFile(object):
+    """ Test the replace_file function"""
+
+    def test_replace(self, tmpdir):
+        """ the destination is replaced and the source is gone """
+        assert self
+        source = tmpdir.join('source')
+        destination = tmpdir.join('destination')
+        source.write('new')
+        destination.write('old')
+        pyres.utils.replace_file(str(source), str(destination))
+        assert destination.read() == 'new'
+        assert not source.exists()
+
+
+class TestPreallocate(object):
+    """ Test the preallocate and sync functions"""
+
+    @pytest.mark.skipif(not hasattr(pyres.utils.os, 'posix_fallocate'),
+                        reason="needs posix_fallocate")
+    def test_preallocate(self, tmpdir):
+        """ the file grows to the size asked for """
+        assert self
+        with open(str(tmpdir.join('file')), 'wb') as the_file:
+            assert pyres.utils.preallocate(the_file, 1000)
+        assert tmpdir.join('file').size() == 1000
+
+    def test_not_supported(self, tmpdir):
+        """ filesystems which cannot preallocate are left alone but a full
+        disk is an error """
+        assert self
+        with open(str(tmpdir.join('file')), 'wb') as the_file:
+            assert not pyres.utils.preallocate(the_file, 0)
+            with patch('pyres.utils.os.posix_fallocate', create=True,
+                       side_effect=OSError(errno.EOPNOTSUPP, 'no')):
+                assert not pyres.utils.preallocate(the_file, 1000)
+            with patch('pyres.utils.os.posix_fallocate', create=True,
+                       side_effect=OSError(errno.ENOSPC, 'full')):
+                with pytest.raises(OSError):
+                    pyres.utils.preallocate(the_file, 1000)
+
+    def test_sync(self, tmpdir):
+        """ files and directories can be synced """
+        assert self
+        tmpdir.join('file').write('data')
+        with patch('pyres.utils.os.fsync') as fsync:
+            pyres.utils.sync_file(str(tmpdir.join('file')))
+            pyres.utils.sync_directory(str(tmpdir))
+        assert fsync.call_count == 2
+
+
+class TestHash(object):
+    """ Test hashing and linking identical files"""
+
+    def test_hash_file_object(self, tmpdir):
+        """ the start of a file is hashed a block at a time """
+        assert self
+        tmpdir.join('file').write('abcdef')
+        with open(str(tmpdir.join('file')), 'rb') as the_file:
+            the_hash = pyres.utils.hash_file_object(the_file,
+                                                    hashlib.sha256(), 3, 2)
+        assert the_hash.hexdigest() == \
+            'ba7816bf8f01cfea414140de5dae2223b00361a396177a9cb410ff61f20015ad'
+
+    def test_link_file(self, tmpdir):
+        """ the file is replaced by a link to the one we already have """
+        assert self
+        existing = tmpdir.join('existing')
+        duplicate = tmpdir.join('duplicate')
+        existing.write('same')
+        duplicate.write('same')
+        assert pyres.utils.link_file(str(existing), str(duplicate))
+        assert os.path.samefile(str(existing), str(duplicate))
+        assert sorted(os.listdir(str(tmpdir))) == ['duplicate', 'existing']
+
+    def test_link_fails(self, tmpdir):
+        """ a file which cannot be linked is left alone """
+        assert self
+        duplicate = tmpdir.join('duplicate')
+        duplicate.write('same')
+        assert not pyres.utils.link_file(str(tmpdir.join('missing')),
+                                         str(duplicate))
+        assert duplicate.read() == 'same'
+        assert os.listdir(str(tmpdir)) == ['duplicate']
+
+
+class TestDurationString(object):
+    """ Test the duration_as_string function"""
+
+    @pytest.mark.parametrize("seconds, expected", [
+        (0, "0:00:00"), (61.6, "0:01:02"), (3600 * 27 + 5, "27:00:05")])
+    def test_duration(self, seconds, expected):
+        """ hours, minutes and seconds """
+        assert self
+        assert pyres.utils.duration_as_string(seconds) == expected
+
+
 class TestMkdir(object):
     """ Test the mkdir_p function"""
 
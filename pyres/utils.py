@@ -4,6 +4,7 @@ Utility functions shared by pyres tool
 import os
 import time
 import errno
+import pyres.dates as dates
 
 
 def mkdir_p(_path):
@@ -20,6 +21,90 @@ def mkdir_p(_path):
             raise
 
 
+def replace_file(source, destination):
+    """ Rename source to destination, replacing destination if it exists.
+    On POSIX systems the rename is atomic. """
+    if hasattr(os, 'replace'):
+        os.replace(source, destination)
+    else:
+        # python 2 has no os.replace and os.rename will not overwrite on
+        # windows
+        if os.name == 'nt' and os.path.exists(destination):
+            os.remove(destination)
+        os.rename(source, destination)
+
+
+def preallocate(file_object, size):
+    """ Reserve size bytes on the disk for an open file, where the system
+    supports it.  Returns True if the space was reserved. """
+    if not size or not hasattr(os, 'posix_fallocate'):
+        return False
+    file_object.flush()
+    try:
+        os.posix_fallocate(file_object.fileno(), 0, size)
+    except OSError as exc:
+        # not every filesystem can do it, but a full disk is still an error
+        if exc.errno in (errno.EOPNOTSUPP, errno.EINVAL, errno.ENOSYS):
+            return False
+        raise
+    return True
+
+
+def sync_file(file_name):
+    """ Force the contents of a file out to the disk """
+    descriptor = os.open(file_name, os.O_RDONLY)
+    try:
+        os.fsync(descriptor)
+    finally:
+        os.close(descriptor)
+
+
+def sync_directory(directory):
+    """ Force the entries of a directory out to the disk, so a file renamed
+    into it stays renamed after a crash.  Not possible on windows. """
+    if os.name == 'nt':
+        return
+    descriptor = os.open(directory, os.O_RDONLY)
+    try:
+        os.fsync(descriptor)
+    except OSError:
+        pass  # some filesystems cannot sync a directory
+    finally:
+        os.close(descriptor)
+
+
+def hash_file_object(file_object, the_hash, size=None, block_size=1 << 20):
+    """ Add size bytes, or the rest, of an open file to the_hash, which can
+    be anything with an update method """
+    while size is None or size > 0:
+        block = file_object.read(block_size if size is None
+                                 else min(block_size, size))
+        if not block:
+            break
+        the_hash.update(block)
+        if size is not None:
+            size -= len(block)
+    return the_hash
+
+
+def link_file(existing, file_name):
+    """ Replace file_name with a hard link to existing, which must have the
+    same contents.  Returns False, leaving file_name alone, if the link
+    cannot be made, for instance across filesystems. """
+    link_name = file_name + ".link"
+    try:
+        if os.path.exists(link_name):
+            os.remove(link_name)
+        os.link(existing, link_name)
+        replace_file(link_name, file_name)
+    except (OSError, AttributeError):
+        # python 2 on windows has no os.link
+        if os.path.exists(link_name):
+            os.remove(link_name)
+        return False
+    return True
+
+
 def clean_name(value):
     """ remove bad character from possible file name component """
     deletechars = r"\/:*%?\"<>|'"
@@ -30,7 +115,7 @@ def clean_name(value):
 
 def string_to_date(date_string):
     """ Convert a formatted string into a date."""
-    return time.strptime(date_string, "%Y/%m/%d:%H:%M:%S")
+    return dates.parse_database_date(date_string)
 
 
 def date_as_string(value):
@@ -43,6 +128,13 @@ def current_date_time_as_string():
     return time.strftime("%Y_%m_%d_%H_%M_%S")
 
 
+def duration_as_string(seconds):
+    """ Format a number of seconds as hours:minutes:seconds """
+    minutes, seconds = divmod(int(round(seconds)), 60)
+    hours, minutes = divmod(minutes, 60)
+    return "%d:%02d:%02d" % (hours, minutes, seconds)
+
+
 def acroname(name):
     """ Returns a three letter acronym given a podcast title """
     if not len(name):